@@ -0,0 +1,120 @@
+'''
+Synthetic fixtures for the benchmarks: annotation archives and PDF documents.
+
+Fixtures are generated from a seed, so that two runs (on two commits) measure the same data.
+Annotation pages follow the layout of the real ones (see `tests/resources/annotations`): a tree of
+sections and columns of entries, with their boxes, lines and parsed fields. Documents are made of
+full-page grayscale JPEG scans, with dark strokes on a light background like printed directories.
+'''
+
+import json
+import random
+import zipfile
+from io import BytesIO
+
+from PIL import Image, ImageDraw
+from pikepdf import Dictionary, Name, Pdf, Stream
+
+# Sizes of a page: in pixels (scan), and in PDF units
+PAGE_SIZE = (1700, 2650)
+PAGE_BOX = (612, 954)
+
+_NAMES = ["Kibleur", "Kidd (Mme)", "Kieffer", "Lambert", "Leblanc", "Martin", "Moreau", "Petit", "Roux",
+          "Durand", "Dubois", "Bernard", "Fournier", "Girard", "Bonnet", "Dupont", "Lefebvre", "Mercier"]
+_ACTIVITIES = ["marbrier", "avoué de 1re instance", "boulanger", "md de vins", "horloger", "notaire",
+               "épicier", "tailleur", "serrurier", "libraire", "bijoutier", "fab. de papiers peints"]
+_STREETS = ["St-Nicolas-St-Antoine", "Castiglione", "Christine", "St-Honoré", "Richelieu", "Rivoli",
+            "Faub.-St-Denis", "Montmartre", "Vieille-du-Temple", "Bac", "Grenelle-St-Germain"]
+
+
+def make_page(rng: random.Random, view: int) -> dict:
+    '''
+    Return the annotations of a page: a title and 2 or 3 columns of 35 to 50 entries.
+    '''
+    left, top, width, height = 252, 76, 1428, 2550
+    columns = rng.choice([2, 3])
+    column_width = width // columns
+    children = [{"type": "TITLE_LEVEL_1", "box": [left, top, width, 34], "text": f"{view} KNA KRE LAB\n"}]
+    column_nodes = []
+    for column in range(columns):
+        x = left + column * column_width
+        entries = []
+        y = top + 54
+        for _ in range(rng.randint(35, 50)):
+            name, activity, street = rng.choice(_NAMES), rng.choice(_ACTIVITIES), rng.choice(_STREETS)
+            number = str(rng.randint(1, 180))
+            lines = rng.choice([1, 1, 1, 2])
+            box = [x + 2, y, rng.randint(column_width // 2, column_width - 20), 26 * lines]
+            entries.append({
+                "type": "ENTRY",
+                "box": box,
+                "children": [{"type": "LINE", "box": [box[0], box[1] + 26 * i, box[2], 26], "text": "",
+                              "indented": i > 0, "EOL": i == lines - 1} for i in range(lines)],
+                "raw": f"##{name}##, {activity}, @@{street}@@, $${number}$$.\n",
+                "name": name,
+                "street": street,
+                "street_number": number,
+                "grade": rng.choice([-1, 126]),
+                "perfect_match": rng.random() < 0.3,
+            })
+            y += box[3] + 2
+        column_box = [x, top + 52, column_width, height - 52]
+        column_nodes.append({"type": "COLUMN_LEVEL_1", "box": column_box, "children": [
+            {"type": "SECTION_LEVEL_2", "box": column_box, "children": [
+                {"type": "COLUMN_LEVEL_2", "box": column_box, "children": entries}]}]})
+    children.append({"type": "SECTION_LEVEL_1", "box": [left, top + 52, width, height - 52], "children": column_nodes})
+    return {"type": "PAGE", "box": [left, top, width, height], "children": children}
+
+
+def make_annotation_archive(path: str, views: int, seed: int = 0):
+    '''
+    Write an annotation archive of `views` pages (views 1 to `views`), as uploaded by the annotator.
+    '''
+    rng = random.Random(seed)
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        for view in range(1, views + 1):
+            archive.writestr(f"{view:04}.json", json.dumps(make_page(rng, view), ensure_ascii=False))
+
+
+def make_scan(rng: random.Random, size: tuple = PAGE_SIZE) -> bytes:
+    '''
+    Return a JPEG image looking like a scanned page of a directory: lines of dark strokes.
+    '''
+    image = Image.new("L", size, 236)
+    draw = ImageDraw.Draw(image)
+    margin = size[0] // 10
+    column_width = (size[0] - 2 * margin) // 2
+    for column in range(2):
+        x0 = margin + column * column_width
+        for y in range(margin, size[1] - margin, 30):
+            x = x0
+            x1 = x0 + rng.randint(column_width // 2, column_width - 20)
+            while x < x1:
+                word = rng.randint(15, 90)
+                draw.rectangle([x, y, min(x + word, x1), y + 16], fill=rng.randint(20, 80))
+                x += word + rng.randint(8, 14)
+    out = BytesIO()
+    image.save(out, format="JPEG", quality=80)
+    return out.getvalue()
+
+
+def make_document(path: str, pages: int, seed: int = 0, distinct_scans: int = 8):
+    '''
+    Write a PDF document of `pages` pages, each made of a full-page JPEG image (the images are
+    stored for each page, their content cycles over `distinct_scans` scans).
+    '''
+    rng = random.Random(seed)
+    scans = [make_scan(rng) for _ in range(min(pages, distinct_scans))]
+    pdf = Pdf.new()
+    for page_index in range(pages):
+        image = Stream(pdf, scans[page_index % len(scans)])
+        image.Type = Name.XObject
+        image.Subtype = Name.Image
+        image.Width, image.Height = PAGE_SIZE
+        image.ColorSpace = Name.DeviceGray
+        image.BitsPerComponent = 8
+        image.Filter = Name.DCTDecode
+        page = pdf.add_blank_page(page_size=PAGE_BOX)
+        page.Resources = Dictionary(XObject=Dictionary(Im0=image))
+        page.Contents = Stream(pdf, f"q {PAGE_BOX[0]} 0 0 {PAGE_BOX[1]} 0 0 cm /Im0 Do Q".encode())
+    pdf.save(path)
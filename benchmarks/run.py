@@ -0,0 +1,267 @@
+'''
+Benchmarks of the annotation storage and of the page images.
+
+Measures the latency (mean, p50, p90, p99) and throughput of the storage and document functions
+called by the request handlers, on synthetic fixtures generated from a seed (see `fixtures`):
+annotation archives of 100 to 3000 views, and a document of a few hundred JPEG pages.
+The results are written as JSON, with the commit and the environment they were measured on,
+so that two commits can be compared:
+
+    python -m benchmarks.run --output base.json
+    (change the code)
+    python -m benchmarks.run --output new.json --compare base.json
+
+With `--compare`, the process exits with status 1 when the median latency of a benchmark grew
+by more than `--max-regression` (25% by default). `--quick` runs small sizes, for a smoke test.
+'''
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from directory_annotator_storage.annotation_backend import create_annotation_backend
+from directory_annotator_storage.backend_annotations import configure_annotation_cache
+from directory_annotator_storage.backend_documents import (
+    configure_pdf_cache, get_document_pages, get_image_from_view)
+from directory_annotator_storage.constants_config import (
+    ANNOT_BACKEND, ANNOT_PATH, DEFAULT_ANNOT_CACHE_SIZE, DEFAULT_PDF_CACHE_SIZE)
+
+from benchmarks.fixtures import make_annotation_archive, make_document, make_page
+
+DOCUMENT_NAME = "Bench_1850a.pdf"
+
+# Full and quick runs: views of the annotation archives, pages of the document, iterations
+SIZES = {"views": [100, 1000, 3000], "pages": 300, "iterations": 200}
+QUICK_SIZES = {"views": [20, 100], "pages": 20, "iterations": 20}
+
+
+def measure(name: str, function, iterations: int, setup=None, **params) -> dict:
+    '''
+    Call `function(i)` `iterations` times (after `setup(i)` when defined, not timed) and
+    return the statistics of the durations, in milliseconds.
+    '''
+    durations = []
+    for i in range(iterations):
+        if setup is not None:
+            setup(i)
+        start = time.perf_counter()
+        function(i)
+        durations.append(time.perf_counter() - start)
+    durations.sort()
+    total = sum(durations)
+
+    def percentile(p):
+        return durations[min(len(durations) - 1, int(round(p / 100 * (len(durations) - 1))))] * 1000
+
+    result = {
+        "name": name,
+        "params": params,
+        "iterations": iterations,
+        "throughput": iterations / total if total > 0 else None,
+        "mean_ms": total / iterations * 1000,
+        "p50_ms": percentile(50),
+        "p90_ms": percentile(90),
+        "p99_ms": percentile(99),
+        "min_ms": durations[0] * 1000,
+        "max_ms": durations[-1] * 1000,
+    }
+    print(f"{name:<32} {json.dumps(params):<28} p50 {result['p50_ms']:9.3f} ms  "
+          f"p99 {result['p99_ms']:9.3f} ms  {result['throughput']:10.1f} /s", flush=True)
+    return result
+
+
+def annotation_benchmarks(backend, archive_path: str, views: int, iterations: int, seed: int) -> list:
+    '''
+    Benchmarks of the annotation storage on a document of `views` views, restored from
+    `archive_path` before each benchmark.
+    '''
+    rng = random.Random(seed)
+    order = [rng.randint(1, views) for _ in range(iterations)]
+    pages = [make_page(rng, view) for view in order]
+    params = {"views": views}
+
+    def restore():
+        with open(archive_path, "rb") as archive:
+            backend.replace(DOCUMENT_NAME, archive)
+
+    results = []
+    restore()
+    configure_annotation_cache(0)
+    results.append(measure("load_annotations", lambda i: backend.load(DOCUMENT_NAME, order[i]),
+                           iterations, cache="none", **params))
+    configure_annotation_cache(DEFAULT_ANNOT_CACHE_SIZE)
+    for view in set(order):
+        backend.load(DOCUMENT_NAME, view)
+    results.append(measure("load_annotations", lambda i: backend.load(DOCUMENT_NAME, order[i]),
+                           iterations, cache="warm", **params))
+
+    restore()
+    results.append(measure("save_annotations", lambda i: backend.save(DOCUMENT_NAME, views + 1 + i, pages[i]),
+                           iterations, target="new_view", **params))
+    restore()
+    results.append(measure("save_annotations", lambda i: backend.save(DOCUMENT_NAME, order[i], pages[i]),
+                           iterations, target="replaced_view", **params))
+
+    # Exports are slower: fewer iterations
+    export_iterations = max(5, iterations // 10)
+    restore()
+    results.append(measure("export_annotations", lambda i: backend.export_zip(DOCUMENT_NAME),
+                           export_iterations, after="nothing", **params))
+    results.append(measure("export_annotations", lambda i: backend.export_zip(DOCUMENT_NAME),
+                           export_iterations, setup=lambda i: backend.save(DOCUMENT_NAME, order[i], pages[i]),
+                           after="save", **params))
+    return results
+
+
+def document_benchmarks(documents_dir: str, pages: int, iterations: int, seed: int) -> list:
+    '''
+    Benchmarks of the access to the pages of a document of `pages` pages.
+    '''
+    rng = random.Random(seed)
+    order = [rng.randint(1, pages) for _ in range(iterations)]
+    params = {"pages": pages}
+
+    results = []
+    configure_pdf_cache(0)
+    results.append(measure("get_document_pages", lambda i: get_document_pages(documents_dir, DOCUMENT_NAME),
+                           iterations, pdf_cache="none", **params))
+    results.append(measure("get_image_from_view", lambda i: get_image_from_view(documents_dir, DOCUMENT_NAME,
+                                                                                order[i]),
+                           iterations, pdf_cache="none", output="passthrough", **params))
+    configure_pdf_cache(DEFAULT_PDF_CACHE_SIZE)
+    results.append(measure("get_document_pages", lambda i: get_document_pages(documents_dir, DOCUMENT_NAME),
+                           iterations, pdf_cache="warm", **params))
+    results.append(measure("get_image_from_view", lambda i: get_image_from_view(documents_dir, DOCUMENT_NAME,
+                                                                                order[i]),
+                           iterations, pdf_cache="warm", output="passthrough", **params))
+    # Decoding and encoding as PNG is slower: fewer iterations
+    png_iterations = max(5, iterations // 20)
+    results.append(measure("get_image_from_view", lambda i: get_image_from_view(documents_dir, DOCUMENT_NAME,
+                                                                                order[i], ()),
+                           png_iterations, pdf_cache="warm", output="png", **params))
+    return results
+
+
+def prepare_fixtures(fixtures_dir: str, sizes: dict, seed: int) -> dict:
+    '''
+    Generate the missing fixtures in `fixtures_dir`, return their paths: `archives` (by number
+    of views) and `documents` (the directory of the document).
+    '''
+    os.makedirs(fixtures_dir, exist_ok=True)
+    archives = {}
+    for views in sizes["views"]:
+        archives[views] = os.path.join(fixtures_dir, f"annotations-{views}-{seed}.zip")
+        if not os.path.exists(archives[views]):
+            print(f"Generating {archives[views]}", flush=True)
+            make_annotation_archive(archives[views], views, seed)
+    documents_dir = os.path.join(fixtures_dir, f"documents-{sizes['pages']}-{seed}")
+    document_path = os.path.join(documents_dir, DOCUMENT_NAME)
+    if not os.path.exists(document_path):
+        print(f"Generating {document_path}", flush=True)
+        os.makedirs(documents_dir, exist_ok=True)
+        make_document(document_path, sizes["pages"], seed)
+    return {"archives": archives, "documents": documents_dir}
+
+
+def environment() -> dict:
+    '''
+    Return the description of the code and machine the benchmarks ran on.
+    '''
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    versions = {}
+    for module_name in ("pikepdf", "PIL"):
+        try:
+            versions[module_name] = getattr(__import__(module_name), "__version__", None)
+        except ImportError:
+            versions[module_name] = None
+    return {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "versions": versions,
+    }
+
+
+def compare(results: list, baseline: list, max_regression: float) -> list:
+    '''
+    Return the descriptions of the benchmarks whose median latency grew by more than
+    `max_regression` (a ratio) since `baseline`.
+    '''
+    def key(result):
+        return result["name"], json.dumps(result["params"], sort_keys=True)
+
+    previous = {key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get(key(result))
+        if before is None or before["p50_ms"] <= 0:
+            continue
+        change = result["p50_ms"] / before["p50_ms"] - 1
+        print(f"{result['name']:<32} {json.dumps(result['params']):<28} p50 {change:+8.1%}")
+        if change > max_regression:
+            regressions.append(f"{result['name']} {json.dumps(result['params'])}: "
+                               f"{before['p50_ms']:.3f} -> {result['p50_ms']:.3f} ms")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the annotation storage and the page images.")
+    parser.add_argument("--quick", action="store_true", help="Small sizes, for a smoke test")
+    parser.add_argument("--backend", default="zip", choices=["zip", "sqlite"], help="Annotation storage")
+    parser.add_argument("--views", type=int, nargs="+", help="Numbers of views of the annotation archives")
+    parser.add_argument("--pages", type=int, help="Number of pages of the document")
+    parser.add_argument("--iterations", type=int, help="Iterations of each benchmark")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the fixtures and of the accessed views")
+    parser.add_argument("--fixtures", help="Directory of the fixtures, generated when missing (default: temporary)")
+    parser.add_argument("--output", help="JSON file of the results")
+    parser.add_argument("--compare", help="JSON file of the results to compare with")
+    parser.add_argument("--max-regression", type=float, default=0.25,
+                        help="Maximum growth of the median latencies when comparing (default: 0.25)")
+    args = parser.parse_args(argv)
+
+    sizes = dict(QUICK_SIZES if args.quick else SIZES)
+    for name in ("views", "pages", "iterations"):
+        if getattr(args, name) is not None:
+            sizes[name] = getattr(args, name)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        fixtures = prepare_fixtures(args.fixtures or os.path.join(work_dir, "fixtures"), sizes, args.seed)
+        results = []
+        for views in sizes["views"]:
+            annotation_dir = os.path.join(work_dir, f"annotations-{views}")
+            os.makedirs(annotation_dir)
+            backend = create_annotation_backend({ANNOT_PATH: annotation_dir, ANNOT_BACKEND: args.backend})
+            for result in annotation_benchmarks(backend, fixtures["archives"][views], views,
+                                                sizes["iterations"], args.seed):
+                result["params"]["backend"] = args.backend
+                results.append(result)
+        results.extend(document_benchmarks(fixtures["documents"], sizes["pages"], sizes["iterations"], args.seed))
+
+    report = {"environment": environment(), "sizes": sizes, "seed": args.seed, "results": results}
+    if args.output:
+        with open(args.output, "w") as out_file:
+            json.dump(report, out_file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as in_file:
+            regressions = compare(results, json.load(in_file)["results"], args.max_regression)
+        if len(regressions) > 0:
+            print("Regressions:\n  " + "\n  ".join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -48,6 +48,10 @@ def create_app(test_config=None):
     # Apply the blueprints to the app
     from directory_annotator_storage import health_check
     app.register_blueprint(health_check.bp)
+    from directory_annotator_storage import metrics
+    app.register_blueprint(metrics.bp)
+    from directory_annotator_storage import profiling
+    app.register_blueprint(profiling.bp)
     from directory_annotator_storage import directories
     app.register_blueprint(directories.bp)
 
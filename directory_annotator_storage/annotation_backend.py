@@ -0,0 +1,253 @@
+'''
+Interface of the annotation storage, and selection of its implementation.
+
+The storage is chosen with `SODUCO_ANNOTATIONS_BACKEND`:
+- `zip` (default): a ZIP archive per document, see `backend_annotations`;
+- `sqlite`: a SQLite database in WAL mode, see `backend_annotations_sqlite`.
+Whatever the storage, the annotations of a document are exported and imported as a ZIP archive
+of `NNNN.json` files.
+'''
+
+import hashlib
+import os
+from abc import ABC, abstractmethod
+from io import BytesIO
+
+import directory_annotator_storage.backend_annotations as zip_backend
+from directory_annotator_storage.annotation_log import LogCorruptedError
+from directory_annotator_storage.backend_annotations import (
+    AnnotationsNotFoundError, InvalidDocumentNameError, VersionMismatchError)
+from directory_annotator_storage.zip_index import ArchiveCorruptedError
+from directory_annotator_storage.constants_config import ANNOT_PATH, ANNOT_BACKEND, ANNOT_DB_PATH
+
+# Attempts of an update of a view saved concurrently
+_UPDATE_ATTEMPTS = 5
+
+
+class ArchiveExport:
+    '''
+    The exported annotations of a document: `file` is a ZIP archive of `size` bytes, open for
+    reading (binary) and owned by the caller. `etag` identifies its content, and `last_modified`
+    is the timestamp of its last change (or `None` when unknown).
+    '''
+    __slots__ = ("file", "size", "etag", "last_modified")
+
+    def __init__(self, file, size: int, etag: str, last_modified: float = None):
+        self.file = file
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+
+
+class AnnotationBackend(ABC):
+    '''
+    Storage of the annotations of the views of the documents.
+    Documents are identified by their name, with or without extension (e.g. "Didot_1851a.pdf").
+    '''
+
+    @abstractmethod
+    def load(self, document_name: str, view: int):
+        '''
+        Load the annotations of a view of a document.
+        The result may be shared with other callers (cached): it must not be modified.
+
+        Raises:
+            InvalidDocumentNameError: If the document name is badly formed
+            AnnotationsNotFoundError: If there is no annotation for this document/view.
+            ArchiveCorruptedError, LogCorruptedError: If the stored annotations are damaged
+        '''
+
+    def load_deflated(self, document_name: str, view: int):
+        '''
+        Load a view as stored, when it can be sent to the application without being parsed
+        (see `backend_annotations.DeflatedPage`). Returns `None` when not available.
+
+        Raises:
+            InvalidDocumentNameError: If the document name is badly formed
+            AnnotationsNotFoundError: If there is no annotation for this document/view.
+        '''
+        return None
+
+    @abstractmethod
+    def version(self, document_name: str, view: int) -> str:
+        '''
+        Return the version of the annotations of a view (a hash of their stored content),
+        without reading them.
+
+        Raises:
+            InvalidDocumentNameError: If the document name is badly formed
+            AnnotationsNotFoundError: If there is no annotation for this document/view.
+        '''
+
+    @abstractmethod
+    def documents(self) -> list:
+        '''
+        Return the sorted names (without extension) of the documents which have annotations.
+        '''
+
+    @abstractmethod
+    def document_views(self, document_name: str) -> list:
+        '''
+        Return the sorted views of a document which have annotations.
+
+        Raises:
+            InvalidDocumentNameError: If the document name is badly formed
+        '''
+
+    @abstractmethod
+    def save(self, document_name: str, view: int, data, if_match: str = None) -> str:
+        '''
+        Save (create or replace) the annotations of a view of a document, and return their version.
+        With `if_match`, the view is only saved if its current version is `if_match`
+        (or if it exists, for `"*"`).
+
+        Raises:
+            SaveError: When any save-related error is detected.
+            VersionMismatchError: When `if_match` does not match the stored view.
+        '''
+
+    def update(self, document_name: str, view: int, transform, if_match: str = None) -> str:
+        '''
+        Replace the annotations of a view with `transform(annotations)`, and return their version.
+        `transform` must not modify its argument (see `json_patch`). The update is atomic:
+        it is retried (up to `_UPDATE_ATTEMPTS` times) when the view is saved concurrently,
+        unless `if_match` is given.
+
+        Raises:
+            InvalidDocumentNameError: If the document name is badly formed
+            AnnotationsNotFoundError: If there is no annotation for this document/view.
+            SaveError: When any save-related error is detected.
+            VersionMismatchError: When `if_match` does not match the stored view, or the view
+                kept being saved concurrently.
+        '''
+        for _ in range(_UPDATE_ATTEMPTS):
+            # Read before the content: a concurrent save makes the save below fail
+            version = self.version(document_name, view)
+            if if_match is not None and if_match not in ("*", version):
+                raise VersionMismatchError(f"View {view} was modified.")
+            data = transform(self.load(document_name, view))
+            try:
+                return self.save(document_name, view, data, if_match=version)
+            except VersionMismatchError:
+                if if_match is not None:
+                    raise
+        raise VersionMismatchError(f"View {view} is being modified concurrently.")
+
+    def load_many(self, document_name: str, views: list):
+        '''
+        Load the annotations of several views of a document. Yields `(view, annotations, error)`
+        for each view, in order, where `error` is the exception raised by `load` (or `None`).
+        '''
+        for view in views:
+            try:
+                yield view, self.load(document_name, view), None
+            except (InvalidDocumentNameError, AnnotationsNotFoundError, ArchiveCorruptedError,
+                    LogCorruptedError) as err:
+                yield view, None, err
+
+    def save_many(self, document_name: str, pages: dict, expected: dict = None) -> dict:
+        '''
+        Save the annotations of several views of a document (`pages` maps views to annotations),
+        at once when the storage allows it. `expected` maps views to the versions they must have
+        (see `if_match` in `save`). Returns the versions of the saved views.
+
+        Raises:
+            SaveError: When any save-related error is detected.
+            VersionMismatchError: When a version is not the expected one.
+        '''
+        expected = expected or {}
+        return {view: self.save(document_name, view, data, if_match=expected.get(view))
+                for view, data in pages.items()}
+
+    @abstractmethod
+    def export_zip(self, document_name: str) -> BytesIO:
+        '''
+        Return a ZIP archive of all the annotations of a document, or `None` if it has none.
+        '''
+
+    def open_export(self, document_name: str) -> ArchiveExport:
+        '''
+        Return the ZIP archive of all the annotations of a document as an `ArchiveExport`,
+        or `None` if it has none. Backends should avoid holding the archive in memory.
+        '''
+        io_zip = self.export_zip(document_name)
+        if io_zip is None:
+            return None
+        content = io_zip.getbuffer()
+        return ArchiveExport(io_zip, content.nbytes, hashlib.sha256(content).hexdigest())
+
+    @abstractmethod
+    def replace(self, document_name: str, zip_data, merge: bool = False):
+        '''
+        Replace all the annotations of a document with the content of a ZIP archive of views
+        (bytes, or a binary file read in chunks). The archive is checked before anything is
+        replaced. With `merge`, only the views of the archive which changed are replaced,
+        and the other views of the document are kept.
+
+        Raises:
+            InvalidDocumentNameError: If the document name is badly formed
+            InvalidArchiveError: If the archive is not a valid archive of views
+            SaveError: If the annotations cannot be replaced
+        '''
+
+
+class ZipAnnotationBackend(AnnotationBackend):
+    '''
+    Annotations stored as a ZIP archive (and its log) per document, in `annotation_directory`.
+    '''
+    def __init__(self, annotation_directory: str):
+        self.annotation_directory = annotation_directory
+
+    def load(self, document_name: str, view: int):
+        return zip_backend.load_annotations(self.annotation_directory, document_name, view)
+
+    def load_deflated(self, document_name: str, view: int):
+        return zip_backend.load_deflated_annotations(self.annotation_directory, document_name, view)
+
+    def version(self, document_name: str, view: int) -> str:
+        return zip_backend.get_annotations_version(self.annotation_directory, document_name, view)
+
+    def documents(self) -> list:
+        return zip_backend.list_annotated_documents(self.annotation_directory)
+
+    def document_views(self, document_name: str) -> list:
+        return zip_backend.list_annotated_views(self.annotation_directory, document_name)
+
+    def save(self, document_name: str, view: int, data, if_match: str = None) -> str:
+        return zip_backend.save_annotations(self.annotation_directory, document_name, view, data, if_match)
+
+    def save_many(self, document_name: str, pages: dict, expected: dict = None) -> dict:
+        return zip_backend.save_many_annotations(self.annotation_directory, document_name, pages, expected)
+
+    def export_zip(self, document_name: str) -> BytesIO:
+        return zip_backend.get_document_annotations_as_zip_file(self.annotation_directory, document_name)
+
+    def open_export(self, document_name: str) -> ArchiveExport:
+        zip_file = zip_backend.open_document_annotations(self.annotation_directory, document_name)
+        if zip_file is None:
+            return None
+        stat = os.fstat(zip_file.fileno())
+        # The archive is never modified in place: its identity identifies its content
+        etag = hashlib.sha256(f"{stat.st_ino}-{stat.st_mtime_ns}-{stat.st_size}".encode()).hexdigest()
+        return ArchiveExport(zip_file, stat.st_size, etag, stat.st_mtime)
+
+    def replace(self, document_name: str, zip_data, merge: bool = False):
+        zip_backend.replace_document_annotations(self.annotation_directory, document_name, zip_data, merge)
+
+
+def create_annotation_backend(config) -> AnnotationBackend:
+    '''
+    Create the annotation backend selected by the application configuration.
+
+    Raises:
+        ValueError: If the backend name is unknown
+    '''
+    backend_name = config.get(ANNOT_BACKEND, "zip")
+    if backend_name == "zip":
+        return ZipAnnotationBackend(config[ANNOT_PATH])
+    if backend_name == "sqlite":
+        # Avoids loading sqlite3 when not used
+        from directory_annotator_storage.backend_annotations_sqlite import SQLiteAnnotationBackend
+        db_path = config.get(ANNOT_DB_PATH) or os.path.join(config[ANNOT_PATH], "annotations.sqlite3")
+        return SQLiteAnnotationBackend(db_path)
+    raise ValueError(f"Unknown annotation backend '{backend_name}'.")
@@ -0,0 +1,88 @@
+'''
+In-process cache of parsed annotation pages.
+
+Several reviewers often read the same views: keeping the parsed (and filtered) pages avoids
+reading, decompressing, parsing and filtering them again. Each entry carries the version of the
+stored page it was parsed from (e.g. the identity of the archive or of the log record), and is
+only used while this version is current, so that writes from other worker processes are observed.
+The cache is bounded by an approximate memory budget: the size of a page is estimated from the
+size of its serialized form.
+'''
+
+import threading
+from collections import OrderedDict
+
+
+class AnnotationCache:
+    '''
+    LRU cache of parsed pages, keyed by `(document key, view)`, holding at most about `max_bytes`.
+    Cached pages are shared by all callers and must not be modified.
+    '''
+    def __init__(self, max_bytes: int):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (version, data, size), least recently used first
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        '''
+        Return the page cached for `key` if it was parsed from `version`, `None` otherwise.
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, key, version, data, size: int):
+        '''
+        Cache the page `data` of `key`, parsed from `version` and serialized in `size` bytes.
+        '''
+        with self._lock:
+            self._remove(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (version, data, size)
+            self.bytes += size
+            self._shrink()
+
+    def invalidate(self, predicate):
+        '''
+        Drop the entries whose key matches `predicate(key)`.
+        '''
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                self._remove(key)
+
+    def resize(self, max_bytes: int):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._shrink()
+
+    def info(self) -> dict:
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / requests if requests > 0 else 0.0,
+                "size": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def _remove(self, key):
+        # Must be called with the lock held
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def _shrink(self):
+        # Must be called with the lock held
+        while self.bytes > self.max_bytes:
+            self.bytes -= self._entries.popitem(last=False)[1][2]
@@ -0,0 +1,202 @@
+'''
+Append-only log of annotation pages.
+
+Each document has a log next to its ZIP archive, where saved views are appended instead of
+rewriting the archive. The latest record of a view wins over older records and over the archive.
+The log is folded into the archive by compaction (see `backend_annotations`).
+
+The log starts with a file header `magic, generation`: `generation` is random, written when
+the log is created, so that a log is not mistaken for an earlier (compacted) log which had the
+same inode. Then come the records.
+Record layout (little-endian): a header `magic, view, flags, crc32, size, stored_size`
+followed by `stored_size` bytes of payload. `crc32` and `size` describe the uncompressed payload;
+the payload is a raw deflate stream when `FLAG_DEFLATED` is set.
+An incomplete record at the end of the log (interrupted write) is ignored, and removed by the
+next append.
+'''
+
+import os
+import struct
+import threading
+import zlib
+
+_FILE_MAGIC = b"SDLG"
+_FILE_HEADER = struct.Struct("<4s16s")
+_MAGIC = b"SDAL"
+_HEADER = struct.Struct("<4sIHIII")
+
+# Payload is a raw deflate stream
+FLAG_DEFLATED = 0x1
+# Payload is already in the form sent to the application (see `backend_annotations.encode_page`)
+FLAG_NORMALIZED = 0x2
+
+
+class LogCorruptedError(RuntimeError):
+    pass
+
+
+class LogEntry:
+    '''
+    Location of the latest record of a view in a log (identified by `log_id`, see `LogIndex`).
+    '''
+    __slots__ = ("log_id", "offset", "flags", "crc", "size", "stored_size")
+
+    def __init__(self, log_id, offset, flags, crc, size, stored_size):
+        self.log_id = log_id
+        self.offset = offset
+        self.flags = flags
+        self.crc = crc
+        self.size = size
+        self.stored_size = stored_size
+
+
+class LogIndex:
+    '''
+    Index of the records of a log: `entries` maps each view to its latest `LogEntry`.
+    `length` is the size of the valid part of the file (header included), and `log_id`
+    identifies the file: its inode and generation.
+    '''
+    def __init__(self, log_id=None, length=0):
+        self.log_id = log_id
+        self.length = length
+        self.entries = {}
+
+
+def _read_log_id(log_file, stat: os.stat_result):
+    # Return the identity of an open log and the offset of its first record, or `None` while
+    # its header is incomplete
+    log_file.seek(0)
+    header = log_file.read(_FILE_HEADER.size)
+    if len(header) < _FILE_HEADER.size:
+        return None
+    magic, generation = _FILE_HEADER.unpack(header)
+    if magic != _FILE_MAGIC:
+        raise LogCorruptedError("Bad log header.")
+    return (stat.st_ino, generation), _FILE_HEADER.size
+
+
+def _scan(log_file, index: LogIndex, end: int):
+    # Index records from `index.length` up to `end`, stopping at the first incomplete record
+    log_file.seek(index.length)
+    while index.length + _HEADER.size <= end:
+        header = log_file.read(_HEADER.size)
+        magic, view, flags, crc, size, stored_size = _HEADER.unpack(header)
+        if magic != _MAGIC:
+            raise LogCorruptedError(f"Bad record header at offset {index.length}.")
+        record_end = index.length + _HEADER.size + stored_size
+        if record_end > end:
+            break
+        index.entries[view] = LogEntry(index.log_id, index.length + _HEADER.size, flags, crc, size, stored_size)
+        index.length = record_end
+        log_file.seek(record_end)
+
+
+_indexes_lock = threading.Lock()
+_indexes = {}  # path -> LogIndex
+
+
+def read_index(log_path: str) -> LogIndex:
+    '''
+    Return the index of a log, or an empty index if the log does not exist.
+    Indexes are cached per process: only records appended since the last call are read.
+    '''
+    try:
+        log_file = open(log_path, "rb")
+    except FileNotFoundError:
+        with _indexes_lock:
+            _indexes.pop(log_path, None)
+        return LogIndex()
+
+    with log_file:
+        stat = os.fstat(log_file.fileno())
+        identity = _read_log_id(log_file, stat)
+        if identity is None:
+            # Being created, or its creation was interrupted
+            return LogIndex()
+        log_id, start = identity
+        with _indexes_lock:
+            cached = _indexes.get(log_path)
+        if cached is not None and cached.log_id == log_id and cached.length <= stat.st_size:
+            if cached.length + _HEADER.size > stat.st_size:
+                return cached
+            # Copy so that concurrent readers keep a consistent index
+            index = LogIndex(log_id, cached.length)
+            index.entries = dict(cached.entries)
+        else:
+            index = LogIndex(log_id, start)
+        _scan(log_file, index, stat.st_size)
+
+    with _indexes_lock:
+        _indexes[log_path] = index
+    return index
+
+
+def read_stored_record(log_path: str, entry: LogEntry) -> bytes:
+    '''
+    Return the payload of a record as it is stored (deflated if `FLAG_DEFLATED` is set).
+
+    Raises:
+        FileNotFoundError: If the log was removed (e.g. by a compaction) or replaced in the meantime
+    '''
+    with open(log_path, "rb") as log_file:
+        identity = _read_log_id(log_file, os.fstat(log_file.fileno()))
+        if identity is None or identity[0] != entry.log_id:
+            raise FileNotFoundError(f"The log \"{log_path}\" was replaced.")
+        log_file.seek(entry.offset)
+        return log_file.read(entry.stored_size)
+
+
+def read_record(log_path: str, entry: LogEntry) -> bytes:
+    '''
+    Return the uncompressed payload of a record.
+
+    Raises:
+        FileNotFoundError: If the log was removed (e.g. by a compaction) or replaced in the meantime
+        LogCorruptedError: If the payload does not match its checksum
+    '''
+    data = read_stored_record(log_path, entry)
+    if entry.flags & FLAG_DEFLATED:
+        data = zlib.decompress(data, -zlib.MAX_WBITS)
+    if len(data) != entry.size or zlib.crc32(data) != entry.crc:
+        raise LogCorruptedError(f"Bad checksum for the record at offset {entry.offset}.")
+    return data
+
+
+def encode_record(view: int, data: bytes, compress_level: int = None, flags: int = 0) -> bytes:
+    '''
+    Build a record for `data`, deflated if `compress_level` is not `None`.
+    `flags` are stored with the record (`FLAG_DEFLATED` is set as needed).
+    '''
+    payload = data
+    if compress_level is not None:
+        compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        payload = compressor.compress(data) + compressor.flush()
+        flags |= FLAG_DEFLATED
+    return _HEADER.pack(_MAGIC, view, flags, zlib.crc32(data), len(data), len(payload)) + payload
+
+
+def append_records(log_path: str, records: list):
+    '''
+    Append encoded records (see `encode_record`) to a log, and wait until they are on disk.
+    An incomplete record left at the end of the log by an interrupted write is removed first.
+    The log is created (with a new generation) if needed.
+    Must be called with the lock of the document held.
+    '''
+    index = read_index(log_path)
+    with open(log_path, "ab") as log_file:
+        if log_file.tell() != index.length:
+            log_file.truncate(index.length)
+            log_file.seek(index.length)
+        if index.log_id is None:
+            records = [_FILE_HEADER.pack(_FILE_MAGIC, os.urandom(16))] + list(records)
+        log_file.write(b"".join(records))
+        log_file.flush()
+        os.fsync(log_file.fileno())
+
+
+def forget(log_path: str):
+    '''
+    Drop the cached index of a log (to call after removing or replacing it).
+    '''
+    with _indexes_lock:
+        _indexes.pop(log_path, None)
@@ -1,14 +1,61 @@
 from io import BytesIO
 import os
 import json
+import logging
+import re
+import shutil
+import stat
 import tempfile
+import threading
+import time
+import zlib
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from filelock import FileLock
 
 from werkzeug.utils import safe_join
 
+import directory_annotator_storage.annotation_log as alog
+from directory_annotator_storage.annotation_cache import AnnotationCache
+from directory_annotator_storage.constants_config import (
+    DEFAULT_ANNOT_CACHE_SIZE, DEFAULT_ANNOT_COMMIT_WINDOW, DEFAULT_ANNOT_COMPRESSION)
+from directory_annotator_storage.group_commit import GroupCommitter
+from directory_annotator_storage.instrumentation import observe, register_collector, timer
 import directory_annotator_storage.path_utils as pu
+import directory_annotator_storage.zip_index as zindex
+
+# Storage layout
+# =============================================================================================
+# Annotations of a document are stored in a ZIP archive containing files names like `0001.json`,
+# where `0001` is the 0-padded, 4-digits number of the view.
+# Saving a view appends it to a log next to the archive (see `annotation_log`), so that a save
+# costs O(size of the view). Views in the log take precedence over the ones in the archive.
+# The log is folded into the archive by a compaction, which runs in the background when the log
+# grows, and before the archive is exported. The archive itself is never modified in place:
+# it is always replaced atomically, so an open archive is a consistent snapshot.
+# Views are stored as compact JSON, deflated at the level set by `configure_annotation_codec`.
+# Views saved by this version are normalized (see `encode_page`): such log records are flagged,
+# and such archive members carry the `_NORMALIZED_COMMENT` comment, so that their deflated bytes
+# can be sent as they are (see `load_deflated_annotations`).
+
+_NORMALIZED_COMMENT = b"normalized"
+
+# Names of the views in an archive
+_MEMBER_NAME = re.compile(r"^(\d+)\.json$")
+
+# Size of the chunks used to copy uploaded archives
+_COPY_CHUNK_SIZE = 1024 ** 2
+
+# A compaction is scheduled when the log is larger than both thresholds
+_COMPACTION_MIN_BYTES = 4 * 1024 ** 2
+_COMPACTION_RATIO = 0.5
+
+# Mask of the permissions of new files, applied to the archives replaced from temporary files
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+logger = logging.getLogger(__name__)
 
 
 class InvalidDocumentNameError(RuntimeError):
@@ -17,6 +64,38 @@ class InvalidDocumentNameError(RuntimeError):
 class AnnotationsNotFoundError(RuntimeError):
     pass
 
+class InvalidArchiveError(RuntimeError):
+    pass
+
+class VersionMismatchError(RuntimeError):
+    '''
+    The stored version of a view is not the one expected by a conditional save.
+    '''
+
+# Parsed pages, keyed by (archive path, view), see `annotation_cache`
+_cache = AnnotationCache(DEFAULT_ANNOT_CACHE_SIZE)
+
+# Deflate level of the stored views (0: not compressed)
+_compress_level = DEFAULT_ANNOT_COMPRESSION
+
+# Saves of the documents, grouped by archive path
+_committer = GroupCommitter(DEFAULT_ANNOT_COMMIT_WINDOW)
+
+register_collector("annotation_cache", lambda: _cache.info(), ("size", "bytes"), ("hits", "misses"))
+register_collector("group_commit", lambda: _committer.info(), (), ("commits", "writes", "lock_wait"))
+
+
+class DeflatedPage:
+    '''
+    A view as stored: `data` is a raw deflate stream of `size` bytes of JSON, with checksum `crc`.
+    '''
+    __slots__ = ("data", "crc", "size")
+
+    def __init__(self, data: bytes, crc: int, size: int):
+        self.data = data
+        self.crc = crc
+        self.size = size
+
 # Public members
 # =============================================================================================
 
@@ -36,32 +115,71 @@ def load_annotations(annotation_directory: str, document_name: str, view: int) -
 
     Returns:
         dict: Annotations for this particular view of the document. May be empty.
+        They may be shared with other callers (see `annotation_cache`): do not modify them.
     """
-    # Check for bad parameters
-    if not(isinstance(document_name, str)) or len(document_name) == 0:
-        raise InvalidDocumentNameError()
-
     # TODO check for existing document first?
-
-    # Check archive exists
-    zip_name = pu.get_stem_with_extension(document_name, "zip")
-    zip_path = safe_join(annotation_directory, zip_name)
-    if not os.path.exists(zip_path):
-        raise AnnotationsNotFoundError()
+    zip_path, log_path = _checked_storage_paths(annotation_directory, document_name)
 
     json_filename = f"{view:04}.json"
-    annot_data = None
-    with zipfile.ZipFile(zip_path) as zo:
-        if json_filename not in zo.namelist():
-            raise AnnotationsNotFoundError()
-        with zo.open(json_filename) as json_file:
-                annot_data = json.load(json_file)
-                __data_filter_on_load(annot_data)
-                json_file.close()  # FIXME do we need this?
-        zo.close()  # FIXME do we need this?
-
+    json_bytes = None
+    while json_bytes is None:
+        # Read the log first: a compaction replaces the archive before removing the log
+        log_index = alog.read_index(log_path)
+        entry = log_index.entries.get(view)
+        if entry is not None:
+            version = _log_version(entry)
+            cached = _cache.get((zip_path, view), version)
+            if cached is not None:
+                return cached
+            try:
+                json_bytes = alog.read_record(log_path, entry)
+            except FileNotFoundError:
+                continue  # log compacted in the meantime: the archive is up to date
+        else:
+            try:
+                stat = os.stat(zip_path)
+            except FileNotFoundError:
+                raise AnnotationsNotFoundError()
+            version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            cached = _cache.get((zip_path, view), version)
+            if cached is not None:
+                return cached
+            # Seek straight to the member, using the cached central directory of the archive
+            json_bytes = zindex.read_member(zip_path, json_filename)
+            if json_bytes is None:
+                raise AnnotationsNotFoundError()
+
+    annot_data = decode_page(json_bytes)
+    _cache.put((zip_path, view), version, annot_data, len(json_bytes))
     return annot_data
 
+def load_deflated_annotations(annotation_directory: str, document_name: str, view: int) -> DeflatedPage:
+    """
+    Load a view of a document as it is stored, when it can be sent without being parsed:
+    deflated, and normalized when saved. Returns `None` otherwise (use `load_annotations`).
+
+    Raises:
+        InvalidDocumentNameError: If the document name is badly formed
+        AnnotationsNotFoundError: If there is no annotation for this document/view.
+    """
+    zip_path, log_path = _checked_storage_paths(annotation_directory, document_name)
+    while True:
+        entry = alog.read_index(log_path).entries.get(view)
+        if entry is not None:
+            if not (entry.flags & alog.FLAG_DEFLATED and entry.flags & alog.FLAG_NORMALIZED):
+                return None
+            try:
+                return DeflatedPage(alog.read_stored_record(log_path, entry), entry.crc, entry.size)
+            except FileNotFoundError:
+                continue  # log compacted in the meantime: the archive is up to date
+        stored = zindex.read_stored_member(zip_path, f"{view:04}.json")
+        if stored is None:
+            raise AnnotationsNotFoundError()
+        data, member = stored
+        if member.compress_type != zipfile.ZIP_DEFLATED or member.comment != _NORMALIZED_COMMENT:
+            return None
+        return DeflatedPage(data, member.crc, member.file_size)
+
 
 
 class SaveError(RuntimeError):
@@ -72,12 +190,15 @@ class SaveError(RuntimeError):
         super().__init__(msg)
 
 
-def save_annotations(annotation_directory: str, document_name: str, view: int, data: dict):
+def save_annotations(annotation_directory: str, document_name: str, view: int, data: dict,
+                     if_match: str = None) -> str:
     '''
     Tries to save the document in ZIP archive.
     The ZIP archive will contain files names like `0001.json` 
     where `0001` is the 0-padded, 4-digits number of the page.
     Any existing file inside the ZIP archive will be overwrote.
+    The view is appended to the log of the archive first, and moved to the archive
+    by a later compaction (see "Storage layout").
 
     Parameters
     ----------
@@ -90,80 +211,484 @@ def save_annotations(annotation_directory: str, document_name: str, view: int, d
     page_id: (int)
         Number of the page in the document.
 
+    if_match: (str)
+        When defined, only save if the version of the stored view is this one
+        (see `get_annotations_version`), or if the view exists for `"*"`.
+
     Returns
     -------
-    None
+    str: The version of the saved view.
 
     Exceptions
     ----------
     SaveError:
         When any save-related error is detected.
+    VersionMismatchError:
+        When `if_match` does not match the stored view.
     '''
-    
-    def write_json_in_zip(json_data, zip_handle, file_name):
-        json_data = __data_filter_on_save(json_data)
-        json_bytes = json.dumps(json_data, ensure_ascii=False, indent=2)
-        zip_handle.writestr(file_name, json_bytes)
+    expected = {view: if_match} if if_match is not None else {}
+    return save_many_annotations(annotation_directory, document_name, {view: data}, expected)[view]
 
-    filename = safe_join(annotation_directory, pu.get_stem_with_extension(document_name, "zip"))
+def save_many_annotations(annotation_directory: str, document_name: str, pages: dict,
+                          expected: dict = None) -> dict:
+    '''
+    Save several views of a document at once (`pages` maps views to their annotations):
+    the lock of the document is taken once, and the views are appended to the log together.
+    Concurrent saves to the same document are grouped in a single commit (see `group_commit`).
+    `expected` maps views to the versions they must have for the save to happen (see `if_match`
+    in `save_annotations`). Returns the versions of the saved views.
 
-    zipPath = Path(filename)
-    jsonName = f"{view:04}.json"
-    lock = FileLock(filename + ".lock")
-    with lock:
-        if zipPath.exists():
-            if not zipPath.is_file():
-                raise SaveError(f"\"{zipPath}\" is not a file. Cannot save.")
-            if not zipfile.is_zipfile(zipPath):
-                raise SaveError(f"\"{zipPath}\" is not a valid zip file. Cannot save.")
-        # else: we open/append the file and investigate further
-        replace_json = False  # indicates whether replacing the json file is necessary
-        with zipfile.ZipFile(zipPath, 'a') as zipObj:
-            if jsonName in zipObj.namelist():
-                replace_json = True
-            else: # json file does not exist
-                # since the file is open, we can add a new element
-                write_json_in_zip(data, zipObj, jsonName)
-
-        if replace_json:
-            # Hack because we cannot remove/update a file in a ZIP file.
-            opFile, tmpZip = tempfile.mkstemp(dir=os.path.dirname(zipPath))
-            os.close(opFile)
-            with zipfile.ZipFile(tmpZip, 'w') as zipOut:
-                with zipfile.ZipFile(zipPath, 'r') as zipIn:
-                    for f in zipIn.infolist():
-                        if jsonName != f.filename:
-                            data_tmp = zipIn.read(f.filename)
-                            zipOut.writestr(f.filename, data_tmp)
-                write_json_in_zip(data, zipOut, jsonName)
-            os.remove(zipPath)
-            os.rename(tmpZip, zipPath)
+    Raises:
+        SaveError: When any save-related error is detected (then no view is saved).
+        VersionMismatchError: When a version is not the expected one (then no view is saved).
+    '''
+    filename, log_path = _storage_paths(annotation_directory, document_name)
+    if filename is None:
+        raise SaveError(f"Invalid document name \"{document_name}\". Cannot save.")
+
+    # Encoded by each writer: the commit, serialized, only writes
+    save = _Save({view: encode_page(data) for view, data in pages.items()}, expected or {})
+    versions = _committer.submit(filename, save, _commit_saves)
+    # Write-through: the next read of these views does not need to parse them again
+    for view, version in versions.items():
+        json_bytes = save.pages[view]
+        _cache.put((filename, view), version, decode_page(json_bytes), len(json_bytes))
+    _schedule_compaction(filename, log_path)
+    return {view: content_version(json_bytes) for view, json_bytes in save.pages.items()}
+
+def get_annotations_version(annotation_directory: str, document_name: str, view: int) -> str:
+    '''
+    Return the version of a view of a document, without reading it: a hash of its content.
+
+    Raises:
+        InvalidDocumentNameError: If the document name is badly formed
+        AnnotationsNotFoundError: If there is no annotation for this document/view.
+    '''
+    zip_path, log_path = _checked_storage_paths(annotation_directory, document_name)
+    version = _stored_etag(zip_path, alog.read_index(log_path), view)
+    if version is None:
+        raise AnnotationsNotFoundError()
+    return version
+
+def list_annotated_views(annotation_directory: str, document_name: str) -> list:
+    '''
+    Return the sorted views of a document which have annotations.
+
+    Raises:
+        InvalidDocumentNameError: If the document name is badly formed
+    '''
+    zip_path, log_path = _checked_storage_paths(annotation_directory, document_name)
+    views = set(alog.read_index(log_path).entries)
+    for name in zindex.member_names(zip_path):
+        match = _MEMBER_NAME.match(name)
+        if match is not None:
+            views.add(int(match.group(1)))
+    return sorted(views)
+
+def list_annotated_documents(annotation_directory: str) -> list:
+    '''
+    Return the sorted names (without extension) of the documents which have annotations.
+    '''
+    path = Path(annotation_directory)
+    stems = set(p.stem for p in path.glob("*.zip"))
+    stems.update(Path(p.stem).stem for p in path.glob("*.zip.log"))
+    return sorted(stems)
+
+def compact_annotations(annotation_directory: str, document_name: str):
+    '''
+    Fold the log of saved views of a document into its ZIP archive.
+    '''
+    zip_path, log_path = _storage_paths(annotation_directory, document_name)
+    with FileLock(zip_path + ".lock"):
+        _compact(zip_path, log_path)
+
+def open_document_annotations(annotation_directory: str, document_name: str):
+    '''
+    Return the ZIP archive of all the annotations of a document, open for reading (binary),
+    or `None` if it does not exist. The log is compacted first.
+    The file is a consistent snapshot: later saves or replacements do not change it.
+    '''
+    filename, log_path = _storage_paths(annotation_directory, document_name)
+    with FileLock(filename + ".lock"):
+        _compact(filename, log_path)
+        try:
+            # The archive is only ever replaced, so this descriptor keeps the current version
+            return open(filename, 'rb')
+        except FileNotFoundError:
+            return None
 
 def get_document_annotations_as_zip_file(annotation_directory: str, document_name: str) -> BytesIO: # | None
-    filename = safe_join(annotation_directory, pu.get_stem_with_extension(document_name, "zip"))
     io_zip = None
-    if os.path.exists(filename):
-        with open(filename, 'rb') as fh:
+    fh = open_document_annotations(annotation_directory, document_name)
+    if fh is not None:
+        with fh:
             io_zip = BytesIO(fh.read())
             io_zip.seek(0)  # be friendly, rewind
     return io_zip
 
-# TODO add options to merge (with or without replacement)
-def replace_document_annotations(annotation_directory: str, document_name: str, zip_data: bytes) -> None:
-    filename = safe_join(annotation_directory, pu.get_stem_with_extension(document_name, "zip"))
-    lock = FileLock(filename + ".lock")
-    with lock:
-        with open(filename, 'wb') as out_file:
-            out_file.write(BytesIO(zip_data).getbuffer())
+def replace_document_annotations(annotation_directory: str, document_name: str, zip_data,
+                                 merge: bool = False) -> None:
+    '''
+    Replace the annotations of a document with the content of a ZIP archive.
+
+    Args:
+        zip_data (bytes | file): The archive, or a binary file to read it from (read in chunks)
+        merge (bool): Only replace the views of the archive which changed, keeping the others
+
+    Raises:
+        InvalidDocumentNameError: If the document name is badly formed
+        InvalidArchiveError: If the archive is not a valid archive of views
+    '''
+    filename, log_path = _storage_paths(annotation_directory, document_name)
+    if filename is None:
+        raise InvalidDocumentNameError()
+    if isinstance(zip_data, (bytes, bytearray)):
+        zip_data = BytesIO(zip_data)
+
+    # The upload is written and checked next to the archive, before taking the lock
+    opFile, tmpZip = tempfile.mkstemp(dir=os.path.dirname(filename))
+    try:
+        with os.fdopen(opFile, 'wb') as out_file:
+            shutil.copyfileobj(zip_data, out_file, _COPY_CHUNK_SIZE)
+            out_file.flush()
+            os.fsync(out_file.fileno())
+        members = check_annotations_archive(tmpZip)
+        with FileLock(filename + ".lock"):
+            if merge:
+                _merge(annotation_directory, document_name, tmpZip, members)
+            else:
+                _copy_mode(tmpZip, filename)
+                os.replace(tmpZip, filename)
+                zindex.forget(filename)
+                _remove_log(log_path)
+    finally:
+        if os.path.exists(tmpZip):
+            os.remove(tmpZip)
+    _cache.invalidate(lambda key: key[0] == filename)
+    if merge:
+        _schedule_compaction(filename, log_path)
+
+def check_annotations_archive(zip_file) -> dict:
+    '''
+    Check that an archive (path or binary file) only contains views (`NNNN.json` members holding
+    JSON), and return the names of its members by view.
+
+    Raises:
+        InvalidArchiveError: If the archive is truncated, corrupted, or contains other files
+    '''
+    members = {}
+    try:
+        with zipfile.ZipFile(zip_file) as zipIn:
+            for name in zipIn.namelist():
+                match = _MEMBER_NAME.match(name)
+                if match is None or name != f"{int(match.group(1)):04}.json":
+                    raise InvalidArchiveError(f"Unexpected file \"{name}\" in the archive.")
+                # Reading checks the CRC of the member
+                json.loads(zipIn.read(name))
+                members[int(match.group(1))] = name
+    except (zipfile.BadZipFile, zipfile.LargeZipFile, EOFError, NotImplementedError, OSError) as err:
+        raise InvalidArchiveError(f"Invalid ZIP archive: {err}")
+    except ValueError as err:
+        raise InvalidArchiveError(f"Invalid JSON in the archive: {err}")
+    return members
+
+
+def configure_annotation_codec(compress_level: int):
+    '''
+    Set the deflate level (0 to 9) of the views saved from now on (0 stores them uncompressed).
+    '''
+    global _compress_level
+    _compress_level = min(9, max(0, int(compress_level)))
+
+def configure_group_commit(window: float):
+    '''
+    Set the time, in seconds, a save waits for concurrent saves of the same document,
+    to commit them together (0: only group the saves arriving during a commit).
+    '''
+    _committer.window = max(0.0, float(window))
+
+def group_commit_info() -> dict:
+    '''
+    Return the statistics of the grouped saves of this process (see `GroupCommitter.info`).
+    '''
+    return _committer.info()
+
+def configure_annotation_cache(max_bytes: int):
+    '''
+    Set the approximate memory budget, in bytes, of the parsed pages cached by this process
+    (0 disables the cache).
+    '''
+    _cache.resize(max(0, int(max_bytes)))
+
+def annotation_cache_info() -> dict:
+    '''
+    Return the statistics of the parsed page cache of this process:
+    `hits`, `misses`, `hit_ratio`, number of pages (`size`), `bytes` and `max_bytes`.
+    '''
+    return _cache.info()
+
+
+def encode_page(json_data) -> bytes:
+    '''
+    Serialize the annotations of a view as they are stored: normalized, so that they can be sent
+    to the application without being filtered again, as compact JSON.
+    '''
+    with timer("annotation_encode"):
+        json_data = __data_filter_on_save(json_data)
+        return json.dumps(json_data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def content_version(json_bytes: bytes) -> str:
+    '''
+    Return the version of a view from its stored content (see `get_annotations_version`).
+    '''
+    return _etag(zlib.crc32(json_bytes), len(json_bytes))
+
+def decode_page(json_bytes: bytes):
+    '''
+    Deserialize the annotations of a view, as they are sent to the application.
+    '''
+    with timer("annotation_decode"):
+        annot_data = json.loads(json_bytes)
+        __data_filter_on_load(annot_data)
+    return annot_data
+
+def normalize_page(json_data):
+    '''
+    Return the annotations of a view as they are loaded once saved (see `encode_page` and
+    `decode_page`), without serializing them. `json_data` is not modified.
+    '''
+    return __data_filter_on_save(json_data)
 
 
 # Internal definitions
 # =============================================================================================
 
+def _storage_paths(annotation_directory: str, document_name: str):
+    '''
+    Return the paths to the archive and to the log of a document (`None` for a bad name).
+    '''
+    zip_path = safe_join(annotation_directory, pu.get_stem_with_extension(document_name, "zip"))
+    if zip_path is None:
+        return None, None
+    return zip_path, zip_path + ".log"
+
+def _checked_storage_paths(annotation_directory: str, document_name: str):
+    '''
+    Return the paths to the archive and to the log of a document.
+
+    Raises:
+        InvalidDocumentNameError: If the document name is badly formed
+    '''
+    if not(isinstance(document_name, str)) or len(document_name) == 0:
+        raise InvalidDocumentNameError()
+    zip_path, log_path = _storage_paths(annotation_directory, document_name)
+    if zip_path is None:
+        raise InvalidDocumentNameError()
+    return zip_path, log_path
+
+def _log_version(entry: alog.LogEntry) -> tuple:
+    '''
+    Identify a record of a log, for the parsed page cache.
+    '''
+    return (entry.log_id, entry.offset, entry.crc, entry.size)
+
+def _copy_mode(tmp_path: str, path: str):
+    '''
+    Give a temporary file (created with mode 0600) the mode of the file it replaces, or the mode
+    of a new file if there is none.
+    '''
+    try:
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        mode = 0o666 & ~_UMASK
+    os.chmod(tmp_path, mode)
+
+def _remove_log(log_path: str):
+    try:
+        os.remove(log_path)
+    except FileNotFoundError:
+        pass
+    alog.forget(log_path)
+
+def _compact(zip_path: str, log_path: str):
+    '''
+    Rewrite the archive with the views of the log, then remove the log.
+    Must be called with the lock of the document held.
+    '''
+    index = alog.read_index(log_path)
+    if len(index.entries) == 0:
+        _remove_log(log_path)
+        return
+
+    start = time.perf_counter()
+    names_in_log = set(f"{view:04}.json" for view in index.entries)
+    compress_type = zipfile.ZIP_DEFLATED if _compress_level > 0 else zipfile.ZIP_STORED
+    opFile, tmpZip = tempfile.mkstemp(dir=os.path.dirname(zip_path))
+    os.close(opFile)
+    try:
+        with zipfile.ZipFile(tmpZip, 'w', compress_type, compresslevel=_compress_level or None) as zipOut:
+            if os.path.exists(zip_path):
+                with zipfile.ZipFile(zip_path, 'r') as zipIn:
+                    for f in zipIn.infolist():
+                        if f.filename not in names_in_log:
+                            # Members are recompressed with the current codec
+                            f.compress_type = compress_type
+                            zipOut.writestr(f, zipIn.read(f.filename), compresslevel=_compress_level or None)
+            for view, entry in sorted(index.entries.items()):
+                member = zipfile.ZipInfo(f"{view:04}.json", time.localtime(time.time())[:6])
+                member.compress_type = compress_type
+                member.external_attr = 0o600 << 16
+                if entry.flags & alog.FLAG_NORMALIZED:
+                    member.comment = _NORMALIZED_COMMENT
+                zipOut.writestr(member, alog.read_record(log_path, entry), compresslevel=_compress_level or None)
+        archive_size = os.path.getsize(tmpZip)
+        _copy_mode(tmpZip, zip_path)
+        # Order matters for readers: the archive must be up to date before the log disappears
+        os.replace(tmpZip, zip_path)
+        zindex.forget(zip_path)
+    except BaseException:
+        os.remove(tmpZip)
+        raise
+    _remove_log(log_path)
+    observe("soduco_stage_duration_seconds", time.perf_counter() - start, stage="annotation_compaction")
+    observe("soduco_annotation_write_bytes", archive_size, kind="compaction")
+
+def _merge(annotation_directory: str, document_name: str, zip_path: str, members: dict):
+    '''
+    Append the views of the archive `zip_path` which differ from the stored ones to the log.
+    Must be called with the lock of the document held.
+    '''
+    _, log_path = _storage_paths(annotation_directory, document_name)
+    records = []
+    with zipfile.ZipFile(zip_path) as zipIn:
+        for view, name in sorted(members.items()):
+            page = decode_page(zipIn.read(name))
+            try:
+                if load_annotations(annotation_directory, document_name, view) == page:
+                    continue
+            except AnnotationsNotFoundError:
+                pass
+            records.append(alog.encode_record(view, encode_page(page), _compress_level or None, alog.FLAG_NORMALIZED))
+    if len(records) > 0:
+        alog.append_records(log_path, records)
+
+class _Save:
+    '''
+    A save waiting to be committed: `pages` maps views to their encoded content, and `expected`
+    maps views to their expected versions.
+    '''
+    __slots__ = ("pages", "expected", "records")
+
+    def __init__(self, pages: dict, expected: dict):
+        self.pages = pages
+        self.expected = expected
+        self.records = [alog.encode_record(view, json_bytes, _compress_level or None, alog.FLAG_NORMALIZED)
+                        for view, json_bytes in pages.items()]
+
+def _etag(crc: int, size: int) -> str:
+    # Also computed by `content_version`
+    return f"{crc:08x}-{size:x}"
+
+def _stored_etag(zip_path: str, log_index: alog.LogIndex, view: int) -> str:
+    '''
+    Return the version of a stored view (see `get_annotations_version`), or `None` if it does not exist.
+    '''
+    entry = log_index.entries.get(view)
+    if entry is not None:
+        return _etag(entry.crc, entry.size)
+    member = zindex.member_info(zip_path, f"{view:04}.json")
+    if member is not None:
+        return _etag(member.crc, member.file_size)
+    return None
+
+def _commit_saves(zip_path: str, saves: list):
+    '''
+    Append the views of several `_Save` to the log at once. Returns, for each save, the cache
+    versions of the views it wrote (except the views which a later save of the batch overwrote),
+    or a `VersionMismatchError`; and the time spent waiting for the lock.
+    '''
+    zipPath = Path(zip_path)
+    log_path = zip_path + ".log"
+    start = time.monotonic()
+    with FileLock(zip_path + ".lock"):
+        lock_wait = time.monotonic() - start
+        observe("soduco_lock_wait_seconds", lock_wait)
+        if zipPath.exists():
+            if not zipPath.is_file():
+                raise SaveError(f"\"{zipPath}\" is not a file. Cannot save.")
+            if not zipfile.is_zipfile(zipPath):
+                raise SaveError(f"\"{zipPath}\" is not a valid zip file. Cannot save.")
+        try:
+            log_index = alog.read_index(log_path)
+            # Versions of the views written by the previous saves of the batch
+            written = {}
+            accepted = []
+            for save in saves:
+                for view, expected in save.expected.items():
+                    current = written[view] if view in written else _stored_etag(zip_path, log_index, view)
+                    if current is None or (expected != "*" and expected != current):
+                        break
+                else:
+                    accepted.append(save)
+                    for view, json_bytes in save.pages.items():
+                        written[view] = content_version(json_bytes)
+            if len(accepted) > 0:
+                records = [record for save in accepted for record in save.records]
+                with timer("annotation_append"):
+                    alog.append_records(log_path, records)
+                observe("soduco_annotation_write_bytes", sum(len(record) for record in records), kind="append")
+                log_index = alog.read_index(log_path)
+        except (OSError, alog.LogCorruptedError) as err:
+            raise SaveError(f"Cannot append to \"{log_path}\": {err}")
+
+    last_saves = {view: save for save in accepted for view in save.pages}
+    results = []
+    for save in saves:
+        if save in accepted:
+            results.append({view: _log_version(log_index.entries[view])
+                            for view in save.pages if last_saves[view] is save})
+        else:
+            results.append(VersionMismatchError(f"Views {sorted(save.expected)} were modified."))
+    return results, lock_wait
+
+_compactor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="compaction")
+_compactions_lock = threading.Lock()
+_compactions_pending = set()
+
+def _schedule_compaction(zip_path: str, log_path: str):
+    '''
+    Compact the archive in the background if its log became large.
+    '''
+    try:
+        log_size = os.path.getsize(log_path)
+        zip_size = os.path.getsize(zip_path) if os.path.exists(zip_path) else 0
+    except FileNotFoundError:
+        return
+    if log_size < _COMPACTION_MIN_BYTES or log_size < _COMPACTION_RATIO * zip_size:
+        return
+    with _compactions_lock:
+        if zip_path in _compactions_pending:
+            return
+        _compactions_pending.add(zip_path)
+    _compactor.submit(_background_compaction, zip_path, log_path)
+
+def _background_compaction(zip_path: str, log_path: str):
+    try:
+        with FileLock(zip_path + ".lock"):
+            _compact(zip_path, log_path)
+    except Exception:
+        logger.exception("Compaction of \"%s\" failed.", zip_path)
+    finally:
+        with _compactions_lock:
+            _compactions_pending.discard(zip_path)
+
 def __data_filter_on_load(json_data):
     '''
     Transform annotation data after loading and before it is sent to the application.
+    Views saved by this version are already normalized (see `__data_filter_on_save`).
     '''
+    if not isinstance(json_data, list):
+        return
     for x in json_data:
         if "type" in x and x["type"] in ["ENTRY", "TITLE_LEVEL_1", "TITLE_LEVEL_2"]:
             if x.get("origin") is None:
@@ -173,8 +698,11 @@ def __data_filter_on_load(json_data):
 
 def __data_filter_on_save(doc_content):
     '''
-    Transform annotation data before saving.
+    Transform annotation data before saving: apply the defaults of `__data_filter_on_load`,
+    so that the stored view can be sent as it is.
     '''
+    if not isinstance(doc_content, list):
+        return doc_content
+    doc_content = [dict(x) if isinstance(x, dict) else x for x in doc_content]
+    __data_filter_on_load(doc_content)
     return doc_content
-
-
@@ -0,0 +1,189 @@
+'''
+Annotations stored in a SQLite database, with one row per (document, view).
+
+The database runs in WAL mode: readers never block, and each save is a single upsert statement,
+so that worker processes do not serialize on a per-document lock.
+'''
+
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import zipfile
+from io import BytesIO
+
+from directory_annotator_storage.annotation_backend import AnnotationBackend, ArchiveExport
+from directory_annotator_storage.backend_annotations import (
+    AnnotationsNotFoundError, InvalidDocumentNameError, SaveError, VersionMismatchError, check_annotations_archive,
+    content_version, decode_page, encode_page)
+from directory_annotator_storage.instrumentation import observe, timer
+import directory_annotator_storage.path_utils as pu
+
+# Size of the chunks used to copy uploaded archives
+_COPY_CHUNK_SIZE = 1024 ** 2
+
+# A rowid table: views are too large to be stored in the B-tree of the key (`WITHOUT ROWID`)
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS annotations (
+    document TEXT NOT NULL,
+    view INTEGER NOT NULL,
+    content BLOB NOT NULL,
+    etag TEXT NOT NULL,
+    UNIQUE (document, view)
+);
+"""
+
+_UPSERT = "INSERT OR REPLACE INTO annotations (document, view, content, etag) VALUES (?, ?, ?, ?)"
+
+
+class SQLiteAnnotationBackend(AnnotationBackend):
+    '''
+    Annotations stored in the SQLite database `db_path` (created if needed).
+    '''
+    def __init__(self, db_path: str, timeout: float = 30):
+        self.db_path = db_path
+        self.timeout = timeout
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.executescript(_SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        # One connection per thread, and per process (connections must not cross a fork)
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.db_path, timeout=self.timeout)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    @staticmethod
+    def _document_key(document_name: str) -> str:
+        if not isinstance(document_name, str) or len(pu.get_stem(document_name)) == 0:
+            raise InvalidDocumentNameError()
+        return pu.get_stem(document_name)
+
+    def load(self, document_name: str, view: int):
+        row = self._connection().execute(
+            "SELECT content FROM annotations WHERE document = ? AND view = ?",
+            (self._document_key(document_name), view)).fetchone()
+        if row is None:
+            raise AnnotationsNotFoundError()
+        return decode_page(row[0])
+
+    def version(self, document_name: str, view: int) -> str:
+        row = self._connection().execute(
+            "SELECT etag FROM annotations WHERE document = ? AND view = ?",
+            (self._document_key(document_name), view)).fetchone()
+        if row is None:
+            raise AnnotationsNotFoundError()
+        return row[0]
+
+    def documents(self) -> list:
+        rows = self._connection().execute("SELECT DISTINCT document FROM annotations ORDER BY document")
+        return [row[0] for row in rows]
+
+    def document_views(self, document_name: str) -> list:
+        rows = self._connection().execute(
+            "SELECT view FROM annotations WHERE document = ? ORDER BY view",
+            (self._document_key(document_name),))
+        return [row[0] for row in rows]
+
+    def save(self, document_name: str, view: int, data, if_match: str = None) -> str:
+        expected = {view: if_match} if if_match is not None else {}
+        return self._save(document_name, {view: data}, expected)[view]
+
+    def save_many(self, document_name: str, pages: dict, expected: dict = None) -> dict:
+        return self._save(document_name, pages, expected or {})
+
+    def _save(self, document_name: str, pages: dict, expected: dict) -> dict:
+        try:
+            document = self._document_key(document_name)
+        except InvalidDocumentNameError:
+            raise SaveError(f"Invalid document name \"{document_name}\". Cannot save.")
+        rows = []
+        for view, data in pages.items():
+            content = encode_page(data)
+            rows.append((document, view, content, content_version(content)))
+        try:
+            with timer("sqlite_commit"), self._connection() as connection:
+                if len(expected) > 0:
+                    # Write lock taken before checking the versions
+                    connection.execute("BEGIN IMMEDIATE")
+                    for view, version in expected.items():
+                        try:
+                            current = self.version(document_name, view)
+                        except AnnotationsNotFoundError:
+                            current = None
+                        if current is None or (version != "*" and version != current):
+                            raise VersionMismatchError(f"View {view} was modified.")
+                connection.executemany(_UPSERT, rows)
+        except sqlite3.Error as err:
+            raise SaveError(f"Cannot save views {sorted(pages)} of \"{document_name}\": {err}")
+        observe("soduco_annotation_write_bytes", sum(len(content) for _, _, content, _ in rows), kind="upsert")
+        return {view: etag for _, view, _, etag in rows}
+
+    def export_zip(self, document_name: str) -> BytesIO:
+        rows = self._connection().execute(
+            "SELECT view, content FROM annotations WHERE document = ? ORDER BY view",
+            (self._document_key(document_name),)).fetchall()
+        if len(rows) == 0:
+            return None
+        io_zip = BytesIO()
+        with zipfile.ZipFile(io_zip, 'w') as zipOut:
+            for view, content in rows:
+                zipOut.writestr(f"{view:04}.json", content)
+        io_zip.seek(0)
+        return io_zip
+
+    def open_export(self, document_name: str) -> ArchiveExport:
+        rows = self._connection().execute(
+            "SELECT view, content FROM annotations WHERE document = ? ORDER BY view",
+            (self._document_key(document_name),))
+        # Spooled to a temporary file (rows are read one by one), hashed on the way
+        digest = hashlib.sha256()
+        zip_file = tempfile.TemporaryFile()
+        with zipfile.ZipFile(zip_file, 'w') as zipOut:
+            for view, content in rows:
+                digest.update(f"{view}:{len(content)}:".encode())
+                digest.update(content)
+                zipOut.writestr(f"{view:04}.json", content)
+        zip_file.flush()
+        size = os.fstat(zip_file.fileno()).st_size
+        if len(zipOut.infolist()) == 0:
+            zip_file.close()
+            return None
+        zip_file.seek(0)
+        return ArchiveExport(zip_file, size, digest.hexdigest())
+
+    def replace(self, document_name: str, zip_data, merge: bool = False):
+        document = self._document_key(document_name)
+        if isinstance(zip_data, (bytes, bytearray)):
+            zip_data = BytesIO(zip_data)
+        with tempfile.TemporaryFile() as zip_file:
+            shutil.copyfileobj(zip_data, zip_file, _COPY_CHUNK_SIZE)
+            members = check_annotations_archive(zip_file)
+            try:
+                self._replace(document, zip_file, members, merge)
+            except sqlite3.Error as err:
+                raise SaveError(f"Cannot replace the annotations of \"{document_name}\": {err}")
+
+    def _replace(self, document: str, zip_file, members: dict, merge: bool):
+        with zipfile.ZipFile(zip_file) as zipIn:
+            # Single transaction: readers see either all the old views or all the new ones
+            with self._connection() as connection:
+                if not merge:
+                    connection.execute("DELETE FROM annotations WHERE document = ?", (document,))
+                for view, name in sorted(members.items()):
+                    content = zipIn.read(name)
+                    if merge:
+                        content = encode_page(decode_page(content))
+                        row = connection.execute(
+                            "SELECT content FROM annotations WHERE document = ? AND view = ?",
+                            (document, view)).fetchone()
+                        if row is not None and row[0] == content:
+                            continue
+                    connection.execute(_UPSERT, (document, view, content, content_version(content)))
@@ -1,11 +1,19 @@
 import glob
 import os
-from pikepdf import Pdf, PdfImage
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from PIL import Image
+from pikepdf import Pdf, PdfError, PdfImage
 
 from io import BytesIO
 
 from werkzeug.utils import safe_join
 
+from directory_annotator_storage.constants_config import DEFAULT_PDF_CACHE_SIZE
+from directory_annotator_storage.instrumentation import increment, register_collector, timer
+from directory_annotator_storage.rasterizer import RasterizationError, rasterize_page, render_size
+
 
 def document_list(documents_dir: str) -> list:
     list_doc = sorted(glob.glob(os.path.join(documents_dir, '*.pdf')))
@@ -21,60 +29,275 @@ class DocumentNotFoundError(RuntimeError):
 class InvalidViewIndexError(RuntimeError):
     pass
 
+
+# Cache of open PDF files
+# =============================================================================================
+
+class _PdfCacheEntry:
+    def __init__(self, key):
+        self.key = key
+        self.lock = threading.Lock()
+        self.pdf = None
+        self.evicted = False
+
+    def close(self):
+        with self.lock:
+            self.evicted = True
+            if self.pdf is not None:
+                self.pdf.close()
+                self.pdf = None
+
+
+class _PdfCache:
+    '''
+    Bounded LRU cache of open `pikepdf.Pdf` handles, shared by the threads of a worker process.
+
+    Entries are keyed by path, modification time and size, so a document replaced on disk is
+    reopened. A handle is used by one thread at a time (qpdf objects are not thread-safe), and
+    evicted handles are closed as soon as the thread using them releases them.
+    '''
+    def __init__(self, max_size: int):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # path -> _PdfCacheEntry, least recently used first
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    @contextmanager
+    def open(self, path: str):
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        evicted = []
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry.key == key:
+                self._entries.move_to_end(path)
+                self.hits += 1
+            else:
+                if entry is not None:
+                    evicted.append(self._entries.pop(path))
+                entry = _PdfCacheEntry(key)
+                self.misses += 1
+                self._entries[path] = entry
+                while len(self._entries) > self.max_size:
+                    evicted.append(self._entries.popitem(last=False)[1])
+        for old_entry in evicted:
+            if old_entry is not entry:
+                old_entry.close()
+
+        with entry.lock:
+            if entry.pdf is None:
+                with timer("pdf_open"):
+                    entry.pdf = Pdf.open(path)
+            try:
+                yield entry.pdf
+            finally:
+                # Evicted while we were using it (or cache disabled): nobody else will close it
+                if entry.evicted or entry in evicted:
+                    entry.pdf.close()
+                    entry.pdf = None
+                    entry.evicted = True
+
+    def resize(self, max_size: int):
+        with self._lock:
+            self.max_size = max_size
+            evicted = []
+            while len(self._entries) > self.max_size:
+                evicted.append(self._entries.popitem(last=False)[1])
+        for entry in evicted:
+            entry.close()
+
+    def info(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+                "max_size": self.max_size,
+            }
+
+
+_pdf_cache = _PdfCache(DEFAULT_PDF_CACHE_SIZE)
+register_collector("pdf_cache", lambda: _pdf_cache.info(), ("size",), ("hits", "misses"))
+
+
+def configure_pdf_cache(max_open_files: int):
+    '''
+    Set the maximum number of PDF files kept open by this process (0 disables the cache).
+    Extra handles are closed immediately.
+    '''
+    _pdf_cache.resize(max(0, int(max_open_files)))
+
+
+def pdf_cache_info() -> dict:
+    '''
+    Return the statistics of the open PDF cache of this process:
+    `hits`, `misses`, current `size` and `max_size`.
+    '''
+    return _pdf_cache.info()
+
+
+# Documents access
+# =============================================================================================
+
+def get_document_stat(documents_dir: str, document_name: str) -> os.stat_result:
+    '''
+    Return the state (size, modification time...) of a document file.
+
+    Raises:
+        DocumentNotFoundError: If the document does not exist
+    '''
+    document_path = safe_join(documents_dir, document_name)
+    if document_path is None:
+        raise DocumentNotFoundError()
+    try:
+        return os.stat(document_path)
+    except FileNotFoundError:
+        raise DocumentNotFoundError()
+
 def get_document_pages(documents_dir: str, document_name: str) -> int:
     document_path = safe_join(documents_dir, document_name)
     if not os.path.exists(document_path):
         raise DocumentNotFoundError()
 
     try:
-        pdf_file = Pdf.open(document_path)
-        pages = len(pdf_file.pages)
-        return pages
-    except RuntimeError:
+        with _pdf_cache.open(document_path) as pdf_file:
+            return len(pdf_file.pages)
+    except (RuntimeError, PdfError):
         raise DocumentReadError()
 
+# The minimal size of an image covering a whole pdf page
+_MIN_WIDTH, _MIN_HEIGHT = (512, 512)
+
+# Image filters which can be sent as-is, with the matching MIME type
+_PASSTHROUGH_FILTERS = {
+    "/DCTDecode": "image/jpeg",
+    "/JPXDecode": "image/jp2",
+}
+
+def _whole_page_images(page) -> list:
+    return [
+        image for image in (PdfImage(page.images[image_id]) for image_id in page.images)
+        if image.width > _MIN_WIDTH and image.height > _MIN_HEIGHT
+    ]
+
 def _need_rasterization(page) -> bool:
-    # The minimal size of a pdf page
-    MIN_WIDTH, MIN_HEIGHT = (512, 512)
+    return len(_whole_page_images(page)) != 1
 
-    nb_whole_page_image = 0
-    for image_id in page.images:
-        image = PdfImage(page.images[image_id])
-        if (image.width > MIN_WIDTH and image.height > MIN_HEIGHT):
-            nb_whole_page_image += 1
+def get_page_image_size(page, raster_dpi: int) -> list:
+    '''
+    Return the `[width, height]` of the image served for a PDF page: the size of its whole-page
+    image, or the size of the page rendered at `raster_dpi` if it must be rasterized.
+    '''
+    page_images = _whole_page_images(page)
+    if len(page_images) == 1:
+        return [page_images[0].width, page_images[0].height]
+    return list(render_size(page.mediabox, raster_dpi))
 
-    return nb_whole_page_image != 1
+def _passthrough_type(pdf_image: PdfImage):
+    '''
+    Return the MIME type of the raw stream of `pdf_image` if it is a complete image file that
+    browsers display like the PDF does, or `None` if the image must be decoded.
+    '''
+    if len(pdf_image.filters) != 1 or pdf_image.filters[0] not in _PASSTHROUGH_FILTERS:
+        return None
+    # Masks and decode arrays are applied by PDF readers only
+    if pdf_image.obj.get("/SMask") is not None or pdf_image.obj.get("/Mask") is not None:
+        return None
+    if pdf_image.obj.get("/Decode") is not None:
+        return None
+    mimetype = _PASSTHROUGH_FILTERS[pdf_image.filters[0]]
+    # JPEG streams in CMYK (or other exotic) colorspaces are rendered inconsistently
+    if mimetype == "image/jpeg" and pdf_image.mode not in ("L", "RGB"):
+        return None
+    return mimetype
 
-def get_image_from_view(documents_dir: str, document_name: str, view: int) -> bytes:
+@contextmanager
+def _open_view_image(documents_dir: str, document_name: str, view: int):
+    # Yields `(pdf_image, page_box)` for a view while its PDF file is held open, where
+    # `pdf_image` is the whole-page `PdfImage`, or `None` if the page must be rasterized.
     # IMPORTANT: views are 1-indexed in parameter, and translated to 0-indexing here
     document_path = safe_join(documents_dir, document_name)
-    if not os.path.exists(document_path):
+    if document_path is None or not os.path.exists(document_path):
         raise DocumentNotFoundError()
 
-    image_data = None
     try:
-        pdf_file = Pdf.open(document_path)
-        num_pages = len(pdf_file.pages)
-        if not 1 <= view <= num_pages:
-            raise InvalidViewIndexError()
-        page = pdf_file.pages[view - 1]
-
-        if (_need_rasterization(page)):
-            raise NotImplementedError # TODO
-
-        for image in page.images:
-            pdf_image = PdfImage(page.images[image])
-            pil_image = pdf_image.as_pil_image()
-
-            img_byte_arr = BytesIO()
-            pil_image.save(img_byte_arr, format='PNG')
-            image_data = img_byte_arr.getvalue()
-            break
+        with _pdf_cache.open(document_path) as pdf_file:
+            num_pages = len(pdf_file.pages)
+            if not 1 <= view <= num_pages:
+                raise InvalidViewIndexError()
+            page = pdf_file.pages[view - 1]
+            page_box = [float(v) for v in page.mediabox]
+
+            page_images = _whole_page_images(page)
+            if len(page_images) != 1:
+                yield None, page_box
+            else:
+                yield page_images[0], page_box
     except InvalidViewIndexError:
         raise
-    except NotImplementedError:
-        raise
-    except RuntimeError:
+    except (RuntimeError, PdfError):
         raise DocumentReadError()
 
-    return image_data
+def _rasterize(documents_dir: str, document_name: str, view: int, page_box) -> bytes:
+    increment("soduco_pdf_pages_decoded_total", kind="rasterized")
+    try:
+        with timer("rasterize"):
+            return rasterize_page(safe_join(documents_dir, document_name), view, page_box)
+    except RasterizationError:
+        raise DocumentReadError()
+
+def _decode(pdf_image: PdfImage) -> Image.Image:
+    increment("soduco_pdf_pages_decoded_total", kind="decoded")
+    with timer("image_decode"):
+        return pdf_image.as_pil_image()
+
+def get_image_from_view(documents_dir: str, document_name: str, view: int,
+                        passthrough_types: tuple = ("image/jpeg",)) -> tuple:
+    '''
+    Read the image of a view of a document.
+
+    When the page image is stored in a format listed in `passthrough_types`, its compressed
+    stream is returned without decoding. Otherwise, it is decoded and encoded as PNG.
+    Pages which are not made of a single whole-page image are rasterized (see `rasterizer`).
+
+    Args:
+        documents_dir (str): Path to the directory containing the documents
+        document_name (str): Name of the document (e.g. "Didot_1851a.pdf")
+        view (int): View of the document (1-indexed)
+        passthrough_types (tuple): MIME types which can be sent as-is
+
+    Raises:
+        DocumentNotFoundError: If the document does not exist
+        InvalidViewIndexError: If the view does not exist
+        DocumentReadError: If the document could not be read or rendered
+
+    Returns:
+        tuple: `(image_data, mimetype)`
+    '''
+    with _open_view_image(documents_dir, document_name, view) as (pdf_image, page_box):
+        if pdf_image is not None:
+            # Fast path: send the compressed stream as-is
+            mimetype = _passthrough_type(pdf_image)
+            if mimetype is not None and mimetype in passthrough_types:
+                increment("soduco_pdf_pages_decoded_total", kind="passthrough")
+                with timer("image_read"):
+                    return pdf_image.obj.read_raw_bytes(), mimetype
+            pil_image = _decode(pdf_image)
+
+    if pdf_image is None:
+        return _rasterize(documents_dir, document_name, view, page_box), "image/png"
+    img_byte_arr = BytesIO()
+    with timer("png_encode"):
+        pil_image.save(img_byte_arr, format='PNG')
+    return img_byte_arr.getvalue(), "image/png"
+
+def get_decoded_image_from_view(documents_dir: str, document_name: str, view: int):
+    '''
+    Decode (or rasterize) the image of a view of a document, as a `PIL.Image`.
+    Raises the same errors as `get_image_from_view`.
+    '''
+    with _open_view_image(documents_dir, document_name, view) as (pdf_image, page_box):
+        if pdf_image is not None:
+            return _decode(pdf_image)
+    return Image.open(BytesIO(_rasterize(documents_dir, document_name, view, page_box)))
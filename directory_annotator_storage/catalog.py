@@ -0,0 +1,220 @@
+'''
+Catalog of the documents (PDF files) served by the application.
+
+For each PDF of the documents directory, the catalog records its name, size, modification time,
+number of pages and the dimensions of the main image of each page. It is kept in memory and
+persisted as a compact JSON sidecar file, shared by all worker processes.
+The catalog is refreshed incrementally: only documents whose size or modification time changed
+are opened again.
+'''
+
+import json
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+
+from filelock import FileLock
+from pikepdf import Pdf, PdfError
+
+from directory_annotator_storage.backend_documents import (
+    DocumentNotFoundError, DocumentReadError, get_page_image_size)
+from directory_annotator_storage.constants_config import DEFAULT_RASTER_DPI
+
+# Version of the on-disk format, bump it when the layout of an entry changes
+_INDEX_VERSION = 2
+
+
+def _is_document(file_name: str) -> bool:
+    # Same rule as `glob("*.pdf")`
+    return file_name.endswith(".pdf") and not file_name.startswith(".")
+
+
+def _describe_document(document_path: str, raster_dpi: int):
+    '''
+    Return `(num_pages, page_sizes)` for a PDF file, where `page_sizes` lists the `[width, height]`
+    of the image served for each page (see `backend_documents.get_page_image_size`).
+    Returns `(None, None)` if the file cannot be read.
+
+    Runs in worker processes: must not rely on any state of the caller.
+    '''
+    try:
+        with Pdf.open(document_path) as pdf_file:
+            page_sizes = [get_page_image_size(page, raster_dpi) for page in pdf_file.pages]
+            return len(page_sizes), page_sizes
+    except (RuntimeError, PdfError):
+        return None, None
+
+
+class DocumentCatalog:
+    '''
+    Catalog of the PDF files of `documents_dir`.
+
+    Args:
+        documents_dir (str): Path to the directory containing the documents
+        index_path (str): Path to the JSON sidecar file (optional, in-memory only if `None`)
+        max_workers (int): Number of processes used by `refresh(parallel=True)`
+        raster_dpi (int): Resolution of the rasterized pages
+    '''
+    def __init__(self, documents_dir: str, index_path: str = None, max_workers: int = None,
+                 raster_dpi: int = DEFAULT_RASTER_DPI):
+        self.documents_dir = documents_dir
+        self.index_path = index_path
+        self.max_workers = max_workers
+        self.raster_dpi = raster_dpi
+        self._lock = threading.Lock()
+        # name -> [size, mtime_ns, num_pages, page_sizes]
+        self._documents = {}
+        self._names = []
+        self._dir_mtime = None
+        self._index_mtime = None
+
+    # Public members
+    # -----------------------------------------------------------------------------------------
+
+    def refresh(self, parallel: bool = False):
+        '''
+        Synchronize the catalog with the documents directory.
+        Only new or modified documents are opened, using a process pool if `parallel` is set.
+        '''
+        with self._lock:
+            self._refresh(parallel)
+
+    def document_names(self) -> list:
+        '''
+        Return the sorted list of the file names of the documents.
+        '''
+        with self._lock:
+            self._reload_index_if_changed()
+            if self._dir_mtime != self._stat_mtime(self.documents_dir):
+                self._refresh(parallel=False)
+            return list(self._names)
+
+    def get(self, document_name: str) -> dict:
+        '''
+        Return the catalog entry of a document, as a dict with keys
+        `filename`, `size`, `mtime_ns`, `num_pages` and `page_sizes`.
+
+        Raises:
+            DocumentNotFoundError: If the document does not exist
+            DocumentReadError: If the document could not be read
+        '''
+        if not _is_document(document_name) or os.path.basename(document_name) != document_name:
+            raise DocumentNotFoundError()
+        try:
+            stat = os.stat(os.path.join(self.documents_dir, document_name))
+        except FileNotFoundError:
+            raise DocumentNotFoundError()
+
+        with self._lock:
+            self._reload_index_if_changed()
+            entry = self._documents.get(document_name)
+            if entry is None or entry[:2] != [stat.st_size, stat.st_mtime_ns]:
+                # New or modified document: only update this entry
+                with self._index_lock():
+                    self._reload_index_if_changed()
+                    entry = self._documents.get(document_name)
+                    if entry is None or entry[:2] != [stat.st_size, stat.st_mtime_ns]:
+                        self._update({document_name: stat}, parallel=False)
+                        self._names = sorted(self._documents)
+                        self._save_index()
+                        entry = self._documents[document_name]
+
+        size, mtime_ns, num_pages, page_sizes = entry
+        if num_pages is None:
+            raise DocumentReadError()
+        return {
+            "filename": document_name,
+            "size": size,
+            "mtime_ns": mtime_ns,
+            "num_pages": num_pages,
+            "page_sizes": page_sizes,
+        }
+
+    # Internal definitions
+    # -----------------------------------------------------------------------------------------
+
+    @staticmethod
+    def _stat_mtime(path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _index_lock(self):
+        # Serializes the updates of the sidecar file between worker processes
+        if self.index_path is None:
+            return nullcontext()
+        return FileLock(self.index_path + ".lock")
+
+    def _refresh(self, parallel):
+        with self._index_lock():
+            # Another worker may have done the work already
+            self._reload_index_if_changed()
+            dir_mtime = self._stat_mtime(self.documents_dir)
+            current = {}
+            if dir_mtime is not None:
+                with os.scandir(self.documents_dir) as it:
+                    for dir_entry in it:
+                        if _is_document(dir_entry.name) and dir_entry.is_file():
+                            current[dir_entry.name] = dir_entry.stat()
+            removed = set(self._documents) - set(current)
+            for name in removed:
+                del self._documents[name]
+            stale = {
+                name: stat for name, stat in current.items()
+                if name not in self._documents
+                or self._documents[name][:2] != [stat.st_size, stat.st_mtime_ns]
+            }
+            changed = len(stale) > 0 or len(removed) > 0 or dir_mtime != self._dir_mtime
+            self._update(stale, parallel)
+            self._names = sorted(self._documents)
+            self._dir_mtime = dir_mtime
+            if changed:
+                self._save_index()
+
+    def _update(self, stats: dict, parallel: bool):
+        names = list(stats)
+        paths = [os.path.join(self.documents_dir, name) for name in names]
+        if parallel and len(paths) > 1:
+            with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+                descriptions = list(executor.map(_describe_document, paths, [self.raster_dpi] * len(paths)))
+        else:
+            descriptions = [_describe_document(path, self.raster_dpi) for path in paths]
+        for name, (num_pages, page_sizes) in zip(names, descriptions):
+            stat = stats[name]
+            self._documents[name] = [stat.st_size, stat.st_mtime_ns, num_pages, page_sizes]
+
+    def _reload_index_if_changed(self):
+        if self.index_path is None:
+            return
+        index_mtime = self._stat_mtime(self.index_path)
+        if index_mtime is None or index_mtime == self._index_mtime:
+            return
+        try:
+            with open(self.index_path, "r") as index_file:
+                index = json.load(index_file)
+        except (OSError, ValueError):
+            return
+        if index.get("version") != _INDEX_VERSION or index.get("raster_dpi") != self.raster_dpi:
+            return
+        self._documents = index["documents"]
+        self._names = sorted(self._documents)
+        self._dir_mtime = index["dir_mtime"]
+        self._index_mtime = index_mtime
+
+    def _save_index(self):
+        if self.index_path is None:
+            return
+        index = {
+            "version": _INDEX_VERSION,
+            "raster_dpi": self.raster_dpi,
+            "dir_mtime": self._dir_mtime,
+            "documents": self._documents,
+        }
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.index_path))
+        with os.fdopen(fd, "w") as index_file:
+            json.dump(index, index_file, separators=(",", ":"))
+        os.replace(tmp_path, self.index_path)
+        self._index_mtime = self._stat_mtime(self.index_path)
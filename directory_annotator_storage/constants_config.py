@@ -19,10 +19,115 @@ DOC_PATH = "SODUCO_DIRECTORIES_PATH"
 # Path to the directory which contains the annotations for each document (cheap DB).
 ANNOT_PATH = "SODUCO_ANNOTATIONS_PATH"
 
+# app.config[ANNOT_BACKEND]: str (optional, default: "zip")
+# Storage of the annotations: "zip" (an archive per document in ANNOT_PATH) or "sqlite".
+ANNOT_BACKEND = "SODUCO_ANNOTATIONS_BACKEND"
+
+# app.config[ANNOT_DB_PATH]: str (optional, default: "annotations.sqlite3" in ANNOT_PATH)
+# Path to the database of the "sqlite" annotation backend.
+ANNOT_DB_PATH = "SODUCO_ANNOTATIONS_DB"
+
+# app.config[ANNOT_CACHE_SIZE]: int (optional, default: DEFAULT_ANNOT_CACHE_SIZE)
+# Approximate memory budget, in bytes, of the parsed annotation pages cached by each worker process
+# (0 to disable). Only used by the "zip" annotation backend.
+ANNOT_CACHE_SIZE = "SODUCO_ANNOTATIONS_CACHE_SIZE"
+
+# app.config[ANNOT_COMPRESSION]: int (optional, default: DEFAULT_ANNOT_COMPRESSION)
+# Deflate level (0 to 9, 0 for no compression) of the annotations stored by the "zip" backend.
+ANNOT_COMPRESSION = "SODUCO_ANNOTATIONS_COMPRESSION"
+
+# app.config[ANNOT_COMMIT_WINDOW]: float (optional, default: DEFAULT_ANNOT_COMMIT_WINDOW)
+# Time, in seconds, a save waits for concurrent saves of the same document to commit them together.
+# Only used by the "zip" annotation backend.
+ANNOT_COMMIT_WINDOW = "SODUCO_ANNOTATIONS_COMMIT_WINDOW"
+
+# app.config[ANNOT_SORT_ON_SAVE]: bool (optional, default: False)
+# Sort the entries of the saved views in reading order (see `reading_order`).
+ANNOT_SORT_ON_SAVE = "SODUCO_ANNOTATIONS_SORT_ON_SAVE"
+
 # app.config[SECRET_KEY_PATH]: str
 # Path to the file contaning secret auth tokens (cheap auth).
 SECRET_KEY_PATH = "SODUCO_PATH_SECRET_KEY"
 
+# app.config[PDF_CACHE_SIZE]: int (optional, default: DEFAULT_PDF_CACHE_SIZE)
+# Maximum number of PDF files kept open by each worker process.
+PDF_CACHE_SIZE = "SODUCO_PDF_CACHE_SIZE"
+
+# app.config[CACHE_PATH]: str (optional)
+# Path to a writeable directory shared by all worker processes, where derived data is stored
+# (document catalog, etc.). Nothing is persisted when not defined.
+CACHE_PATH = "SODUCO_CACHE_PATH"
+
+# app.config[CATALOG_WORKERS]: int (optional, default: number of CPUs)
+# Number of processes used to build the document catalog at startup.
+CATALOG_WORKERS = "SODUCO_CATALOG_WORKERS"
+
+# app.config[IMAGE_CACHE_SIZE]: int (optional, default: DEFAULT_IMAGE_CACHE_SIZE)
+# Budget, in bytes, of the disk cache of page images stored in CACHE_PATH (0 to disable).
+IMAGE_CACHE_SIZE = "SODUCO_IMAGE_CACHE_SIZE"
+
+# app.config[TILE_SIZE]: int (optional, default: DEFAULT_TILE_SIZE)
+# Size, in pixels, of the (square) tiles of the page images.
+TILE_SIZE = "SODUCO_TILE_SIZE"
+
+# app.config[RASTER_DPI]: int (optional, default: DEFAULT_RASTER_DPI)
+# Resolution used to render the pages which are not made of a single image.
+RASTER_DPI = "SODUCO_RASTER_DPI"
+
+# app.config[RASTER_WORKERS]: int (optional, default: DEFAULT_RASTER_WORKERS)
+# Number of processes rendering pages, for each worker process.
+RASTER_WORKERS = "SODUCO_RASTER_WORKERS"
+
+# app.config[RASTER_TIMEOUT]: float (optional, default: DEFAULT_RASTER_TIMEOUT)
+# Maximum duration, in seconds, of the rendering of a page.
+RASTER_TIMEOUT = "SODUCO_RASTER_TIMEOUT"
+
+# app.config[RASTER_MEMORY_LIMIT]: int (optional, default: DEFAULT_RASTER_MEMORY_LIMIT)
+# Maximum memory, in bytes, of a process rendering pages (0 for no limit).
+RASTER_MEMORY_LIMIT = "SODUCO_RASTER_MEMORY_LIMIT"
+
+# app.config[IMAGE_WORKERS]: int (optional, default: DEFAULT_IMAGE_WORKERS)
+# Number of processes producing page images, for each worker process (0 to produce them in
+# the request handlers).
+IMAGE_WORKERS = "SODUCO_IMAGE_WORKERS"
+
+# app.config[IMAGE_QUEUE_LIMIT]: int (optional, default: DEFAULT_IMAGE_QUEUE_LIMIT)
+# Maximum number of images waiting for a process, beyond which image requests are rejected
+# (503 Service Unavailable).
+IMAGE_QUEUE_LIMIT = "SODUCO_IMAGE_QUEUE_LIMIT"
+
+# app.config[IMAGE_TIMEOUT]: float (optional, default: DEFAULT_IMAGE_TIMEOUT)
+# Maximum duration, in seconds, of the production of an image, from the moment a process
+# begins to produce it (its process is then killed).
+IMAGE_TIMEOUT = "SODUCO_IMAGE_TIMEOUT"
+
+# app.config[PREFETCH_VIEWS]: int (optional, default: 0)
+# Number of views following the one read which are prefetched in the background (0 to disable).
+PREFETCH_VIEWS = "SODUCO_PREFETCH_VIEWS"
+
+# app.config[PREFETCH_WORKERS]: int (optional, default: DEFAULT_PREFETCH_WORKERS)
+# Maximum number of views prefetched concurrently, for each worker process.
+PREFETCH_WORKERS = "SODUCO_PREFETCH_WORKERS"
+
+# app.config[METRICS_ENABLED]: bool (optional, default: True)
+# Serve the metrics of the application on `/metrics` (Prometheus text format). The metrics of all
+# worker processes are aggregated when CACHE_PATH is defined.
+METRICS_ENABLED = "SODUCO_METRICS_ENABLED"
+
+# app.config[METRICS_TOKEN]: str (optional)
+# Token required in the `Authorization` header of the requests to `/metrics` (none by default).
+METRICS_TOKEN = "SODUCO_METRICS_TOKEN"
+
+# app.config[PROFILE_TOKEN]: str (optional)
+# Token enabling the profiling of the requests which send it in the `X-Profile-Token` header
+# (see `profiling`). Profiling is disabled when not defined.
+PROFILE_TOKEN = "SODUCO_PROFILE_TOKEN"
+
+# app.config[PROFILE_PATH]: str (optional)
+# Path to a writeable directory where the profiles of the requests are written. When not defined,
+# a summary of the profile is sent instead of the response.
+PROFILE_PATH = "SODUCO_PROFILE_PATH"
+
 # DEFINED INTERNALLY 
 #######################################################################
 
@@ -31,8 +136,70 @@ SECRET_KEY_PATH = "SODUCO_PATH_SECRET_KEY"
 # Defined by reading a secret token file upon app initialization.
 TOKENS = "TOKENS"
 
+# app.config[ANNOTATIONS]: annotation_backend.AnnotationBackend
+# Storage of the annotations, created upon app initialization according to ANNOT_BACKEND.
+ANNOTATIONS = "ANNOTATIONS"
+
+# app.config[SPATIAL_INDEX]: spatial_index.SpatialIndex | None
+# Index of the elements of the views, created upon app initialization when ANNOT_PATH is defined
+# (stored in CACHE_PATH if defined, in ANNOT_PATH otherwise).
+SPATIAL_INDEX = "SPATIAL_INDEX"
+
+# app.config[SEARCH_INDEX]: search_index.SearchIndex | None
+# Full-text index of the annotations, created upon app initialization when ANNOT_PATH is defined
+# (stored in CACHE_PATH if defined, in ANNOT_PATH otherwise).
+SEARCH_INDEX = "SEARCH_INDEX"
+
+# app.config[CATALOG]: catalog.DocumentCatalog
+# Catalog of the documents, built upon app initialization when DOC_PATH is defined.
+CATALOG = "CATALOG"
+
+# app.config[IMAGE_CACHE]: image_cache.ImageCache | None
+# Disk cache of page images, created upon app initialization when CACHE_PATH is defined.
+IMAGE_CACHE = "IMAGE_CACHE"
+
+# app.config[IMAGE_POOL]: image_workers.ImageWorkers
+# Pool of processes producing the page images, created upon app initialization.
+IMAGE_POOL = "IMAGE_POOL"
+
+# app.config[PREFETCHER]: prefetch.Prefetcher | None
+# Prefetcher of the next views, created upon app initialization when PREFETCH_VIEWS > 0.
+PREFETCHER = "PREFETCHER"
+
 # OTHER CONSTANTS
 #######################################################################
 
 # Default token to add to authorized authentication tokens when debug is active.
 DEBUG_TOKEN = "12345678"
+
+# Default maximum number of open PDF files per worker process.
+DEFAULT_PDF_CACHE_SIZE = 16
+
+# Default memory budget of the parsed annotation pages cache (64 MiB).
+DEFAULT_ANNOT_CACHE_SIZE = 64 * 1024 ** 2
+
+# Default deflate level of the stored annotations.
+DEFAULT_ANNOT_COMPRESSION = 6
+
+# Default time a save waits for concurrent saves of the same document (2 ms).
+DEFAULT_ANNOT_COMMIT_WINDOW = 0.002
+
+# Default budget of the disk cache of page images (2 GiB).
+DEFAULT_IMAGE_CACHE_SIZE = 2 * 1024 ** 3
+
+# Default size of the tiles of the page images.
+DEFAULT_TILE_SIZE = 512
+
+# Default settings of the rendering of pages.
+DEFAULT_RASTER_DPI = 150
+DEFAULT_RASTER_WORKERS = 2
+DEFAULT_RASTER_TIMEOUT = 60
+DEFAULT_RASTER_MEMORY_LIMIT = 2 * 1024 ** 3
+
+# Default settings of the pool of processes producing page images.
+DEFAULT_IMAGE_WORKERS = 2
+DEFAULT_IMAGE_QUEUE_LIMIT = 4
+DEFAULT_IMAGE_TIMEOUT = 60
+
+# Default maximum number of views prefetched concurrently.
+DEFAULT_PREFETCH_WORKERS = 1
@@ -1,19 +1,67 @@
 import codecs
+import gzip
 import json
+import os
+import struct
 from io import BytesIO
 
-from flask import Blueprint, request, jsonify, send_file, abort, current_app
+from flask import Blueprint, request, jsonify, send_file, abort, current_app, make_response, g
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from werkzeug.wsgi import wrap_file
 
+from directory_annotator_storage.annotation_backend import create_annotation_backend
+from directory_annotator_storage.annotation_log import LogCorruptedError
 from directory_annotator_storage.backend_annotations import (
-    AnnotationsNotFoundError, InvalidDocumentNameError, SaveError, get_document_annotations_as_zip_file, load_annotations, replace_document_annotations, save_annotations)
+    AnnotationsNotFoundError, InvalidArchiveError, InvalidDocumentNameError, SaveError, VersionMismatchError,
+    configure_annotation_cache, configure_annotation_codec, configure_group_commit, normalize_page)
 from directory_annotator_storage.backend_documents import (
-    DocumentNotFoundError, DocumentReadError, InvalidViewIndexError, document_list, get_document_pages, get_image_from_view)
-from directory_annotator_storage.constants_config import (TOKENS, DOC_PATH, ANNOT_PATH)
+    DocumentNotFoundError, DocumentReadError, InvalidViewIndexError, configure_pdf_cache, get_document_stat,
+    get_image_from_view)
+from directory_annotator_storage.catalog import DocumentCatalog
+from directory_annotator_storage.constants_config import (
+    TOKENS, DOC_PATH, ANNOT_PATH, ANNOT_CACHE_SIZE, ANNOT_COMMIT_WINDOW, ANNOT_COMPRESSION,
+    ANNOT_SORT_ON_SAVE, PDF_CACHE_SIZE, CACHE_PATH, CATALOG_WORKERS, IMAGE_CACHE_SIZE, TILE_SIZE, RASTER_DPI,
+    RASTER_WORKERS, RASTER_TIMEOUT, RASTER_MEMORY_LIMIT, IMAGE_WORKERS, IMAGE_QUEUE_LIMIT, IMAGE_TIMEOUT,
+    PREFETCH_VIEWS, PREFETCH_WORKERS, ANNOTATIONS, SPATIAL_INDEX, SEARCH_INDEX, CATALOG, IMAGE_CACHE, IMAGE_POOL,
+    PREFETCHER, DEFAULT_ANNOT_CACHE_SIZE, DEFAULT_ANNOT_COMMIT_WINDOW, DEFAULT_ANNOT_COMPRESSION,
+    DEFAULT_PDF_CACHE_SIZE, DEFAULT_IMAGE_CACHE_SIZE, DEFAULT_TILE_SIZE, DEFAULT_RASTER_DPI, DEFAULT_RASTER_WORKERS,
+    DEFAULT_RASTER_TIMEOUT, DEFAULT_RASTER_MEMORY_LIMIT, DEFAULT_IMAGE_WORKERS, DEFAULT_IMAGE_QUEUE_LIMIT,
+    DEFAULT_IMAGE_TIMEOUT, DEFAULT_PREFETCH_WORKERS)
+from directory_annotator_storage.image_cache import ImageCache, image_key
+from directory_annotator_storage.image_workers import ImageWorkers, ImageWorkersBusyError
+from directory_annotator_storage.instrumentation import register_collector
+from directory_annotator_storage.json_patch import (
+    InvalidPatchError, PatchConflictError, apply_json_patch, apply_keyed_diff)
+from directory_annotator_storage.prefetch import Prefetcher
+from directory_annotator_storage.profiling import is_profiled
+from directory_annotator_storage.rasterizer import configure_rasterizer, rasterization_dpi
+from directory_annotator_storage.reading_order import sort_page
+from directory_annotator_storage.search_index import SearchIndex, search_index_path
+from directory_annotator_storage.spatial_index import SpatialIndex
+from directory_annotator_storage.image_variants import (
+    IMAGE_VARIANTS, InvalidTileIndexError, get_tile_from_view, get_variant_from_view, tile_levels)
+from directory_annotator_storage.zip_index import ArchiveCorruptedError
 import directory_annotator_storage.path_utils as pu
 
 bp = Blueprint('directories', __name__, url_prefix='/directories')
 bp.config = {}
 
+# Maximum number of views of a batch request
+_MAX_BATCH_VIEWS = 1000
+
+# Number of results of a search, by default and at most
+_DEFAULT_SEARCH_LIMIT = 50
+_MAX_SEARCH_LIMIT = 1000
+
+# Gzip members sent around a stored view, so that the response is `{"content": <view>}`
+_GZIP_CONTENT_PREFIX = gzip.compress(b'{"content":', mtime=0)
+_GZIP_CONTENT_SUFFIX = gzip.compress(b'}', mtime=0)
+_GZIP_ETAG_SUFFIX = "-gzip"
+_GZIP_MEMBER_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+
+# Errors of the stored annotations of a document (its archive or its log is damaged)
+_CORRUPTION_ERRORS = (ArchiveCorruptedError, LogCorruptedError)
+
 @bp.before_request
 def before_request_func():
     if request.method == "OPTIONS":
@@ -23,15 +71,75 @@ def before_request_func():
     if request_token not in bp.config[TOKENS]:
         abort(403, "Invalid request token.")
 
+@bp.before_request
+def track_foreground_request():
+    # Prefetching pauses while requests are being served
+    if bp.config.get(PREFETCHER) is not None:
+        bp.config[PREFETCHER].foreground_started()
+        g.prefetch_foreground = True
+
+@bp.teardown_request
+def untrack_foreground_request(exc):
+    if g.pop("prefetch_foreground", False):
+        bp.config[PREFETCHER].foreground_finished()
+
 @bp.record
 def record_config(setup_state):
     bp.config = setup_state.app.config
+    if bp.config.get(ANNOT_PATH):
+        bp.config[ANNOTATIONS] = create_annotation_backend(bp.config)
+        index_dir = bp.config.get(CACHE_PATH) or bp.config[ANNOT_PATH]
+        os.makedirs(index_dir, exist_ok=True)
+        bp.config[SPATIAL_INDEX] = SpatialIndex(os.path.join(index_dir, "spatial_index.sqlite3"))
+        bp.config[SEARCH_INDEX] = SearchIndex(search_index_path(bp.config))
+    configure_annotation_cache(bp.config.get(ANNOT_CACHE_SIZE, DEFAULT_ANNOT_CACHE_SIZE))
+    configure_annotation_codec(bp.config.get(ANNOT_COMPRESSION, DEFAULT_ANNOT_COMPRESSION))
+    configure_group_commit(bp.config.get(ANNOT_COMMIT_WINDOW, DEFAULT_ANNOT_COMMIT_WINDOW))
+    configure_pdf_cache(bp.config.get(PDF_CACHE_SIZE, DEFAULT_PDF_CACHE_SIZE))
+    raster_settings = {
+        "workers": bp.config.get(RASTER_WORKERS, DEFAULT_RASTER_WORKERS),
+        "dpi": bp.config.get(RASTER_DPI, DEFAULT_RASTER_DPI),
+        "timeout": bp.config.get(RASTER_TIMEOUT, DEFAULT_RASTER_TIMEOUT),
+        "memory_limit": bp.config.get(RASTER_MEMORY_LIMIT, DEFAULT_RASTER_MEMORY_LIMIT),
+    }
+    configure_rasterizer(**raster_settings)
+    if bp.config.get(IMAGE_POOL) is not None:
+        bp.config[IMAGE_POOL].shutdown()
+    bp.config[IMAGE_POOL] = ImageWorkers(
+        bp.config.get(IMAGE_WORKERS, DEFAULT_IMAGE_WORKERS),
+        bp.config.get(IMAGE_QUEUE_LIMIT, DEFAULT_IMAGE_QUEUE_LIMIT),
+        bp.config.get(IMAGE_TIMEOUT, DEFAULT_IMAGE_TIMEOUT),
+        bp.config.get(PDF_CACHE_SIZE, DEFAULT_PDF_CACHE_SIZE),
+        raster_settings)
+    register_collector("image_workers", bp.config[IMAGE_POOL].info, ("pending",),
+                       ("completed", "rejected", "timeouts"))
+    if bp.config.get(DOC_PATH):
+        cache_path = bp.config.get(CACHE_PATH)
+        index_path = None
+        if cache_path:
+            os.makedirs(cache_path, exist_ok=True)
+            index_path = os.path.join(cache_path, "catalog.json")
+        catalog = DocumentCatalog(bp.config[DOC_PATH], index_path, bp.config.get(CATALOG_WORKERS), rasterization_dpi())
+        catalog.refresh(parallel=True)
+        bp.config[CATALOG] = catalog
+    bp.config[IMAGE_CACHE] = None
+    if bp.config.get(CACHE_PATH) and bp.config.get(IMAGE_CACHE_SIZE, DEFAULT_IMAGE_CACHE_SIZE) > 0:
+        bp.config[IMAGE_CACHE] = ImageCache(
+            os.path.join(bp.config[CACHE_PATH], "images"),
+            bp.config.get(IMAGE_CACHE_SIZE, DEFAULT_IMAGE_CACHE_SIZE))
+    bp.config[PREFETCHER] = None
+    if bp.config.get(PREFETCH_VIEWS, 0) > 0:
+        bp.config[PREFETCHER] = Prefetcher(
+            bp.config[PREFETCH_VIEWS],
+            bp.config.get(PREFETCH_WORKERS, DEFAULT_PREFETCH_WORKERS),
+            [warm_image, warm_annotation])
+        register_collector("prefetch", bp.config[PREFETCHER].info, ("pending",), ("completed", "dropped"))
 
 # ROUTES
 #######################################################################
 @bp.route('/', methods=['GET'])
 def show_all_directories():
-    list_doc = document_list(bp.config[DOC_PATH])
+    list_doc = bp.config[CATALOG].document_names()
     directories = { pu.get_stem_with_extension(d, 'pdf'): {} for d in list_doc }
     res_dict = { "directories":  directories }
     return jsonify(res_dict)
@@ -41,7 +149,7 @@ def get_directory(document):
     document_path = pu.get_stem_with_extension(document, "pdf")
     pages = None
     try:
-        pages = get_document_pages(bp.config[DOC_PATH], document_path)
+        pages = bp.config[CATALOG].get(document_path)["num_pages"]
     except DocumentReadError:
         abort(500, description="Error reading document.")
     except DocumentNotFoundError:
@@ -52,7 +160,7 @@ def get_directory(document):
     }
     return jsonify(result)
 
-@bp.route('/<document>/<int:view>/annotation', methods=['GET', 'PUT'])
+@bp.route('/<document>/<int:view>/annotation', methods=['GET', 'PUT', 'PATCH'])
 def access_annotation(document, view):
     '''
     Access the annotation of a view of a document.
@@ -67,7 +175,7 @@ def access_annotation(document, view):
 
     Methods
     -------
-    GET|PUT
+    GET|PUT|PATCH
 
     Action
     ------
@@ -76,19 +184,46 @@ def access_annotation(document, view):
     if request.method == 'GET':
         download = turn_to_bool(request.args.get('download'))
         content = None
+        deflated = None
         try:
-            content = load_annotations(bp.config[ANNOT_PATH], document, view)
+            # Read before the content: a concurrent save can only make it older than the content
+            version = bp.config[ANNOTATIONS].version(document, view)
+            if request.if_none_match.star_tag or any(
+                    view_version(tag) == version for tag in request.if_none_match.as_set()):
+                response = make_response("", 304)
+                response.set_etag(version)
+                return response
+            # Fast path: the stored bytes are sent as they are, when the client accepts gzip
+            if not download and request.accept_encodings["gzip"]:
+                deflated = bp.config[ANNOTATIONS].load_deflated(document, view)
+            if deflated is None:
+                content = bp.config[ANNOTATIONS].load(document, view)
         except AnnotationsNotFoundError:
             abort(404, f"No annotation available for view '{view}' of document '{document}'.")
         except InvalidDocumentNameError:
             abort(400, f"Invalid document name '{document}'.")
+        except _CORRUPTION_ERRORS:
+            current_app.logger.exception("Could not read view %s of '%s'", view, document)
+            return "Error reading the annotations", 500
         
         if download:
             buf = BytesIO()
             buf.write(codecs.encode(json.dumps(content)))
             return send_file(buf, as_attachment=True, mimetype='text/plain')
         else:
-            return jsonify({ "content": content })
+            if deflated is not None:
+                response = make_response(
+                    _GZIP_CONTENT_PREFIX + gzip_member(deflated) + _GZIP_CONTENT_SUFFIX)
+                response.mimetype = "application/json"
+                response.content_encoding = "gzip"
+                # Each representation has its own entity tag
+                response.set_etag(version + _GZIP_ETAG_SUFFIX)
+            else:
+                response = jsonify({ "content": content })
+                response.set_etag(version)
+            response.vary.add("Accept-Encoding")
+            schedule_prefetch(response, document, view)
+            return response
 
     elif request.method == 'PUT':
         json_data = request.get_json(force=True)
@@ -101,41 +236,273 @@ def access_annotation(document, view):
         if not isinstance(content, list):
             current_app.logger.info("Content is not a list, but a %s", type(content))
         try:
-            save_annotations(bp.config[ANNOT_PATH], document, view, content)
+            content = prepare_content(content)
+            version = bp.config[ANNOTATIONS].save(document, view, content, if_match=requested_version(document, view))
+        except SaveError:
+            return "Error saving the content", 500
+        except VersionMismatchError:
+            abort(412, f"View '{view}' of document '{document}' was modified in the meantime.")
+        response = make_response("Content saved on the server", 200)
+        response.set_etag(version)
+        index_saved(response, document, {view: content}, {view: version})
+        return response
+
+    elif request.method == 'PATCH':
+        # RFC 6902 JSON Patch, or keyed diff of the elements (see `json_patch`)
+        patch = request.get_json(force=True, silent=True)
+        apply_patch = apply_json_patch if request.mimetype == "application/json-patch+json" else apply_keyed_diff
+        patched = {}
+
+        def transform(page):
+            patched[view] = prepare_content(apply_patch(page, patch))
+            return patched[view]
+        try:
+            version = bp.config[ANNOTATIONS].update(
+                document, view, transform, if_match=requested_version(document, view))
+        except AnnotationsNotFoundError:
+            abort(404, f"No annotation available for view '{view}' of document '{document}'.")
+        except InvalidDocumentNameError:
+            abort(400, f"Invalid document name '{document}'.")
+        except InvalidPatchError as err:
+            abort(400, f"Invalid patch: {err}")
+        except PatchConflictError as err:
+            abort(409, f"Cannot apply the patch: {err}")
+        except _CORRUPTION_ERRORS:
+            current_app.logger.exception("Could not read view %s of '%s'", view, document)
+            return "Error reading the annotations", 500
         except SaveError:
             return "Error saving the content", 500
-        return "Content saved on the server", 200
+        except VersionMismatchError:
+            abort(412, f"View '{view}' of document '{document}' was modified in the meantime.")
+        response = make_response("Content saved on the server", 200)
+        response.set_etag(version)
+        index_saved(response, document, patched, {view: version})
+        return response
+
+
+@bp.route('/<document>/annotations', methods=['GET', 'PUT'])
+def access_annotations(document):
+    '''
+    Access the annotations of several views of a document at once.
+    -----------
+    GET: `views` lists the views, separated by commas, and ranges of views (e.g. `1,3,5-9`).
+    The result, streamed, is `{"views": {"<view>": {"status": <HTTP status>, "content": ...}}}`.
+
+    PUT: the payload is `{"views": {"<view>": <content>}}`, where each content is a list of elements.
+    The views are checked, then saved at once: nothing is saved if one of them is invalid (400).
+    The result is `{"views": {"<view>": {"status": <HTTP status>}}}`.
+    '''
+    if request.method == 'GET':
+        views = parse_views(request.args.get('views'))
+        annotations = bp.config[ANNOTATIONS]
+        # The response is streamed outside of the application context
+        logger = current_app.logger
+
+        def generate():
+            yield '{"views":{'
+            for i, (view, content, error) in enumerate(annotations.load_many(document, views)):
+                if isinstance(error, InvalidDocumentNameError):
+                    result = {"status": 400}
+                elif isinstance(error, _CORRUPTION_ERRORS):
+                    logger.error("Could not read view %s of '%s': %s", view, document, error)
+                    result = {"status": 500}
+                elif error is not None:
+                    result = {"status": 404}
+                else:
+                    result = {"status": 200, "content": content}
+                yield f'{"," if i > 0 else ""}"{view}":{json.dumps(result, ensure_ascii=False)}'
+            yield '}}'
+        return current_app.response_class(generate(), mimetype="application/json")
+
+    json_data = request.get_json(force=True, silent=True)
+    if not isinstance(json_data, dict) or not isinstance(json_data.get("views"), dict):
+        abort(400, "Payload must be {\"views\": {\"<view>\": <content>}}.")
+    if len(json_data["views"]) > _MAX_BATCH_VIEWS:
+        abort(400, f"Too many views (at most {_MAX_BATCH_VIEWS}).")
+    for key, content in json_data["views"].items():
+        # ASCII only: `isdigit` accepts other digits (e.g. "²") which `int` rejects
+        if not (key.isascii() and key.isdigit() and int(key) >= 1):
+            abort(400, f"Invalid view '{key}'.")
+        if not isinstance(content, list) or not all(isinstance(element, dict) for element in content):
+            abort(400, f"Invalid content for view '{key}': expected a list of elements.")
+    pages = {int(key): prepare_content(content) for key, content in json_data["views"].items()}
+    if len(pages) == 0:
+        return jsonify({"views": {}})
+    versions = {}
+    try:
+        versions = bp.config[ANNOTATIONS].save_many(document, pages)
+        status = 200
+    except SaveError:
+        current_app.logger.exception("Could not save views of '%s'", document)
+        status = 500
+    response = jsonify({"views": {str(view): {"status": status} for view in pages}})
+    index_saved(response, document, pages, versions)
+    return response
+
+
+@bp.route('/search', methods=['GET'])
+def search_annotations():
+    '''
+    Search the text of the entries and titles of all the documents.
+    -----------
+    `q` lists the words to find (a word ending with `*` matches the words starting with it),
+    `document` restricts the search to a document, and `limit` (default: 50) bounds the number
+    of results. The result is `{"hits": [{"document", "view", "path", "type", "box", "text", "score"}]}`,
+    best matches first (`path` is the JSON pointer of the element in the view).
+    '''
+    try:
+        limit = int(request.args.get('limit', _DEFAULT_SEARCH_LIMIT))
+    except ValueError:
+        limit = -1
+    if not 0 < limit <= _MAX_SEARCH_LIMIT:
+        abort(400, f"Invalid limit (at most {_MAX_SEARCH_LIMIT}).")
+    hits = bp.config[SEARCH_INDEX].search(request.args.get('q', ""), request.args.get('document'), limit)
+    return jsonify({"hits": hits})
+
+
+@bp.route('/<document>/elements', methods=['GET'])
+def query_elements(document):
+    '''
+    Find elements of the annotations of a document, without loading the views.
+    -----------
+    `views` lists the views, as for `annotations` (default: all the annotated views),
+    `type` the types of the elements, separated by commas (default: all), and `box` (`x,y,w,h`)
+    a rectangle the boxes of the elements must intersect (default: none).
+    The result is `{"elements": [{"view": <view>, "index": <index in the view>, "element": ...}]}`.
+    '''
+    views_arg = request.args.get('views')
+    types = request.args.get('type')
+    box = request.args.get('box')
+    try:
+        box = tuple(float(v) for v in box.split(",")) if box is not None else None
+    except ValueError:
+        box = ()
+    if box is not None and len(box) != 4:
+        abort(400, f"Invalid box '{request.args.get('box')}' (expected x,y,w,h).")
+    try:
+        views = parse_views(views_arg) if views_arg is not None else bp.config[ANNOTATIONS].document_views(document)
+        elements = bp.config[SPATIAL_INDEX].query(
+            bp.config[ANNOTATIONS], document, views, box, types.split(",") if types else None)
+    except InvalidDocumentNameError:
+        abort(400, f"Invalid document name '{document}'.")
+    return jsonify({"elements": [
+        {"view": view, "index": index, "element": element} for view, index, element in elements]})
 
 
 @bp.route('/<document>/<int:view>/image', methods=['GET'])
 def get_image(document, view):
-    try:
-        image_data = get_image_from_view(bp.config[DOC_PATH], document, view)
-    except DocumentReadError:
-        return "Error reading the document", 500
-    except DocumentNotFoundError:
-        abort(404, "Document not found.")
-    except InvalidViewIndexError:
-        abort(404, "View is not available.")
-    except NotImplementedError:
-        abort(500, "Image need to be rasterize")
-    data = BytesIO(image_data)
-    return send_file(data, mimetype='image/jpeg')
+    '''
+    Send the image of a view of a document.
+    JPEG page images are sent as stored in the PDF (and JPEG 2000 ones if the client accepts
+    `image/jp2`), other ones are converted to PNG.
+    '''
+    passthrough_types = ["image/jpeg"]
+    if any(mimetype == "image/jp2" and quality > 0 for mimetype, quality in request.accept_mimetypes):
+        passthrough_types.append("image/jp2")
+
+    def produce():
+        return produce_image(get_image_from_view, bp.config[DOC_PATH], document, view, tuple(passthrough_types))
+
+    response = make_response(send_view_image(document, view, {"passthrough": passthrough_types}, produce))
+    # The format depends on `Accept`: caches must not send JPEG 2000 to other clients
+    response.vary.add("Accept")
+    schedule_prefetch(response, document, view)
+    return response
+
+
+@bp.route('/<document>/<int:view>/image/<variant>', methods=['GET'])
+def get_image_variant(document, view, variant):
+    '''
+    Send a resized variant (`thumbnail`, `medium` or `full`) of the image of a view of a document.
+    '''
+    if variant == "full":
+        return get_image(document, view)
+    if variant not in IMAGE_VARIANTS:
+        abort(404, f"Unknown image variant '{variant}'.")
+
+    def produce():
+        return produce_image(get_variant_from_view, bp.config[DOC_PATH], document, view, variant)
+
+    return send_view_image(document, view, {"variant": variant}, produce)
+
+
+@bp.route('/<document>/<int:view>/tiles', methods=['GET'])
+def get_tiles_info(document, view):
+    '''
+    Describe the tile pyramid of the image of a view of a document.
+    '''
+    width, height = view_page_size(document, view)
+    tile_size = bp.config.get(TILE_SIZE, DEFAULT_TILE_SIZE)
+    return jsonify({
+        "width": width,
+        "height": height,
+        "tile_size": tile_size,
+        "levels": tile_levels(width, height, tile_size),
+        "format": "jpg",
+    })
+
+
+@bp.route('/<document>/<int:view>/tiles/<int:level>/<int:column>_<int:row>.jpg', methods=['GET'])
+def get_tile(document, view, level, column, row):
+    '''
+    Send a tile of the image of a view of a document (see `get_tiles_info`).
+    '''
+    tile_size = bp.config.get(TILE_SIZE, DEFAULT_TILE_SIZE)
+    page_size = tuple(view_page_size(document, view))
+
+    def produce():
+        return produce_image(
+            get_tile_from_view, bp.config[DOC_PATH], document, view, level, column, row, tile_size, page_size)
+
+    params = {"tile": [level, column, row], "tile_size": tile_size}
+    return send_view_image(document, view, params, produce)
 
 
 @bp.route('/<directory>/download_directory', methods=['GET'])
 def download_directory(directory):
-    data = get_document_annotations_as_zip_file(bp.config[ANNOT_PATH], directory)
-    if data is None:
+    '''
+    Download the annotations of a document as a ZIP archive.
+    The archive is streamed from a snapshot, and supports `Range` and conditional requests.
+    '''
+    export = bp.config[ANNOTATIONS].open_export(directory)
+    if export is None:
         abort(404, f"zip file of {directory} not found")
-    return send_file(data, as_attachment=True, download_name=f"{directory}.zip", mimetype="application/zip")
+    response = current_app.response_class(
+        wrap_file(request.environ, export.file), mimetype="application/zip", direct_passthrough=True)
+    response.content_length = export.size
+    response.headers.set("Content-Disposition", "attachment", filename=f"{directory}.zip")
+    response.set_etag(export.etag)
+    if export.last_modified is not None:
+        response.last_modified = export.last_modified
+    response.cache_control.no_cache = True
+    try:
+        return response.make_conditional(request.environ, accept_ranges=True, complete_length=export.size)
+    except RequestedRangeNotSatisfiable:
+        export.file.close()
+        raise
 
 
-# TODO add options to merge (with or without replacement)
 @bp.route('/<directory>/replace_directory', methods=['PUT'])
 def replace_directory(directory):
-    zip_data = request.data
-    replace_document_annotations(bp.config[ANNOT_PATH], directory, zip_data)
+    '''
+    Replace the annotations of a document with an uploaded ZIP archive of views.
+    The upload is streamed to disk and checked before the annotations are replaced.
+    With `merge=1`, only the views of the archive which changed are replaced.
+    '''
+    merge = turn_to_bool(request.args.get('merge'))
+    try:
+        bp.config[ANNOTATIONS].replace(directory, request.stream, merge=merge)
+    except InvalidDocumentNameError:
+        abort(400, f"Invalid document name '{directory}'.")
+    except InvalidArchiveError as err:
+        abort(400, f"Invalid archive: {err}")
+    except SaveError:
+        current_app.logger.exception("Could not replace the annotations of '%s'", directory)
+        return "Error saving the content", 500
+    if bp.config.get(SPATIAL_INDEX) is not None:
+        bp.config[SPATIAL_INDEX].index_replaced(directory)
+    if bp.config.get(SEARCH_INDEX) is not None:
+        bp.config[SEARCH_INDEX].index_replaced(bp.config[ANNOTATIONS], directory)
     return "Content saved on the server", 200
 
 
@@ -143,6 +510,179 @@ def replace_directory(directory):
 # HELPERS
 #######################################################################
 
+def schedule_prefetch(response, document, view):
+    '''
+    Prefetch the views following `view` once `response` is sent, if prefetching is enabled.
+    '''
+    prefetcher = bp.config.get(PREFETCHER)
+    if prefetcher is not None:
+        response.call_on_close(lambda: prefetcher.schedule(document, view))
+
+def warm_image(document, view):
+    '''
+    Fill the image cache for a view, as `get_image` would (called by the prefetcher).
+    Skipped while the image workers have other jobs: prefetching must not delay the requests.
+    '''
+    image_cache = bp.config[IMAGE_CACHE]
+    if image_cache is None:
+        return
+    try:
+        document_stat = get_document_stat(bp.config[DOC_PATH], document)
+        etag = image_key(document, view, document_stat, {"passthrough": ["image/jpeg"]})
+        image_cache.get_or_create(
+            etag, lambda: bp.config[IMAGE_POOL].run(
+                get_image_from_view, bp.config[DOC_PATH], document, view, background=True))
+    except (DocumentNotFoundError, DocumentReadError, InvalidViewIndexError, ImageWorkersBusyError):
+        pass
+
+def warm_annotation(document, view):
+    '''
+    Load the annotations of a view, so they are cached (called by the prefetcher).
+    '''
+    try:
+        bp.config[ANNOTATIONS].load(document, view)
+    except (AnnotationsNotFoundError, InvalidDocumentNameError) + _CORRUPTION_ERRORS:
+        pass
+
+def produce_image(function, *args):
+    '''
+    Return `function(*args)`, computed by the image workers, or by this thread when the request
+    is profiled (see `profiling`).
+    '''
+    if is_profiled():
+        return function(*args)
+    return bp.config[IMAGE_POOL].run(function, *args)
+
+def send_view_image(document, view, params, produce):
+    '''
+    Send an image computed from a view of a document by `produce()`, which returns
+    `(image_data, mimetype)` and may raise the errors of `get_image_from_view` and
+    `ImageWorkers.run`.
+    Images are served from the disk cache when available, and revalidated with
+    `If-None-Match`/`If-Modified-Since` (the entity tag is the cache key, computed from
+    the document, the view and `params`). Profiled requests do not use the cache.
+    '''
+    try:
+        document_stat = get_document_stat(bp.config[DOC_PATH], document)
+        etag = image_key(document, view, document_stat, params)
+        if etag in request.if_none_match:
+            response = make_response("", 304)
+            response.set_etag(etag)
+            return response
+
+        image_cache = bp.config[IMAGE_CACHE]
+        if image_cache is not None and not is_profiled():
+            data, mimetype = image_cache.open_or_create(etag, produce)
+        else:
+            image_data, mimetype = produce()
+            data = BytesIO(image_data)
+    except ImageWorkersBusyError as err:
+        response = make_response("Too many images being produced, retry later", 503)
+        response.headers["Retry-After"] = str(err.retry_after)
+        return response
+    except DocumentReadError:
+        return "Error reading the document", 500
+    except DocumentNotFoundError:
+        abort(404, "Document not found.")
+    except InvalidViewIndexError:
+        abort(404, "View is not available.")
+    except InvalidTileIndexError:
+        abort(404, "Tile is not available.")
+    return send_file(data, mimetype=mimetype, etag=etag, last_modified=document_stat.st_mtime, conditional=True)
+
+
+def gzip_member(page):
+    '''
+    Wrap a `DeflatedPage` in a gzip member, without recompressing it.
+    Gzip streams made of several members are decoded as the concatenation of their members.
+    '''
+    return _GZIP_MEMBER_HEADER + page.data + struct.pack("<II", page.crc, page.size & 0xffffffff)
+
+def parse_views(views_arg):
+    '''
+    Parse a list of views and ranges of views, such as `1,3,5-9`.
+    '''
+    views = []
+    try:
+        for part in (views_arg or "").split(","):
+            first, _, last = part.partition("-")
+            first = int(first)
+            last = int(last) if last else first
+            # Views are 1-indexed
+            if not 1 <= first <= last:
+                raise ValueError(part)
+            if len(views) + last - first + 1 > _MAX_BATCH_VIEWS:
+                abort(400, f"Too many views (at most {_MAX_BATCH_VIEWS}).")
+            views.extend(range(first, last + 1))
+    except ValueError:
+        abort(400, f"Invalid list of views '{views_arg}'.")
+    return views
+
+def view_page_size(document, view):
+    '''
+    Return the `[width, height]` of the image of a view of a document, from the catalog.
+    '''
+    document_path = pu.get_stem_with_extension(document, "pdf")
+    try:
+        page_sizes = bp.config[CATALOG].get(document_path)["page_sizes"]
+    except DocumentReadError:
+        abort(500, description="Error reading document.")
+    except DocumentNotFoundError:
+        abort(404, "Document not found.")
+    if not 1 <= view <= len(page_sizes):
+        abort(404, "View is not available.")
+    return page_sizes[view - 1]
+
+def requested_version(document, view):
+    '''
+    Return the version of a view required by the `If-Match` header of the request, if any.
+    '''
+    if request.if_match.star_tag:
+        return "*"
+    if not request.if_match:
+        return None
+    versions = set(view_version(tag) for tag in request.if_match)
+    if len(versions) > 1:
+        # Any of them may match: use the current one if listed
+        try:
+            current = bp.config[ANNOTATIONS].version(document, view)
+            if current in versions:
+                return current
+        except (AnnotationsNotFoundError, InvalidDocumentNameError):
+            pass
+    return next(iter(versions))
+
+def prepare_content(content):
+    '''
+    Prepare the content of a view before it is saved: its entries are sorted in reading order
+    when `ANNOT_SORT_ON_SAVE` is set.
+    '''
+    if bp.config.get(ANNOT_SORT_ON_SAVE):
+        return sort_page(content)
+    return content
+
+def index_saved(response, document, pages, versions):
+    '''
+    Index saved views once `response` is sent (`pages` maps the views to their content, and
+    `versions` to their version), see `SpatialIndex.index_saved` and `SearchIndex.index_saved`.
+    '''
+    indexes = [index for index in (bp.config.get(SPATIAL_INDEX), bp.config.get(SEARCH_INDEX)) if index is not None]
+    if len(indexes) == 0:
+        return
+    # Indexed as they are loaded from the storage
+    pages = {view: (normalize_page(pages[view]), version) for view, version in versions.items()}
+
+    def index():
+        for search_index in indexes:
+            search_index.index_saved(document, pages)
+    response.call_on_close(index)
+
+def view_version(etag):
+    '''
+    Return the version of a view from the entity tag of one of its representations.
+    '''
+    return etag[:-len(_GZIP_ETAG_SUFFIX)] if etag.endswith(_GZIP_ETAG_SUFFIX) else etag
+
 def turn_to_bool(action):
     if not action or action == '0':
         return False
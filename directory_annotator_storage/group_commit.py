@@ -0,0 +1,126 @@
+'''
+Group commit of concurrent writes.
+
+Concurrent saves to the same document serialize on the lock of the document, and each pays for
+its own write and `fsync`. Instead, writes to a same key are queued: the first writer becomes the
+leader, waits for a short window, then commits all the queued writes at once. The first of the
+writes queued in the meantime (if any) then becomes the leader of the next batch, so that each
+leader commits a single batch and returns. Every writer returns when the commit which includes
+its write is durable.
+'''
+
+import threading
+import time
+
+
+class _Write:
+    __slots__ = ("item", "done", "lead", "result", "error")
+
+    def __init__(self, item):
+        self.item = item
+        # Set when committed, or when the write must lead the next batch (`lead`)
+        self.done = threading.Event()
+        self.lead = False
+        self.result = None
+        self.error = None
+
+
+class _Queue:
+    __slots__ = ("writes", "committing")
+
+    def __init__(self):
+        self.writes = []
+        self.committing = False
+
+
+class GroupCommitter:
+    '''
+    Coalesce concurrent writes to a same key into batches.
+
+    Args:
+        window (float): Time, in seconds, the leader waits for other writes before committing
+    '''
+    def __init__(self, window: float):
+        self.window = window
+        self._lock = threading.Lock()
+        self._queues = {}  # key -> _Queue
+        self.commits = 0
+        self.writes = 0
+        self.max_batch = 0
+        self.lock_wait = 0.0
+
+    def submit(self, key, item, commit):
+        '''
+        Write `item` with the other writes to `key`, and return its result once committed.
+        `commit(key, items)` writes a batch at once, and returns `(results, lock_wait)`: a result
+        for each item, and the time spent waiting for the lock of `key`.
+        The exception raised by `commit`, if any, is raised by all the writes of the batch;
+        a result which is an exception is raised by its write only.
+        '''
+        write = _Write(item)
+        with self._lock:
+            queue = self._queues.setdefault(key, _Queue())
+            queue.writes.append(write)
+            leader = not queue.committing
+            queue.committing = True
+        if leader:
+            if self.window > 0:
+                time.sleep(self.window)
+        else:
+            write.done.wait()
+        if leader or write.lead:
+            # The writes queued during the previous commit are already waiting: no window
+            self._lead(key, queue, commit)
+        if write.error is not None:
+            raise write.error
+        return write.result
+
+    def info(self) -> dict:
+        '''
+        Return statistics: number of `commits` and `writes`, `mean_batch` and `max_batch` sizes,
+        and total `lock_wait` time (seconds).
+        '''
+        with self._lock:
+            return {
+                "commits": self.commits,
+                "writes": self.writes,
+                "mean_batch": self.writes / self.commits if self.commits > 0 else 0.0,
+                "max_batch": self.max_batch,
+                "lock_wait": self.lock_wait,
+            }
+
+    def _lead(self, key, queue: _Queue, commit):
+        # Commit the queued writes (including the leader's), then hand over to the next writer
+        with self._lock:
+            batch = queue.writes
+            queue.writes = []
+        lock_wait = 0.0
+        try:
+            results, lock_wait = commit(key, [write.item for write in batch])
+            for write, result in zip(batch, results):
+                if isinstance(result, BaseException):
+                    write.error = result
+                else:
+                    write.result = result
+        except BaseException as err:
+            for write in batch:
+                write.error = err
+        finally:
+            next_leader = None
+            with self._lock:
+                self.commits += 1
+                self.writes += len(batch)
+                self.max_batch = max(self.max_batch, len(batch))
+                self.lock_wait += lock_wait
+                if len(queue.writes) > 0:
+                    next_leader = queue.writes[0]
+                    next_leader.lead = True
+                else:
+                    queue.committing = False
+                    if self._queues.get(key) is queue:
+                        del self._queues[key]
+            # Waiters must never be left blocked
+            for write in batch:
+                write.done.set()
+            if next_leader is not None:
+                next_leader.done.set()
@@ -0,0 +1,176 @@
+'''
+Content-addressed disk cache of encoded page images, shared by all worker processes.
+
+Each entry is a file named after a hash of the document, the view, the state of the PDF file
+(modification time and size) and the output parameters: a modified document never hits stale
+entries. The cache is bounded by a byte budget: least recently used entries (by file
+modification time, refreshed on each hit) are removed first. Each process scans the cache to
+evict entries once it has written a tenth of the budget since its last scan, so the budget can
+be exceeded by that much per process.
+'''
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from io import BytesIO
+
+from filelock import FileLock, Timeout
+
+# Bump when the content produced for the same key changes
+_CACHE_FORMAT = 1
+
+# When the budget is exceeded, evict entries until this fraction of the budget is used
+_LOW_WATERMARK = 0.9
+
+# File suffix of the cached entries, for each supported MIME type
+_SUFFIXES = {
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/jp2": ".jp2",
+}
+
+
+def image_key(document_name: str, view: int, document_stat: os.stat_result, params: dict = None) -> str:
+    '''
+    Compute the cache key (also usable as an HTTP entity tag) of an image.
+
+    Args:
+        document_name (str): Name of the document (e.g. "Didot_1851a.pdf")
+        view (int): View of the document (1-indexed)
+        document_stat (os.stat_result): State of the PDF file
+        params (dict): Output parameters (format, size, etc.)
+
+    Returns:
+        str: Hexadecimal digest
+    '''
+    description = [_CACHE_FORMAT, document_name, view, document_stat.st_mtime_ns, document_stat.st_size, params or {}]
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+class ImageCache:
+    '''
+    Disk cache of encoded images.
+
+    Args:
+        cache_dir (str): Directory where images are stored (created if needed)
+        max_bytes (int): Budget for the total size of the images
+    '''
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._written = 0  # bytes written since the last eviction scan
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry_path(self, key: str, mimetype: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + _SUFFIXES[mimetype])
+
+    def get(self, key: str):
+        '''
+        Return `(path, mimetype)` for the cached file of `key`, or `None` if absent.
+        '''
+        for mimetype in _SUFFIXES:
+            path = self._entry_path(key, mimetype)
+            try:
+                os.utime(path)  # mark as recently used
+            except FileNotFoundError:
+                continue
+            return path, mimetype
+        return None
+
+    def get_or_create(self, key: str, produce) -> tuple:
+        '''
+        Return `(path, mimetype)` for the cached file of `key`, calling `produce()` to get its
+        content as `(data, mimetype)` on a miss. Concurrent misses on the same key, from any process,
+        wait for the first one instead of producing the content again.
+        Exceptions raised by `produce` are propagated and nothing is cached.
+        '''
+        entry = self.get(key)
+        if entry is not None:
+            return entry
+
+        lock_path = os.path.join(self.cache_dir, key[:2], key + ".lock")
+        os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+        with FileLock(lock_path):
+            entry = self.get(key)
+            if entry is not None:
+                return entry
+            data, mimetype = produce()
+            path = self._entry_path(key, mimetype)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+            try:
+                with os.fdopen(fd, "wb") as tmp_file:
+                    tmp_file.write(data)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+        with self._lock:
+            self._written += len(data)
+            scan = self._written >= self.max_bytes * (1 - _LOW_WATERMARK)
+            if scan:
+                self._written = 0
+        if scan:
+            self.evict()
+        return path, mimetype
+
+    def open_or_create(self, key: str, produce) -> tuple:
+        '''
+        Return `(file, mimetype)`, where `file` is the cached file of `key` open for reading
+        (binary), created as by `get_or_create`. Once open, the entry can be evicted safely; if it
+        is evicted before, the content is produced again (and sent without being cached).
+        '''
+        path, mimetype = self.get_or_create(key, produce)
+        try:
+            return open(path, "rb"), mimetype
+        except FileNotFoundError:
+            data, mimetype = produce()
+            return BytesIO(data), mimetype
+
+    def usage(self) -> int:
+        '''
+        Return the total size of the cached images, in bytes.
+        '''
+        return sum(size for _, _, size in self._entries())
+
+    def evict(self):
+        '''
+        Remove least recently used entries until the cache fits its budget. The lock files of the
+        entries are kept, so that concurrent misses on an evicted entry still produce it once.
+        Only one process evicts at a time; others skip eviction instead of waiting.
+        '''
+        try:
+            with FileLock(os.path.join(self.cache_dir, ".evict.lock"), timeout=0):
+                entries = list(self._entries())
+                total = sum(size for _, _, size in entries)
+                if total <= self.max_bytes:
+                    return
+                entries.sort(key=lambda e: e[1])
+                for path, _, size in entries:
+                    if total <= self.max_bytes * _LOW_WATERMARK:
+                        break
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        continue
+                    total -= size
+        except Timeout:
+            pass
+
+    def _entries(self):
+        # Yields (path, mtime, size) for each cached image
+        with os.scandir(self.cache_dir) as top:
+            for sub in top:
+                if not sub.is_dir():
+                    continue
+                with os.scandir(sub.path) as it:
+                    for entry in it:
+                        if entry.name.startswith(".") or entry.name.endswith(".lock"):
+                            continue
+                        try:
+                            stat = entry.stat()
+                        except FileNotFoundError:
+                            continue
+                        yield entry.path, stat.st_mtime, stat.st_size
@@ -0,0 +1,159 @@
+'''
+Resized variants and tiles of the page images, for thumbnails and deep zoom.
+
+Tiles follow the usual pyramid layout: level 0 is the full resolution image, and each level
+halves the size of the previous one, down to a single tile. Tiles of a level are addressed by
+column and row, from the top-left corner.
+'''
+
+import math
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+from directory_annotator_storage.backend_documents import get_decoded_image_from_view, get_document_stat
+from directory_annotator_storage.instrumentation import timer
+
+# Maximum size (of the largest side) of the resized variants of the page images
+IMAGE_VARIANTS = {
+    "thumbnail": 256,
+    "medium": 1024,
+}
+
+# Quality of the JPEG encoding of variants and tiles
+_JPEG_QUALITY = 85
+
+# Memory budget (bytes, estimated from the pixels) of the decoded (and scaled) pages kept by each
+# process, to cut consecutive tile requests
+_DECODED_CACHE_BYTES = 64 * 1024 ** 2
+
+
+class InvalidTileIndexError(RuntimeError):
+    pass
+
+
+def tile_levels(width: int, height: int, tile_size: int) -> int:
+    '''
+    Return the number of levels of the tile pyramid of an image.
+    '''
+    return max(0, math.ceil(math.log2(max(width, height) / tile_size))) + 1
+
+
+def level_size(width: int, height: int, level: int) -> tuple:
+    '''
+    Return the size of an image scaled for a given level of its tile pyramid.
+    '''
+    scale = 2 ** level
+    return max(1, math.ceil(width / scale)), max(1, math.ceil(height / scale))
+
+
+def _encode_jpeg(pil_image) -> bytes:
+    if pil_image.mode not in ("L", "RGB"):
+        pil_image = pil_image.convert("RGB")
+    out = BytesIO()
+    with timer("jpeg_encode"):
+        pil_image.save(out, format="JPEG", quality=_JPEG_QUALITY)
+    return out.getvalue()
+
+
+_decoded_lock = threading.Lock()
+_decoded_pages = OrderedDict()  # (directory, name, mtime_ns, size, view, level) -> PIL image
+_decoded_bytes = 0
+
+
+def _image_bytes(pil_image) -> int:
+    return pil_image.width * pil_image.height * len(pil_image.getbands())
+
+
+def _cache_page(key, pil_image):
+    global _decoded_bytes
+    size = _image_bytes(pil_image)
+    if size > _DECODED_CACHE_BYTES:
+        return
+    with _decoded_lock:
+        previous = _decoded_pages.pop(key, None)
+        if previous is not None:
+            _decoded_bytes -= _image_bytes(previous)
+        _decoded_pages[key] = pil_image
+        _decoded_bytes += size
+        while _decoded_bytes > _DECODED_CACHE_BYTES:
+            _, evicted = _decoded_pages.popitem(last=False)
+            _decoded_bytes -= _image_bytes(evicted)
+
+
+def _scaled_page(documents_dir: str, document_name: str, view: int, level: int):
+    stat = get_document_stat(documents_dir, document_name)
+    page_key = (documents_dir, document_name, stat.st_mtime_ns, stat.st_size, view)
+    source, source_level = None, None
+    with _decoded_lock:
+        # The level itself, or else the closest cached level above it, to scale it down
+        for cached_level in range(level, -1, -1):
+            if page_key + (cached_level,) in _decoded_pages:
+                _decoded_pages.move_to_end(page_key + (cached_level,))
+                source, source_level = _decoded_pages[page_key + (cached_level,)], cached_level
+                break
+    if source_level == level:
+        return source
+
+    if source is None:
+        source, source_level = get_decoded_image_from_view(documents_dir, document_name, view), 0
+        source.load()
+        _cache_page(page_key + (0,), source)
+        if level == 0:
+            return source
+    with timer("image_resize"):
+        # Sizes of the levels are rounded up, so they can be computed from any level above
+        pil_image = source.resize(level_size(source.width, source.height, level - source_level))
+    _cache_page(page_key + (level,), pil_image)
+    return pil_image
+
+
+def get_variant_from_view(documents_dir: str, document_name: str, view: int, variant: str) -> tuple:
+    '''
+    Return a resized variant of the image of a view of a document, encoded as JPEG.
+
+    Args:
+        variant (str): One of the keys of `IMAGE_VARIANTS`
+
+    Raises:
+        KeyError: If the variant is unknown
+        Errors of `backend_documents.get_image_from_view`
+
+    Returns:
+        tuple: `(image_data, mimetype)`
+    '''
+    max_size = IMAGE_VARIANTS[variant]
+    pil_image = get_decoded_image_from_view(documents_dir, document_name, view)
+    with timer("image_resize"):
+        pil_image.thumbnail((max_size, max_size))
+    return _encode_jpeg(pil_image), "image/jpeg"
+
+
+def get_tile_from_view(documents_dir: str, document_name: str, view: int,
+                       level: int, column: int, row: int, tile_size: int, page_size: tuple) -> tuple:
+    '''
+    Return a tile of the image of a view of a document, encoded as JPEG.
+    Tiles on the right and bottom borders may be smaller than `tile_size`.
+
+    Args:
+        page_size (tuple): `(width, height)` of the image of the view (as recorded by the
+            catalog), used to check the tile before decoding the page
+
+    Raises:
+        InvalidTileIndexError: If the level, column or row is out of the pyramid
+        Errors of `backend_documents.get_image_from_view`
+
+    Returns:
+        tuple: `(image_data, mimetype)`
+    '''
+    width, height = page_size
+    if not 0 <= level < tile_levels(width, height, tile_size) or column < 0 or row < 0:
+        raise InvalidTileIndexError()
+    level_width, level_height = level_size(width, height, level)
+    x0, y0 = column * tile_size, row * tile_size
+    if x0 >= level_width or y0 >= level_height:
+        raise InvalidTileIndexError()
+
+    pil_image = _scaled_page(documents_dir, document_name, view, level)
+    box = (x0, y0, min(x0 + tile_size, pil_image.width), min(y0 + tile_size, pil_image.height))
+    return _encode_jpeg(pil_image.crop(box)), "image/jpeg"
@@ -0,0 +1,161 @@
+'''
+Pool of processes producing the page images.
+
+Decoding pages (pikepdf) and encoding images (PIL) is CPU-bound: done by the request handlers,
+a few image requests would keep all the workers of the application busy, and the annotation
+requests would wait behind them. Images are produced by a bounded pool of separate processes
+instead. A job is admitted only while fewer than `workers + queue_limit` jobs are running or
+waiting: beyond, it is rejected at once (`ImageWorkersBusyError`, sent as
+`503 Service Unavailable` with `Retry-After`). Each job has a timeout, counted from the moment
+a process begins to run it: as the job cannot be cancelled, its process is killed (the other jobs
+go on, see `worker_pool`).
+Background jobs (prefetching) never compete with the requests: they are only admitted while the
+pool is idle, and do not count in the admission of the other jobs.
+'''
+
+import math
+import threading
+import time
+
+from directory_annotator_storage.backend_documents import DocumentReadError, configure_pdf_cache
+from directory_annotator_storage.instrumentation import configure_metrics, metrics_directory
+from directory_annotator_storage.rasterizer import configure_rasterizer, limit_memory
+from directory_annotator_storage.worker_pool import JobTimeoutError, WorkerPool, WorkerPoolError
+
+# Weight of the last job in the mean duration of the jobs
+_DURATION_SMOOTHING = 0.2
+
+
+class ImageWorkersBusyError(RuntimeError):
+    '''
+    All the workers are busy and the queue is full: retry in `retry_after` seconds.
+    '''
+    def __init__(self, retry_after: int):
+        super().__init__(f"Image workers are busy, retry in {retry_after} s.")
+        self.retry_after = retry_after
+
+
+def _init_worker(pdf_cache_size: int, raster_settings: dict, metrics_path: str):
+    # Runs in the worker processes. They render pages themselves: they are killed on timeout,
+    # and limited as the processes of the rasterizer would be
+    limit_memory(raster_settings["memory_limit"])
+    configure_pdf_cache(pdf_cache_size)
+    configure_rasterizer(**dict(raster_settings, workers=0))
+    configure_metrics(metrics_path)
+
+
+class ImageWorkers:
+    '''
+    Bounded pool of processes running image jobs.
+
+    Args:
+        workers (int): Number of processes (0 to run the jobs in the calling thread)
+        queue_limit (int): Maximum number of jobs waiting for a process
+        timeout (float): Maximum duration, in seconds, of a job (waiting time excluded)
+        pdf_cache_size (int): Maximum number of PDF files kept open by each process
+        raster_settings (dict): Arguments of `configure_rasterizer` for the processes
+    '''
+    def __init__(self, workers: int, queue_limit: int, timeout: float, pdf_cache_size: int,
+                 raster_settings: dict):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.timeout = timeout
+        self._initargs = (pdf_cache_size, raster_settings)
+        self._lock = threading.Lock()
+        self._pool = None
+        self.pending = 0
+        self.background = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.mean_duration = 0.0
+
+    # Public members
+    # -----------------------------------------------------------------------------------------
+
+    def run(self, function, *args, background: bool = False):
+        '''
+        Return `function(*args)`, computed by a worker process. `function` and its arguments
+        must be picklable. A `background` job is only run when no other job is pending
+        (it is not counted as rejected otherwise).
+
+        Raises:
+            ImageWorkersBusyError: If the pool is saturated (or busy, for a `background` job)
+            DocumentReadError: If the job timed out, or its process crashed
+            Errors raised by `function`
+        '''
+        if self.workers <= 0:
+            return function(*args)
+        with self._lock:
+            if background:
+                if self.pending > 0:
+                    raise ImageWorkersBusyError(self._retry_after())
+                self.background += 1
+            elif self.pending - self.background >= self.workers + self.queue_limit:
+                self.rejected += 1
+                raise ImageWorkersBusyError(self._retry_after())
+            self.pending += 1
+            pool = self._get_pool()
+        start = time.monotonic()
+        completed = False
+        try:
+            result = pool.run(function, *args, timeout=self.timeout)
+            completed = True
+            return result
+        except JobTimeoutError:
+            with self._lock:
+                self.timeouts += 1
+            raise DocumentReadError(f"Image job timed out after {self.timeout} s.")
+        except WorkerPoolError:
+            raise DocumentReadError("Image worker crashed.")
+        except Exception:
+            # Raised by `function`
+            completed = True
+            raise
+        finally:
+            with self._lock:
+                self.pending -= 1
+                if background:
+                    self.background -= 1
+                if completed:
+                    self.completed += 1
+                    duration = time.monotonic() - start
+                    self.mean_duration += _DURATION_SMOOTHING * (duration - self.mean_duration)
+
+    def info(self) -> dict:
+        '''
+        Return statistics: number of `workers`, `queue_limit`, `pending` jobs (running or
+        waiting, `background` ones included), `completed`, `rejected` and timed out (`timeouts`)
+        jobs, and `mean_duration` of the jobs (seconds).
+        '''
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queue_limit": self.queue_limit,
+                "pending": self.pending,
+                "background": self.background,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "timeouts": self.timeouts,
+                "mean_duration": self.mean_duration,
+            }
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+            self._pool = None
+
+    # Internal definitions
+    # -----------------------------------------------------------------------------------------
+
+    def _get_pool(self):
+        # Must be called with the lock held
+        if self._pool is None:
+            # Spawned: the processes do not inherit the open files and locks of the threads
+            self._pool = WorkerPool(self.workers, _init_worker, self._initargs + (metrics_directory(),), "spawn")
+        return self._pool
+
+    def _retry_after(self) -> int:
+        # Must be called with the lock held: time for the jobs ahead to complete
+        return max(1, math.ceil(self.mean_duration * self.pending / self.workers))
@@ -0,0 +1,374 @@
+'''
+Metrics of the application: counters, histograms and gauges, exported in the Prometheus text
+format (see the `metrics` blueprint).
+
+Each process records its metrics in memory and, when a metrics directory is configured (see
+`configure_metrics`), writes them to a file of this directory `_FLUSH_INTERVAL` seconds after
+they changed (from a background thread), so that the metrics of all the workers of the
+application (and of their image workers) are aggregated when they are exported. The counters and
+histograms of the processes which exited are merged into an archive file, so that they never
+decrease; their gauges are dropped.
+'''
+
+import atexit
+import json
+import logging
+import math
+import os
+import socket
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from filelock import FileLock
+
+logger = logging.getLogger(__name__)
+
+# Buckets of the histograms of durations (seconds) and of sizes (bytes)
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = tuple(256 * 4 ** i for i in range(9))  # 256 B to 16 MiB
+
+# Metrics of the application: name -> (type, help, buckets of the histograms)
+METRICS = {
+    "soduco_request_duration_seconds": (
+        "histogram", "Duration of the requests, by route, method and status.", TIME_BUCKETS),
+    "soduco_stage_duration_seconds": (
+        "histogram", "Duration of the stages of the production of images and of the storage of annotations.",
+        TIME_BUCKETS),
+    "soduco_lock_wait_seconds": (
+        "histogram", "Time spent waiting for the lock of an annotation archive.", TIME_BUCKETS),
+    "soduco_annotation_write_bytes": (
+        "histogram", "Bytes written by a save (appended to the log, or upserted), or by a compaction.", SIZE_BUCKETS),
+    "soduco_pdf_pages_decoded_total": (
+        "counter", "Page images read from the PDF files: sent as stored, decoded, or rasterized.", None),
+}
+
+# Time, in seconds, between a change of the metrics of a process and their write
+_FLUSH_INTERVAL = 1.0
+
+_ARCHIVE_NAME = "archive.json"
+
+
+class _Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._directory = None
+        self._collectors = {}  # prefix -> (collect, gauge fields, counter fields)
+        self._reset()
+
+    def _reset(self):
+        # Must be called with the lock held. A forked child does not report the metrics of its parent
+        self._pid = os.getpid()
+        self._counters = {}    # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [count by bucket (+Inf last), sum]
+        self._flush_scheduled = False
+
+    def configure(self, directory: str):
+        with self._lock:
+            self._directory = directory
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def directory(self) -> str:
+        return self._directory
+
+    def increment(self, name: str, value: float, labels: dict):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            self._counters[key] = self._counters.get(key, 0) + value
+        self._maybe_flush()
+
+    def observe(self, name: str, value: float, labels: dict):
+        buckets = METRICS[name][2]
+        key = (name, _labels_key(labels))
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * (len(buckets) + 1), 0.0]
+            histogram[0][_bucket_index(buckets, value)] += 1
+            histogram[1] += value
+        self._maybe_flush()
+
+    def register_collector(self, prefix: str, collect, fields: tuple, counters: tuple):
+        with self._lock:
+            self._collectors[prefix] = (collect, fields, counters)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            counters = [[name, dict(labels), value] for (name, labels), value in self._counters.items()]
+            histograms = [[name, dict(labels), list(counts), total]
+                          for (name, labels), (counts, total) in self._histograms.items()]
+            collectors = list(self._collectors.items())
+        gauges = []
+        for prefix, (collect, fields, counter_fields) in collectors:
+            try:
+                values = collect()
+            except Exception:
+                logger.exception("Cannot collect the metrics \"%s\".", prefix)
+                continue
+            gauges.extend([f"soduco_{prefix}_{field}", {}, values[field]] for field in fields if field in values)
+            counters.extend([f"soduco_{prefix}_{field}_total", {}, values[field]]
+                            for field in counter_fields if field in values)
+        return {"counters": counters, "histograms": histograms, "gauges": gauges}
+
+    def flush(self):
+        directory = self._directory
+        if directory is None or not os.path.isdir(directory):
+            # Not configured, or removed (such as a temporary directory, before the exit)
+            return
+        data = self.snapshot()
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+            with os.fdopen(fd, "w") as tmp_file:
+                json.dump(data, tmp_file)
+            os.replace(tmp_path, os.path.join(directory, _process_file_name(os.getpid())))
+        except OSError as err:
+            logger.warning("Cannot write the metrics to \"%s\": %s", directory, err)
+
+    def _maybe_flush(self):
+        if self._directory is None:
+            return
+        with self._lock:
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+        flusher = threading.Timer(_FLUSH_INTERVAL, self._scheduled_flush)
+        flusher.daemon = True
+        flusher.start()
+
+    def _scheduled_flush(self):
+        with self._lock:
+            self._flush_scheduled = False
+        self.flush()
+
+
+_registry = _Registry()
+atexit.register(_registry.flush)
+
+
+# Public members
+# =============================================================================================
+
+def configure_metrics(directory: str):
+    '''
+    Set the directory, shared by all the processes of the application, where the metrics of
+    this process are written (`None` to keep them in memory only).
+    '''
+    _registry.configure(directory)
+
+
+def metrics_directory() -> str:
+    '''
+    Return the directory where the metrics of this process are written, or `None`.
+    '''
+    return _registry.directory()
+
+
+def increment(name: str, value: float = 1, **labels):
+    '''
+    Add `value` to the counter `name` (see `METRICS`) with the given labels.
+    '''
+    _registry.increment(name, value, labels)
+
+
+def observe(name: str, value: float, **labels):
+    '''
+    Record `value` in the histogram `name` (see `METRICS`) with the given labels.
+    '''
+    _registry.observe(name, value, labels)
+
+
+@contextmanager
+def timer(stage: str):
+    '''
+    Record the duration of the block in `soduco_stage_duration_seconds`, for `stage`
+    (whether it succeeds or not).
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _registry.observe("soduco_stage_duration_seconds", time.perf_counter() - start, {"stage": stage})
+
+
+def register_collector(prefix: str, collect, fields: tuple, counters: tuple = ()):
+    '''
+    Export `fields` of the statistics returned by `collect()` (such as `pdf_cache_info`) as the
+    gauges `soduco_<prefix>_<field>`, and `counters` (the statistics which only grow) as the
+    counters `soduco_<prefix>_<field>_total`, summed over the processes. When `counters` include
+    `hits` and `misses`, the hit ratio is exported as `soduco_<prefix>_hit_ratio`. A collector
+    registered with the same prefix is replaced.
+    '''
+    _registry.register_collector(prefix, collect, fields, counters)
+
+
+def export() -> str:
+    '''
+    Return the metrics of all the processes, in the Prometheus text format.
+    '''
+    _registry.flush()
+    directory = _registry.directory()
+    if directory is None:
+        snapshots = [_registry.snapshot()]
+    else:
+        snapshots = _read_snapshots(directory)
+    return _format(_aggregate(snapshots))
+
+
+# Internal definitions
+# =============================================================================================
+
+def _labels_key(labels: dict) -> tuple:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _bucket_index(buckets: tuple, value: float) -> int:
+    for i, bound in enumerate(buckets):
+        if value <= bound:
+            return i
+    return len(buckets)
+
+
+def _process_file_name(pid: int) -> str:
+    return f"{socket.gethostname()}-{pid}.json"
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _read_json(path: str):
+    try:
+        with open(path) as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError):
+        return None
+
+
+def _read_snapshots(directory: str) -> list:
+    '''
+    Read the metrics of the processes, after archiving the metrics of the processes of this host
+    which exited.
+    '''
+    host_prefix = socket.gethostname() + "-"
+    archive_path = os.path.join(directory, _ARCHIVE_NAME)
+    with FileLock(archive_path + ".lock"):
+        dead = []
+        for name in os.listdir(directory):
+            pid = name[len(host_prefix):-len(".json")]
+            if name.startswith(host_prefix) and name.endswith(".json") and pid.isdigit() \
+                    and not _is_alive(int(pid)):
+                dead.append(os.path.join(directory, name))
+        if len(dead) > 0:
+            archived = [_read_json(path) for path in [archive_path] + dead]
+            archive = _aggregate([data for data in archived if data is not None], gauges=False)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+            with os.fdopen(fd, "w") as tmp_file:
+                json.dump(archive, tmp_file)
+            os.replace(tmp_path, archive_path)
+            for path in dead:
+                os.remove(path)
+        snapshots = []
+        for name in os.listdir(directory):
+            if name.endswith(".json") and not name.startswith(".tmp-"):
+                data = _read_json(os.path.join(directory, name))
+                if data is not None:
+                    snapshots.append(data)
+    return snapshots
+
+
+def _aggregate(snapshots: list, gauges: bool = True) -> dict:
+    '''
+    Sum the metrics of several processes (each as returned by `_Registry.snapshot`).
+    '''
+    counters = {}
+    histograms = {}
+    gauge_values = {}
+    for data in snapshots:
+        for name, labels, value in data.get("counters", []):
+            key = (name, _labels_key(labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, counts, total in data.get("histograms", []):
+            key = (name, _labels_key(labels))
+            if key not in histograms:
+                histograms[key] = [list(counts), total]
+            elif len(histograms[key][0]) == len(counts):
+                histograms[key][0] = [a + b for a, b in zip(histograms[key][0], counts)]
+                histograms[key][1] += total
+        if gauges:
+            for name, labels, value in data.get("gauges", []):
+                key = (name, _labels_key(labels))
+                gauge_values[key] = gauge_values.get(key, 0) + value
+    return {
+        "counters": [[name, dict(labels), value] for (name, labels), value in sorted(counters.items())],
+        "histograms": [[name, dict(labels), counts, total]
+                       for (name, labels), (counts, total) in sorted(histograms.items())],
+        "gauges": [[name, dict(labels), value] for (name, labels), value in sorted(gauge_values.items())],
+    }
+
+
+def _format_labels(labels: dict, **extra) -> str:
+    labels = dict(labels, **extra)
+    if len(labels) == 0:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+               for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if isinstance(value, float) and math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value)
+
+
+def _format(metrics: dict) -> str:
+    lines = []
+    described = set()
+
+    def describe(name, metric_type, help_text):
+        if name not in described:
+            described.add(name)
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+
+    for name, labels, counts, total in metrics["histograms"]:
+        metric_type, help_text, buckets = METRICS.get(name, ("histogram", "", None))
+        if buckets is None or len(counts) != len(buckets) + 1:
+            continue
+        describe(name, metric_type, help_text)
+        cumulated = 0
+        for bound, count in zip(list(buckets) + [math.inf], counts):
+            cumulated += count
+            le = "+Inf" if math.isinf(bound) else repr(float(bound))
+            lines.append(f"{name}_bucket{_format_labels(labels, le=le)} {cumulated}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(total)}")
+        lines.append(f"{name}_count{_format_labels(labels)} {cumulated}")
+    for name, labels, value in metrics["counters"]:
+        describe(name, "counter", METRICS.get(name, ("counter", "Sum over the processes."))[1])
+        lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+    gauges = {name: value for name, labels, value in metrics["gauges"]}
+    for name, value in gauges.items():
+        describe(name, "gauge", "Sum over the processes.")
+        lines.append(f"{name} {_format_value(value)}")
+    totals = {name: value for name, labels, value in metrics["counters"] if len(labels) == 0}
+    for name in totals:
+        if name.endswith("_hits_total") and name[:-len("_hits_total")] + "_misses_total" in totals:
+            prefix = name[:-len("_hits_total")]
+            requests = totals[name] + totals[prefix + "_misses_total"]
+            describe(prefix + "_hit_ratio", "gauge", "Ratio of the hits, over the processes.")
+            lines.append(f"{prefix}_hit_ratio {_format_value(totals[name] / requests if requests > 0 else 0.0)}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,160 @@
+'''
+Partial updates of annotation pages.
+
+Two formats are supported:
+- JSON Patch (RFC 6902): a list of operations (`add`, `remove`, `replace`, `move`, `copy`, `test`)
+  whose paths are JSON pointers into the page (a list of elements), e.g. `/12/checked`;
+- keyed diffs: `{"<index>": {"<field>": <value>}}` updates fields of the elements at these
+  indexes in the page (a `null` value removes the field).
+Patches are applied to a copy of the page: the page is left unchanged when a patch fails.
+'''
+
+import copy
+
+
+class InvalidPatchError(ValueError):
+    '''
+    The patch is malformed.
+    '''
+
+
+class PatchConflictError(ValueError):
+    '''
+    The patch cannot be applied to the page (missing path, failed `test` operation...).
+    '''
+
+
+# Public members
+# =============================================================================================
+
+def apply_json_patch(page, operations):
+    '''
+    Return a copy of `page` with a JSON Patch (RFC 6902) applied.
+
+    Raises:
+        InvalidPatchError: If the patch is malformed
+        PatchConflictError: If the patch cannot be applied
+    '''
+    if not isinstance(operations, list):
+        raise InvalidPatchError("A JSON Patch must be a list of operations.")
+    page = copy.deepcopy(page)
+    for operation in operations:
+        if not isinstance(operation, dict) or not isinstance(operation.get("path"), str):
+            raise InvalidPatchError(f"Invalid operation {operation!r}.")
+        op = operation.get("op")
+        path = _parse_pointer(operation["path"])
+        if op == "add":
+            page = _add(page, path, copy.deepcopy(_operand(operation, "value")))
+        elif op == "remove":
+            page, _ = _remove(page, path)
+        elif op == "replace":
+            page, _ = _remove(page, path)
+            page = _add(page, path, copy.deepcopy(_operand(operation, "value")))
+        elif op == "move":
+            from_path = _parse_pointer(_operand(operation, "from"))
+            if path[:len(from_path)] == from_path and path != from_path:
+                raise PatchConflictError("Cannot move a value into itself.")
+            page, value = _remove(page, from_path)
+            page = _add(page, path, value)
+        elif op == "copy":
+            value = _get(page, _parse_pointer(_operand(operation, "from")))
+            page = _add(page, path, copy.deepcopy(value))
+        elif op == "test":
+            if _get(page, path) != _operand(operation, "value"):
+                raise PatchConflictError(f"Test failed for '{operation['path']}'.")
+        else:
+            raise InvalidPatchError(f"Unknown operation {op!r}.")
+    return page
+
+
+def apply_keyed_diff(page, diff):
+    '''
+    Return a copy of `page` (a list of elements) with a keyed diff applied.
+
+    Raises:
+        InvalidPatchError: If the diff is malformed
+        PatchConflictError: If an index is out of the page
+    '''
+    if not isinstance(diff, dict) or not isinstance(page, list):
+        raise InvalidPatchError("A keyed diff must map element indexes to fields.")
+    page = list(page)
+    for key, fields in diff.items():
+        if not _is_digits(key) or not isinstance(fields, dict):
+            raise InvalidPatchError(f"Invalid change {key!r}: {fields!r}.")
+        index = int(key)
+        if index >= len(page) or not isinstance(page[index], dict):
+            raise PatchConflictError(f"No element at index {index}.")
+        element = copy.deepcopy(page[index])
+        for field, value in fields.items():
+            if value is None:
+                element.pop(field, None)
+            else:
+                element[field] = copy.deepcopy(value)
+        page[index] = element
+    return page
+
+
+# Internal definitions
+# =============================================================================================
+
+def _operand(operation: dict, name: str):
+    if name not in operation:
+        raise InvalidPatchError(f"Missing '{name}' in operation {operation!r}.")
+    return operation[name]
+
+
+def _is_digits(key: str) -> bool:
+    # ASCII only: `isdigit` accepts other digits (e.g. "²") which `int` rejects
+    return key.isascii() and key.isdigit()
+
+
+def _parse_pointer(pointer) -> list:
+    if not isinstance(pointer, str) or (pointer != "" and not pointer.startswith("/")):
+        raise InvalidPatchError(f"Invalid JSON pointer {pointer!r}.")
+    return [token.replace("~1", "/").replace("~0", "~") for token in pointer.split("/")[1:]]
+
+
+def _index(container: list, token: str, allow_end: bool = False) -> int:
+    if allow_end and token == "-":
+        return len(container)
+    if not _is_digits(token) or (token != "0" and token.startswith("0")):
+        raise PatchConflictError(f"Invalid array index '{token}'.")
+    index = int(token)
+    if index > len(container) or (index == len(container) and not allow_end):
+        raise PatchConflictError(f"Array index {index} out of range.")
+    return index
+
+
+def _get(document, path: list):
+    for token in path:
+        if isinstance(document, list):
+            document = document[_index(document, token)]
+        elif isinstance(document, dict) and token in document:
+            document = document[token]
+        else:
+            raise PatchConflictError(f"Path '/{'/'.join(path)}' does not exist.")
+    return document
+
+
+def _add(document, path: list, value):
+    if len(path) == 0:
+        return value
+    parent = _get(document, path[:-1])
+    if isinstance(parent, list):
+        parent.insert(_index(parent, path[-1], allow_end=True), value)
+    elif isinstance(parent, dict):
+        parent[path[-1]] = value
+    else:
+        raise PatchConflictError(f"Cannot add to a {type(parent).__name__}.")
+    return document
+
+
+def _remove(document, path: list):
+    if len(path) == 0:
+        return None, document
+    parent = _get(document, path[:-1])
+    if isinstance(parent, list):
+        return document, parent.pop(_index(parent, path[-1]))
+    if isinstance(parent, dict) and path[-1] in parent:
+        return document, parent.pop(path[-1])
+    raise PatchConflictError(f"Path '/{'/'.join(path)}' does not exist.")
@@ -0,0 +1,45 @@
+'''
+Metrics endpoint (Prometheus text format), unrestricted unless a token is configured.
+Also records the duration of every request of the application.
+'''
+
+import os
+import time
+
+from flask import Blueprint, Response, abort, g, request
+
+from directory_annotator_storage.constants_config import CACHE_PATH, METRICS_ENABLED, METRICS_TOKEN
+from directory_annotator_storage.instrumentation import configure_metrics, export, observe
+
+bp = Blueprint('metrics', __name__, url_prefix='/metrics')
+bp.config = {}
+
+@bp.record
+def record_config(setup_state):
+    bp.config = setup_state.app.config
+    cache_path = bp.config.get(CACHE_PATH)
+    # Without a shared directory, only the metrics of the process serving the request are exported
+    configure_metrics(os.path.join(cache_path, "metrics") if cache_path else None)
+
+@bp.before_app_request
+def start_timer():
+    g.metrics_start = time.perf_counter()
+
+@bp.after_app_request
+def record_request(response):
+    start = g.pop("metrics_start", None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        observe("soduco_request_duration_seconds", time.perf_counter() - start,
+                route=route, method=request.method, status=response.status_code)
+    return response
+
+# Scrapers request `/metrics`, answered without a redirection (and `/metrics/` too)
+@bp.route('', methods=['GET'], strict_slashes=False)
+def metrics():
+    if not bp.config.get(METRICS_ENABLED, True):
+        abort(404)
+    token = bp.config.get(METRICS_TOKEN)
+    if token and request.headers.get('Authorization') != token:
+        abort(403, "Invalid request token.")
+    return Response(export(), mimetype="text/plain; version=0.0.4")
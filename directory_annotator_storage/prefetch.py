@@ -0,0 +1,110 @@
+'''
+Speculative prefetch of the views following the one being read.
+
+Annotators mostly read a document sequentially: after serving view N, the next views are
+warmed (image and annotation caches) by a small pool of background threads. Prefetching is
+best-effort: jobs are dropped when the queue is full, when the reader moved elsewhere in the
+document, or when foreground requests are being served.
+'''
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Prefetcher:
+    '''
+    Background warmer of the views following the last view read in each document.
+
+    Args:
+        views_ahead (int): Number of views to warm after the view read
+        max_workers (int): Maximum number of views warmed concurrently
+        warmers (list): Callables `warm(document_name, view)`, called for each view to prefetch.
+            They must handle their own errors (e.g. a view past the end of the document).
+    '''
+    def __init__(self, views_ahead: int, max_workers: int, warmers: list):
+        self.views_ahead = views_ahead
+        self.max_workers = max_workers
+        self.warmers = warmers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        # Reentrant: future callbacks may run synchronously while the lock is held
+        self._lock = threading.RLock()
+        self._last_views = {}  # document_name -> last view read
+        self._pending = {}  # (document_name, view) -> future
+        self._foreground = 0
+        self.completed = 0
+        self.dropped = 0
+
+    # Public members
+    # -----------------------------------------------------------------------------------------
+
+    def foreground_started(self):
+        with self._lock:
+            self._foreground += 1
+
+    def foreground_finished(self):
+        with self._lock:
+            self._foreground -= 1
+
+    def schedule(self, document_name: str, view: int):
+        '''
+        Schedule the prefetch of the views following `view` in a document.
+        Pending jobs for views of this document which are not wanted anymore are cancelled.
+        '''
+        with self._lock:
+            if self._last_views.get(document_name) == view:
+                return
+            self._last_views[document_name] = view
+
+            for (doc, pending_view), future in list(self._pending.items()):
+                if doc == document_name and not self._is_wanted(doc, pending_view) and future.cancel():
+                    self._pending.pop((doc, pending_view), None)
+                    self.dropped += 1
+
+            for next_view in range(view + 1, view + 1 + self.views_ahead):
+                key = (document_name, next_view)
+                if key in self._pending:
+                    continue
+                # Global cap on the queue: never pile up more work than the pool can absorb
+                if len(self._pending) >= self.max_workers * self.views_ahead:
+                    self.dropped += 1
+                    continue
+                future = self._executor.submit(self._run, document_name, next_view)
+                self._pending[key] = future
+                future.add_done_callback(lambda future, key=key: self._forget(key, future))
+
+    def info(self) -> dict:
+        '''
+        Return statistics of the prefetcher: `pending`, `completed` and `dropped` jobs.
+        '''
+        with self._lock:
+            return {"pending": len(self._pending), "completed": self.completed, "dropped": self.dropped}
+
+    def shutdown(self):
+        with self._lock:
+            for future in self._pending.values():
+                future.cancel()
+        self._executor.shutdown(wait=True)
+
+    # Internal definitions
+    # -----------------------------------------------------------------------------------------
+
+    def _is_wanted(self, document_name: str, view: int) -> bool:
+        # Must be called with the lock held
+        last_view = self._last_views[document_name]
+        return last_view < view <= last_view + self.views_ahead
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._pending.get(key) is future:
+                del self._pending[key]
+
+    def _run(self, document_name: str, view: int):
+        with self._lock:
+            # The reader moved elsewhere, or requests are being served: do not compete with them
+            if not self._is_wanted(document_name, view) or self._foreground > 0:
+                self.dropped += 1
+                return
+        for warm in self.warmers:
+            warm(document_name, view)
+        with self._lock:
+            self.completed += 1
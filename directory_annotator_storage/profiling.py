@@ -0,0 +1,92 @@
+'''
+Profiling of single requests, to find out why a given document is slow in production.
+
+Disabled unless PROFILE_TOKEN is configured. A request sent with this token in the
+`X-Profile-Token` header runs under `cProfile`: the profile is written to PROFILE_PATH (as a
+`pstats` file named after the time, route, document and view, sent in the `X-Profile-File`
+header of the response), or, when PROFILE_PATH is not defined or with `X-Profile-Output: summary`,
+the response is replaced by a summary of the functions with the largest cumulative time.
+Images of profiled requests are produced by the request thread, without the image cache.
+'''
+
+import cProfile
+import hmac
+import io
+import os
+import pstats
+import re
+import threading
+import time
+
+from flask import Blueprint, abort, current_app, g, request
+
+from directory_annotator_storage.constants_config import PROFILE_PATH, PROFILE_TOKEN
+
+bp = Blueprint('profiling', __name__)
+bp.config = {}
+
+# Number of functions listed in the summaries
+SUMMARY_FUNCTIONS = 40
+
+# One request is profiled at a time by each process
+_profiling_lock = threading.Lock()
+
+@bp.record
+def record_config(setup_state):
+    bp.config = setup_state.app.config
+
+@bp.before_app_request
+def start_profiler():
+    token = request.headers.get('X-Profile-Token')
+    if token is None or not bp.config.get(PROFILE_TOKEN):
+        return
+    if not hmac.compare_digest(token.encode(), bp.config[PROFILE_TOKEN].encode()):
+        abort(403, "Invalid profiling token.")
+    if not _profiling_lock.acquire(blocking=False):
+        abort(409, "Another request is being profiled.")
+    g.profiler = cProfile.Profile()
+    g.profiler.enable()
+
+@bp.after_app_request
+def stop_profiler(response):
+    profiler = g.pop("profiler", None)
+    if profiler is None:
+        return response
+    profiler.disable()
+    _profiling_lock.release()
+    profile_path = bp.config.get(PROFILE_PATH)
+    if profile_path and request.headers.get('X-Profile-Output', 'file') != 'summary':
+        os.makedirs(profile_path, exist_ok=True)
+        file_name = profile_file_name()
+        profiler.dump_stats(os.path.join(profile_path, file_name))
+        response.headers['X-Profile-File'] = file_name
+        return response
+    summary = io.StringIO()
+    summary.write(f"{request.method} {request.path} -> {response.status}\n\n")
+    pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(SUMMARY_FUNCTIONS)
+    return current_app.response_class(summary.getvalue(), mimetype="text/plain")
+
+@bp.teardown_app_request
+def release_profiler(exc):
+    # The request failed before `stop_profiler`
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.disable()
+        _profiling_lock.release()
+
+
+def is_profiled() -> bool:
+    '''
+    Return whether the current request is profiled.
+    '''
+    return g.get("profiler") is not None
+
+def profile_file_name() -> str:
+    '''
+    Return the name of the profile of the current request: time, route, document and view.
+    '''
+    args = request.view_args or {}
+    parts = [time.strftime("%Y%m%d-%H%M%S"), request.endpoint or "unmatched",
+             args.get("document", args.get("directory")), args.get("view")]
+    name = "_".join(str(part) for part in parts if part is not None)
+    return re.sub(r"[^A-Za-z0-9_.-]", "-", name) + f"_{os.getpid()}.prof"
@@ -0,0 +1,202 @@
+'''
+Rasterization of the PDF pages which are not made of a single whole-page image.
+
+Pages are rendered in a pool of separate processes, with a memory limit per process and a
+timeout per page, so that a pathological page can neither block nor crash a worker of the
+application. Pages are rendered with `pdftoppm` (poppler) when it is installed. Otherwise, the
+images placed on the page are composed on a blank canvas; other content (text, vector graphics)
+is not drawn.
+'''
+
+import shutil
+import subprocess
+import threading
+from io import BytesIO
+
+from PIL import Image
+from pikepdf import Pdf, PdfError, PdfImage, parse_content_stream
+
+from directory_annotator_storage.constants_config import (
+    DEFAULT_RASTER_DPI, DEFAULT_RASTER_TIMEOUT, DEFAULT_RASTER_MEMORY_LIMIT, DEFAULT_RASTER_WORKERS)
+from directory_annotator_storage.worker_pool import JobTimeoutError, WorkerPool, WorkerPoolError
+
+# Maximum size, in pixels, of the largest side of a rendered page (the resolution is lowered
+# for larger pages)
+MAX_RENDER_SIZE = 4096
+
+
+class RasterizationError(RuntimeError):
+    pass
+
+
+def render_size(page_box, dpi: int) -> tuple:
+    '''
+    Return the size, in pixels, of a page rendered at `dpi`, given its box in PDF units.
+    '''
+    x0, y0, x1, y1 = [float(v) for v in page_box]
+    width, height = abs(x1 - x0), abs(y1 - y0)
+    scale = dpi / 72
+    if max(width, height) * scale > MAX_RENDER_SIZE:
+        scale = MAX_RENDER_SIZE / max(width, height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+# Renderers (run in the worker processes)
+# =============================================================================================
+
+def limit_memory(memory_limit):
+    '''
+    Limit the size of the address space of the current process (`memory_limit` in bytes, 0 for
+    no limit).
+    '''
+    if memory_limit:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+
+def _render_with_pdftoppm(document_path: str, view: int, size: tuple, timeout: float) -> bytes:
+    # `pdftoppm` inherits the memory limit of the worker process
+    command = ["pdftoppm", "-f", str(view), "-l", str(view), "-png", "-singlefile",
+               "-scale-to-x", str(size[0]), "-scale-to-y", str(size[1]), document_path]
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=timeout, check=True)
+    return result.stdout
+
+
+def _render_with_composition(document_path: str, view: int, size: tuple) -> bytes:
+    with Pdf.open(document_path) as pdf_file:
+        page = pdf_file.pages[view - 1]
+        x0, y0, x1, y1 = [float(v) for v in page.mediabox]
+        scale_x, scale_y = size[0] / (x1 - x0), size[1] / (y1 - y0)
+        canvas = Image.new("RGB", size, "white")
+        xobjects = page.Resources.get("/XObject", {})
+
+        ctm = (1, 0, 0, 1, 0, 0)
+        stack = []
+        for operands, operator in parse_content_stream(page, "q Q cm Do"):
+            op = str(operator)
+            if op == "q":
+                stack.append(ctm)
+            elif op == "Q":
+                ctm = stack.pop() if stack else (1, 0, 0, 1, 0, 0)
+            elif op == "cm":
+                a, b, c, d, e, f = [float(v) for v in operands]
+                A, B, C, D, E, F = ctm
+                ctm = (a * A + b * C, a * B + b * D, c * A + d * C, c * B + d * D,
+                       e * A + f * C + E, e * B + f * D + F)
+            elif op == "Do":
+                xobject = xobjects.get(str(operands[0]))
+                a, b, c, d, e, f = ctm
+                # Only axis-aligned images are supported
+                if xobject is None or xobject.get("/Subtype") != "/Image" or b != 0 or c != 0:
+                    continue
+                image = PdfImage(xobject).as_pil_image()
+                if a < 0:
+                    image = image.transpose(Image.FLIP_LEFT_RIGHT)
+                if d < 0:
+                    image = image.transpose(Image.FLIP_TOP_BOTTOM)
+                # The image fills the unit square of its user space (PDF origin is bottom-left)
+                left = round((min(e, e + a) - x0) * scale_x)
+                top = round((y1 - max(f, f + d)) * scale_y)
+                width = max(1, round(abs(a) * scale_x))
+                height = max(1, round(abs(d) * scale_y))
+                image = image.resize((width, height))
+                mask = image.getchannel("A") if image.mode in ("RGBA", "LA") else None
+                canvas.paste(image.convert("RGB"), (left, top), mask)
+
+    out = BytesIO()
+    canvas.save(out, format="PNG")
+    return out.getvalue()
+
+
+def _render(document_path: str, view: int, size: tuple, timeout: float) -> bytes:
+    if shutil.which("pdftoppm"):
+        return _render_with_pdftoppm(document_path, view, size, timeout)
+    return _render_with_composition(document_path, view, size)
+
+
+# Pool of renderers
+# =============================================================================================
+
+class _Rasterizer:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pool = None
+        self.configure(DEFAULT_RASTER_WORKERS, DEFAULT_RASTER_DPI, DEFAULT_RASTER_TIMEOUT, DEFAULT_RASTER_MEMORY_LIMIT)
+
+    def configure(self, workers, dpi, timeout, memory_limit):
+        with self._lock:
+            self.workers = workers
+            self.dpi = dpi
+            self.timeout = timeout
+            self.memory_limit = memory_limit
+            self._reset()
+
+    def _reset(self):
+        # Must be called with the lock held
+        if self._pool is not None:
+            self._pool.shutdown()
+        self._pool = None
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = WorkerPool(self.workers, limit_memory, (self.memory_limit,))
+            return self._pool
+
+    def render(self, document_path: str, view: int, page_box) -> bytes:
+        size = render_size(page_box, self.dpi)
+        try:
+            if self.workers <= 0:
+                # Rendered by the calling process, which must limit and time out itself
+                return _render(document_path, view, size, self.timeout)
+            # A stuck job cannot be cancelled: its process is killed on timeout
+            return self._get_pool().run(_render, document_path, view, size, self.timeout, timeout=self.timeout)
+        except (JobTimeoutError, subprocess.TimeoutExpired):
+            raise RasterizationError(f"Rendering of view {view} of '{document_path}' timed out.")
+        except WorkerPoolError:
+            raise RasterizationError(f"Rendering of view {view} of '{document_path}' crashed.")
+        except (RuntimeError, PdfError, MemoryError, OSError, subprocess.SubprocessError) as err:
+            raise RasterizationError(f"Rendering of view {view} of '{document_path}' failed: {err}")
+
+
+_rasterizer = _Rasterizer()
+
+
+def configure_rasterizer(workers: int = DEFAULT_RASTER_WORKERS, dpi: int = DEFAULT_RASTER_DPI,
+                         timeout: float = DEFAULT_RASTER_TIMEOUT, memory_limit: int = DEFAULT_RASTER_MEMORY_LIMIT):
+    '''
+    Configure the pool of renderers of this process.
+
+    Args:
+        workers (int): Maximum number of pages rendered concurrently (0 to render them in
+            the calling process)
+        dpi (int): Resolution of the rendered pages
+        timeout (float): Maximum duration, in seconds, of the rendering of a page
+        memory_limit (int): Maximum size, in bytes, of the address space of a renderer (0 for no limit)
+    '''
+    _rasterizer.configure(workers, dpi, timeout, memory_limit)
+
+
+def rasterization_dpi() -> int:
+    '''
+    Return the resolution used to render pages.
+    '''
+    return _rasterizer.dpi
+
+
+def rasterize_page(document_path: str, view: int, page_box) -> bytes:
+    '''
+    Render a page of a PDF file as a PNG image.
+
+    Args:
+        document_path (str): Path to the PDF file
+        view (int): Page to render (1-indexed)
+        page_box: Box of the page (`page.mediabox`), used to compute the size of the output
+
+    Raises:
+        RasterizationError: If the rendering failed, timed out or exceeded its memory limit
+
+    Returns:
+        bytes: PNG image
+    '''
+    return _rasterizer.render(document_path, view, page_box)
@@ -0,0 +1,203 @@
+'''
+Reading order of the entries of the annotation pages.
+
+Entries (and level 2 titles) are sorted by column (`COLUMN_LEVEL_1` elements, in their order in
+the page), then from top to bottom, according to the center of their box. Columns are found
+with sorted intervals: the page is cut into vertical slabs at the column edges, and the columns
+of each slab are sorted by their top edge, so each entry is placed with two `searchsorted`.
+
+Batch mode, to sort every view of the annotations of some (by default all) documents:
+
+    python -m directory_annotator_storage.reading_order [--workers N] [--backend zip|sqlite]
+        [--db DB_PATH] ANNOTATIONS_PATH [DOCUMENT ...]
+'''
+
+import argparse
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+
+import numpy as np
+
+from directory_annotator_storage.backend_annotations import (
+    AnnotationsNotFoundError, InvalidDocumentNameError, VersionMismatchError)
+from directory_annotator_storage.constants_config import ANNOT_PATH, ANNOT_BACKEND, ANNOT_DB_PATH
+
+# Types of the elements which are sorted, and of the columns
+TYPES_TO_SORT = ("ENTRY", "TITLE_LEVEL_2")
+COLUMN_TYPE = "COLUMN_LEVEL_1"
+
+# Attempts to sort a document whose views are saved concurrently
+_SORT_ATTEMPTS = 5
+
+
+# Public members
+# =============================================================================================
+
+def assign_columns(points: np.ndarray, columns: np.ndarray) -> np.ndarray:
+    '''
+    Return, for each point `(x, y)`, the index of the first column `(x, y, w, h)` containing it,
+    or -1 if no column does.
+    '''
+    points = np.asarray(points, dtype="int64").reshape(-1, 2)
+    columns = np.asarray(columns, dtype="int64").reshape(-1, 4)
+    keys = np.full(len(points), -1, dtype="int64")
+    if len(points) == 0 or len(columns) == 0:
+        return keys
+    x0 = columns[:, 0]
+    y0 = columns[:, 1]
+    x1 = x0 + columns[:, 2]
+    y1 = y0 + columns[:, 3]
+
+    # Vertical slabs between consecutive column edges
+    edges = np.unique(np.concatenate([x0, x1]))
+    slab_of_points = np.searchsorted(edges, points[:, 0], side="right") - 1
+    first_slabs = np.searchsorted(edges, x0)
+    last_slabs = np.searchsorted(edges, x1)  # excluded
+    # Points grouped by slab, once
+    points_by_slab = np.argsort(slab_of_points, kind="stable")
+    sorted_slabs = slab_of_points[points_by_slab]
+    slabs = np.unique(sorted_slabs)
+    starts = np.searchsorted(sorted_slabs, slabs, side="left")
+    ends = np.searchsorted(sorted_slabs, slabs, side="right")
+    for slab, start, end in zip(slabs, starts, ends):
+        if slab < 0 or slab >= len(edges) - 1:
+            continue
+        in_slab = np.nonzero((first_slabs <= slab) & (slab < last_slabs))[0]
+        if len(in_slab) == 0:
+            continue
+        point_ids = points_by_slab[start:end]
+        ys = points[point_ids, 1]
+        order = in_slab[np.argsort(y0[in_slab], kind="stable")]
+        if np.all(y1[order][:-1] <= y0[order][1:]):
+            # Disjoint columns: the one starting last above the point is the only candidate
+            candidates = order[np.maximum(np.searchsorted(y0[order], ys, side="right") - 1, 0)]
+            found = (y0[candidates] <= ys) & (ys < y1[candidates])
+            keys[point_ids[found]] = candidates[found]
+        else:
+            # Overlapping columns (unusual): the first one in the page wins
+            inside = (y0[in_slab, np.newaxis] <= ys) & (ys < y1[in_slab, np.newaxis])
+            found = inside.any(axis=0)
+            keys[point_ids[found]] = in_slab[np.argmax(inside, axis=0)[found]]
+    return keys
+
+
+def sort_entries(entries: List, columns: List, *, skip_error: bool = True) -> List:
+    '''
+    Return the entries sorted by column, then from top to bottom.
+    Entries which are not in any column are put at the end, in their original order.
+
+    Raises:
+        RuntimeError: If an entry is not in any column, unless `skip_error` is set
+    '''
+    boxes = [_box(e) for e in entries]
+    valid = [i for i, box in enumerate(boxes) if box is not None]
+    e_coords = np.array([boxes[i] for i in valid], dtype="int64").reshape(-1, 4)
+    centers = np.stack([e_coords[:, 0] + e_coords[:, 2] // 2, e_coords[:, 1] + e_coords[:, 3] // 2], axis=1)
+    column_boxes = [box for box in (_box(c) for c in columns) if box is not None]
+    keys = assign_columns(centers, np.array(column_boxes, dtype="int64").reshape(-1, 4))
+
+    sort_keys = [(np.inf, np.inf)] * len(entries)
+    for i, key, center_y in zip(valid, keys, centers[:, 1]):
+        if key >= 0:
+            sort_keys[i] = (int(key), int(center_y))
+    if not skip_error:
+        for i, key in enumerate(sort_keys):
+            if key[0] == np.inf:
+                raise RuntimeError(f"The entry {entries[i]} is not included in any column.")
+    order = sorted(range(len(entries)), key=lambda i: sort_keys[i])
+    return [entries[i] for i in order]
+
+
+def sort_page(page):
+    '''
+    Return a page (list of elements) with its entries sorted, and moved after the other elements.
+    Pages in another format are returned unchanged.
+    '''
+    if not isinstance(page, list):
+        return page
+    entries = [e for e in page if isinstance(e, dict) and e.get("type") in TYPES_TO_SORT]
+    columns = [e for e in page if isinstance(e, dict) and e.get("type") == COLUMN_TYPE]
+    others = [e for e in page if not (isinstance(e, dict) and e.get("type") in TYPES_TO_SORT)]
+    return others + sort_entries(entries, columns)
+
+
+def sort_document(config: dict, document_name: str) -> int:
+    '''
+    Sort every view of the annotations of a document, and return the number of views changed.
+    `config` selects the annotation backend (see `annotation_backend.create_annotation_backend`).
+    Views are only saved if they did not change since they were read: otherwise the document is
+    sorted again.
+
+    Raises:
+        VersionMismatchError: If the views of the document kept being saved concurrently
+    '''
+    # Imported here: worker processes only need it when sorting documents
+    from directory_annotator_storage.annotation_backend import create_annotation_backend
+    backend = create_annotation_backend(config)
+    views = backend.document_views(document_name)
+    for _ in range(_SORT_ATTEMPTS):
+        # Read before the content: a concurrent save makes the save below fail
+        versions = {}
+        for view in views:
+            try:
+                versions[view] = backend.version(document_name, view)
+            except (InvalidDocumentNameError, AnnotationsNotFoundError):
+                pass
+        changed = {}
+        for view, page, error in backend.load_many(document_name, list(versions)):
+            if error is None:
+                sorted_page = sort_page(page)
+                if sorted_page != page:
+                    changed[view] = sorted_page
+        if len(changed) == 0:
+            return 0
+        try:
+            backend.save_many(document_name, changed, {view: versions[view] for view in changed})
+            return len(changed)
+        except VersionMismatchError:
+            continue
+    raise VersionMismatchError(f"The views of \"{document_name}\" are being modified concurrently.")
+
+
+def sort_documents(config: dict, document_names: List = None, max_workers: int = None) -> dict:
+    '''
+    Sort every view of the annotations of several documents (all by default) in a process pool.
+    Returns the number of views changed by document.
+    '''
+    if document_names is None:
+        from directory_annotator_storage.annotation_backend import create_annotation_backend
+        document_names = create_annotation_backend(config).documents()
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        counts = executor.map(sort_document, [config] * len(document_names), document_names)
+        return dict(zip(document_names, counts))
+
+
+# Internal definitions
+# =============================================================================================
+
+def _box(element):
+    box = element.get("box")
+    if isinstance(box, list) and len(box) == 4 and all(isinstance(v, (int, float)) for v in box):
+        return box
+    return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sort the entries of every view of annotated documents.")
+    parser.add_argument("annotations_path", help="Directory of the annotations")
+    parser.add_argument("documents", nargs="*", help="Documents to sort (default: all)")
+    parser.add_argument("--backend", default="zip", choices=["zip", "sqlite"], help="Annotation storage")
+    parser.add_argument("--db", help="Database of the sqlite storage")
+    parser.add_argument("--workers", type=int, default=None, help="Number of processes")
+    args = parser.parse_args(argv)
+
+    config = {ANNOT_PATH: args.annotations_path, ANNOT_BACKEND: args.backend, ANNOT_DB_PATH: args.db}
+    counts = sort_documents(config, args.documents or None, args.workers)
+    for document_name, count in sorted(counts.items()):
+        print(f"{document_name}: {count} view(s) sorted")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,337 @@
+'''
+Full-text index of the annotations of all the documents.
+
+The text of the entries and titles is indexed in a SQLite FTS5 table (case and accent
+insensitive), with the document, view, path (JSON pointer in the page) and box of each element.
+The index is stored on disk, shared by all worker processes (WAL mode), and kept up to date:
+views saved through the application are indexed once the response is sent, the views of an
+uploaded archive when it replaces the annotations of a document, and each indexed view records
+the version of the stored view it was built from, so that `build` only indexes again the views
+which changed.
+
+To build (or bring up to date) the index of all the documents, in a process pool:
+
+    python -m directory_annotator_storage.search_index [--workers N] [--backend zip|sqlite]
+        [--db DB_PATH] [--cache CACHE_PATH | --index INDEX_PATH] ANNOTATIONS_PATH
+
+By default, the index is the one the server uses: in the cache directory (`--cache`, or
+SODUCO_CACHE_PATH in the settings file named by SODUCO_SETTINGS) if any, in the annotations otherwise.
+'''
+
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from directory_annotator_storage.backend_annotations import AnnotationsNotFoundError
+from directory_annotator_storage.constants_config import (
+    ANNOT_PATH, ANNOT_BACKEND, ANNOT_DB_PATH, CACHE_PATH, SODUCO_SETTINGS)
+import directory_annotator_storage.path_utils as pu
+
+logger = logging.getLogger(__name__)
+
+# Types of the elements whose text is indexed
+INDEXED_TYPES = ("ENTRY", "TITLE_LEVEL_1", "TITLE_LEVEL_2")
+
+# Fields of the elements which are not text
+_IGNORED_FIELDS = ("type", "origin", "children")
+
+# Version of the schema, bump it when the layout of the tables changes (the index is rebuilt)
+_SCHEMA_VERSION = 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS views (
+    id INTEGER PRIMARY KEY,
+    document TEXT NOT NULL,
+    view INTEGER NOT NULL,
+    version TEXT NOT NULL,
+    UNIQUE (document, view)
+);
+CREATE TABLE IF NOT EXISTS elements (
+    id INTEGER PRIMARY KEY,
+    view_id INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    type TEXT,
+    box TEXT,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS elements_view ON elements (view_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS texts USING fts5 (
+    text, content='elements', content_rowid='id', tokenize='unicode61 remove_diacritics 2');
+CREATE TRIGGER IF NOT EXISTS elements_insert AFTER INSERT ON elements BEGIN
+    INSERT INTO texts (rowid, text) VALUES (new.id, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS elements_delete AFTER DELETE ON elements BEGIN
+    INSERT INTO texts (texts, rowid, text) VALUES ('delete', old.id, old.text);
+END;
+"""
+
+_DROP = """
+DROP TABLE IF EXISTS texts;
+DROP TABLE IF EXISTS elements;
+DROP TABLE IF EXISTS views;
+"""
+
+
+class SearchIndex:
+    '''
+    Full-text index of the annotations, in the SQLite database `db_path` (created if needed).
+    '''
+    def __init__(self, db_path: str, timeout: float = 30):
+        self.db_path = db_path
+        self.timeout = timeout
+        self._local = threading.local()
+        with self._connection() as connection:
+            if connection.execute("PRAGMA user_version").fetchone()[0] != _SCHEMA_VERSION:
+                connection.executescript(_DROP)
+                connection.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+            connection.executescript(_SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        # One connection per thread, and per process (connections must not cross a fork)
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.db_path, timeout=self.timeout)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    # Public members
+    # -----------------------------------------------------------------------------------------
+
+    def index_saved(self, document_name: str, pages: dict):
+        '''
+        Index views just saved: `pages` maps views to `(annotations, version)`, the annotations
+        being as loaded from the storage (see `backend_annotations.decode_page`). Errors are
+        logged: the views are indexed again by the next `refresh` or `build`.
+        '''
+        try:
+            self.update(document_name, pages)
+        except sqlite3.Error:
+            logger.exception("Cannot index views %s of \"%s\".", sorted(pages), document_name)
+
+    def index_replaced(self, backend, document_name: str):
+        '''
+        Bring the views of a document whose annotations were replaced up to date (see `refresh`).
+        Errors are logged: the views are indexed again by the next `refresh` or `build`.
+        '''
+        try:
+            self.refresh(backend, document_name)
+        except sqlite3.Error:
+            logger.exception("Cannot index the annotations of \"%s\".", document_name)
+
+    def update(self, document_name: str, pages: dict):
+        '''
+        Index views of a document: `pages` maps views to `(annotations, version)`, or to `None`
+        for views which no longer exist.
+        '''
+        self._write(pu.get_stem(document_name), {
+            view: None if page is None else (page[1], extract_texts(page[0])) for view, page in pages.items()})
+
+    def refresh(self, backend, document_name: str) -> int:
+        '''
+        Index again the views of a document which changed since they were indexed, and remove
+        the views which no longer exist. Returns the number of views indexed or removed.
+
+        Raises:
+            InvalidDocumentNameError: If the document name is badly formed
+        '''
+        document = pu.get_stem(document_name)
+        changes = _changed_views(backend, document_name, self._indexed_versions(document))
+        self._write(document, changes)
+        return len(changes)
+
+    def build(self, config: dict, max_workers: int = None) -> dict:
+        '''
+        Bring the index of all the documents of the annotation storage selected by `config`
+        up to date, reading the documents in a process pool (see `refresh`).
+        Returns the number of views indexed or removed by document.
+        '''
+        from directory_annotator_storage.annotation_backend import create_annotation_backend
+        document_names = create_annotation_backend(config).documents()
+        counts = {}
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            indexed = [self._indexed_versions(document) for document in document_names]
+            for document, changes in zip(document_names, executor.map(
+                    _document_changes, [config] * len(document_names), document_names, indexed)):
+                self._write(document, changes)
+                counts[document] = len(changes)
+        # Documents which no longer exist
+        with self._connection() as connection:
+            removed = [row[0] for row in connection.execute("SELECT DISTINCT document FROM views")
+                       if row[0] not in counts]
+        for document in removed:
+            views = self._indexed_versions(document)
+            self._write(document, dict.fromkeys(views))
+            counts[document] = len(views)
+        return counts
+
+    def search(self, query: str, document_name: str = None, limit: int = 50) -> list:
+        '''
+        Return the elements whose text contains all the words of `query` (a word ending with `*`
+        matches the words starting with it), best matches first, as dictionaries with the
+        `document`, `view`, `path` (JSON pointer in the page), `type`, `box`, `text` and `score`
+        of the elements. With `document_name`, only the elements of this document are returned.
+        '''
+        expression = _match_expression(query)
+        if expression is None:
+            return []
+        sql = ("SELECT v.document, v.view, e.path, e.type, e.box, e.text, bm25(texts) AS score "
+               "FROM texts JOIN elements e ON e.id = texts.rowid JOIN views v ON v.id = e.view_id "
+               "WHERE texts MATCH ?")
+        args = (expression,)
+        if document_name is not None:
+            sql += " AND v.document = ?"
+            args += (pu.get_stem(document_name),)
+        rows = self._connection().execute(sql + " ORDER BY score LIMIT ?", args + (limit,))
+        return [{
+            "document": document,
+            "view": view,
+            "path": path,
+            "type": element_type,
+            "box": json.loads(box) if box is not None else None,
+            "text": text,
+            "score": -score,
+        } for document, view, path, element_type, box, text, score in rows]
+
+    # Internal definitions
+    # -----------------------------------------------------------------------------------------
+
+    def _indexed_versions(self, document: str) -> dict:
+        return dict(self._connection().execute(
+            "SELECT view, version FROM views WHERE document = ?", (document,)))
+
+    def _write(self, document: str, changes: dict):
+        # `changes` maps views to `(version, texts)` (see `extract_texts`), or to `None`
+        with self._connection() as connection:
+            for view, change in changes.items():
+                row = connection.execute(
+                    "SELECT id FROM views WHERE document = ? AND view = ?", (document, view)).fetchone()
+                if row is not None:
+                    connection.execute("DELETE FROM elements WHERE view_id = ?", row)
+                if change is None:
+                    connection.execute("DELETE FROM views WHERE document = ? AND view = ?", (document, view))
+                    continue
+                version, texts = change
+                if row is None:
+                    view_id = connection.execute(
+                        "INSERT INTO views (document, view, version) VALUES (?, ?, ?)",
+                        (document, view, version)).lastrowid
+                else:
+                    view_id = row[0]
+                    connection.execute("UPDATE views SET version = ? WHERE id = ?", (version, view_id))
+                connection.executemany(
+                    "INSERT INTO elements (view_id, path, type, box, text) VALUES (?, ?, ?, ?, ?)",
+                    [(view_id, path, element_type, json.dumps(box) if box is not None else None, text)
+                     for path, element_type, box, text in texts])
+
+
+def extract_texts(page) -> list:
+    '''
+    Return the text of the indexed elements of a page (a list of elements, or a tree of elements
+    with `children`), as `(path, type, box, text)`, where `path` is the JSON pointer of the element
+    in the page, and `text` joins the text fields of the element.
+    '''
+    texts = []
+    stack = [("", page)]
+    while len(stack) > 0:
+        path, node = stack.pop()
+        if isinstance(node, list):
+            stack.extend((f"{path}/{i}", child) for i, child in reversed(list(enumerate(node))))
+        elif isinstance(node, dict):
+            if node.get("type") in INDEXED_TYPES:
+                text = " ".join(value.strip() for field, value in node.items()
+                                if field not in _IGNORED_FIELDS and isinstance(value, str) and value.strip())
+                if len(text) > 0:
+                    texts.append((path, node["type"], node.get("box"), text))
+            if "children" in node:
+                stack.append((f"{path}/children", node["children"]))
+    return texts
+
+
+# Internal definitions
+# =============================================================================================
+
+def _changed_views(backend, document_name: str, indexed: dict) -> dict:
+    '''
+    Return the changes of the index of a document (see `SearchIndex._write`), given the versions
+    of its indexed views.
+    '''
+    changes = dict.fromkeys(view for view in indexed)
+    for view in backend.document_views(document_name):
+        try:
+            version = backend.version(document_name, view)
+        except AnnotationsNotFoundError:
+            continue
+        if indexed.get(view) == version:
+            del changes[view]
+        else:
+            changes[view] = version
+    stale = [view for view, version in changes.items() if version is not None]
+    # Versions were read before the contents: a concurrent save is indexed by its own request
+    for view, data, error in backend.load_many(document_name, stale):
+        changes[view] = None if error is not None else (changes[view], extract_texts(data))
+    return changes
+
+
+def _document_changes(config: dict, document_name: str, indexed: dict) -> dict:
+    # Runs in worker processes
+    from directory_annotator_storage.annotation_backend import create_annotation_backend
+    return _changed_views(create_annotation_backend(config), document_name, indexed)
+
+
+def _match_expression(query: str):
+    # Each word is quoted (FTS5 operators are not available), and the words must all match
+    terms = []
+    for word in (query or "").split():
+        prefix = word.endswith("*")
+        word = word.rstrip("*")
+        if len(word) > 0:
+            terms.append('"' + word.replace('"', '""') + '"' + ("*" if prefix else ""))
+    return " ".join(terms) if len(terms) > 0 else None
+
+
+def search_index_path(config) -> str:
+    '''
+    Return the path of the index of the application with configuration `config`:
+    in CACHE_PATH if defined, in ANNOT_PATH otherwise.
+    '''
+    return os.path.join(config.get(CACHE_PATH) or config[ANNOT_PATH], "search_index.sqlite3")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the full-text index of the annotations.")
+    parser.add_argument("annotations_path", help="Directory of the annotations")
+    parser.add_argument("--backend", default="zip", choices=["zip", "sqlite"], help="Annotation storage")
+    parser.add_argument("--db", help="Database of the sqlite storage")
+    parser.add_argument("--cache", help="Cache directory of the server (default: the one of the settings file)")
+    parser.add_argument("--index", help="Path to the index (default: the one of the server)")
+    parser.add_argument("--workers", type=int, default=None, help="Number of processes")
+    args = parser.parse_args(argv)
+
+    cache_path = args.cache
+    if cache_path is None:
+        # The settings of the server, as loaded by the application
+        from flask import Config
+        settings = Config(os.getcwd())
+        settings.from_envvar(SODUCO_SETTINGS, silent=True)
+        cache_path = settings.get(CACHE_PATH)
+    config = {ANNOT_PATH: args.annotations_path, ANNOT_BACKEND: args.backend, ANNOT_DB_PATH: args.db,
+              CACHE_PATH: cache_path}
+    path = args.index or search_index_path(config)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    index = SearchIndex(path)
+    counts = index.build(config, args.workers)
+    for document_name, count in sorted(counts.items()):
+        print(f"{document_name}: {count} view(s) indexed")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
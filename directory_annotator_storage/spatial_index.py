@@ -0,0 +1,225 @@
+'''
+Index of the elements of the annotation pages, by box and by type.
+
+Elements are stored in a SQLite database (shared by all worker processes, in WAL mode) with an
+R*Tree over their `box`, so that the elements of a view intersecting a rectangle, or the elements
+of a type across a range of views, are found without loading the pages.
+The index is derived data: each indexed view records the version of the stored view it was built
+from (see `AnnotationBackend.version`). Views saved through the application are indexed once the
+response is sent, the views of a document whose annotations are replaced are forgotten, and views
+whose version changed otherwise (other tools) are indexed again when they are queried.
+'''
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from directory_annotator_storage.backend_annotations import AnnotationsNotFoundError
+import directory_annotator_storage.path_utils as pu
+
+logger = logging.getLogger(__name__)
+
+# Version of the schema, bump it when the layout of the tables changes (the index is rebuilt)
+_SCHEMA_VERSION = 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS views (
+    id INTEGER PRIMARY KEY,
+    document TEXT NOT NULL,
+    view INTEGER NOT NULL,
+    version TEXT NOT NULL,
+    UNIQUE (document, view)
+);
+CREATE TABLE IF NOT EXISTS elements (
+    id INTEGER PRIMARY KEY,
+    view_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    type TEXT,
+    element TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS elements_view ON elements (view_id, type);
+CREATE VIRTUAL TABLE IF NOT EXISTS boxes USING rtree (id, view_min, view_max, x0, x1, y0, y1);
+"""
+
+_DROP = """
+DROP TABLE IF EXISTS boxes;
+DROP TABLE IF EXISTS elements;
+DROP TABLE IF EXISTS views;
+"""
+
+
+class SpatialIndex:
+    '''
+    Index of the elements of the views of the documents, in the SQLite database `db_path`
+    (created if needed).
+    '''
+    def __init__(self, db_path: str, timeout: float = 30):
+        self.db_path = db_path
+        self.timeout = timeout
+        self._local = threading.local()
+        with self._connection() as connection:
+            if connection.execute("PRAGMA user_version").fetchone()[0] != _SCHEMA_VERSION:
+                connection.executescript(_DROP)
+                connection.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+            connection.executescript(_SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        # One connection per thread, and per process (connections must not cross a fork)
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.db_path, timeout=self.timeout)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    # Public members
+    # -----------------------------------------------------------------------------------------
+
+    def index_saved(self, document_name: str, pages: dict):
+        '''
+        Index views just saved: `pages` maps views to `(annotations, version)`, the annotations
+        being as loaded from the storage (see `backend_annotations.decode_page`). Errors are
+        logged: the views are indexed again when queried.
+        '''
+        try:
+            self.update(document_name, pages)
+        except sqlite3.Error:
+            logger.exception("Cannot index views %s of \"%s\".", sorted(pages), document_name)
+
+    def index_replaced(self, document_name: str):
+        '''
+        Forget the views of a document whose annotations were replaced: they are indexed again
+        when queried. Errors are logged.
+        '''
+        document = (pu.get_stem(document_name),)
+        try:
+            with self._connection() as connection:
+                connection.execute(
+                    "DELETE FROM boxes WHERE id IN (SELECT e.id FROM elements e JOIN views v ON v.id = e.view_id "
+                    "WHERE v.document = ?)", document)
+                connection.execute(
+                    "DELETE FROM elements WHERE view_id IN (SELECT id FROM views WHERE document = ?)", document)
+                connection.execute("DELETE FROM views WHERE document = ?", document)
+        except sqlite3.Error:
+            logger.exception("Cannot forget the views of \"%s\".", document_name)
+
+    def update(self, document_name: str, pages: dict):
+        '''
+        Index views of a document: `pages` maps views to `(annotations, version)`, or to `None`
+        for views which no longer exist. Only pages which are lists of elements are indexed.
+        '''
+        document = pu.get_stem(document_name)
+        with self._connection() as connection:
+            for view, page in pages.items():
+                row = connection.execute(
+                    "SELECT id FROM views WHERE document = ? AND view = ?", (document, view)).fetchone()
+                if row is not None:
+                    connection.execute(
+                        "DELETE FROM boxes WHERE id IN (SELECT id FROM elements WHERE view_id = ?)", row)
+                    connection.execute("DELETE FROM elements WHERE view_id = ?", row)
+                if page is None:
+                    connection.execute("DELETE FROM views WHERE document = ? AND view = ?", (document, view))
+                    continue
+                data, version = page
+                if row is None:
+                    view_id = connection.execute(
+                        "INSERT INTO views (document, view, version) VALUES (?, ?, ?)",
+                        (document, view, version)).lastrowid
+                else:
+                    view_id = row[0]
+                    connection.execute("UPDATE views SET version = ? WHERE id = ?", (version, view_id))
+                for position, element in enumerate(data if isinstance(data, list) else []):
+                    if not isinstance(element, dict):
+                        continue
+                    element_id = connection.execute(
+                        "INSERT INTO elements (view_id, position, type, element) VALUES (?, ?, ?, ?)",
+                        (view_id, position, element.get("type"),
+                         json.dumps(element, ensure_ascii=False, separators=(",", ":")))).lastrowid
+                    box = _box(element)
+                    if box is not None:
+                        x, y, w, h = box
+                        connection.execute(
+                            "INSERT INTO boxes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (element_id, view_id, view_id, x, x + w, y, y + h))
+
+    def refresh(self, backend, document_name: str, views: list):
+        '''
+        Index again the views of a document whose stored version changed since they were indexed.
+
+        Raises:
+            InvalidDocumentNameError: If the document name is badly formed
+        '''
+        if len(views) == 0:
+            return
+        versions = {}
+        for view in views:
+            try:
+                versions[view] = backend.version(document_name, view)
+            except AnnotationsNotFoundError:
+                versions[view] = None
+        indexed = dict(self._connection().execute(
+            "SELECT view, version FROM views WHERE document = ? AND view BETWEEN ? AND ?",
+            (pu.get_stem(document_name), min(views), max(views))))
+        stale = [view for view in views if versions[view] != indexed.get(view)]
+        if len(stale) == 0:
+            return
+        pages = {}
+        # Versions were read before the contents: a concurrent save leaves the view stale
+        for view, data, error in backend.load_many(document_name, stale):
+            pages[view] = None if error is not None else (data, versions[view])
+        self.update(document_name, pages)
+
+    def query(self, backend, document_name: str, views: list, box: tuple = None, types: list = None) -> list:
+        '''
+        Return the elements of views of a document, as `(view, index in the page, element)`,
+        sorted by view and index. With `box` (`(x, y, w, h)`), only the elements whose box
+        intersects it are returned; with `types`, only the elements of these types.
+        Stale views are indexed first (see `refresh`).
+
+        Raises:
+            InvalidDocumentNameError: If the document name is badly formed
+        '''
+        self.refresh(backend, document_name, views)
+        if len(views) == 0:
+            return []
+        connection = self._connection()
+        view_ids = connection.execute(
+            "SELECT view, id FROM views WHERE document = ? AND view BETWEEN ? AND ?",
+            (pu.get_stem(document_name), min(views), max(views))).fetchall()
+        wanted = set(views)
+        type_filter = ""
+        type_args = ()
+        if types is not None:
+            type_filter = f" AND e.type IN ({','.join('?' * len(types))})"
+            type_args = tuple(types)
+        results = []
+        for view, view_id in sorted(view_ids):
+            if view not in wanted:
+                continue
+            if box is None:
+                rows = connection.execute(
+                    "SELECT e.position, e.element FROM elements e WHERE e.view_id = ?" + type_filter,
+                    (view_id,) + type_args)
+            else:
+                x, y, w, h = box
+                rows = connection.execute(
+                    "SELECT e.position, e.element FROM boxes b JOIN elements e ON e.id = b.id "
+                    "WHERE b.view_min <= ? AND b.view_max >= ? AND b.x0 < ? AND b.x1 > ? "
+                    "AND b.y0 < ? AND b.y1 > ?" + type_filter,
+                    (view_id, view_id, x + w, x, y + h, y) + type_args)
+            results.extend((view, position, json.loads(element)) for position, element in sorted(rows))
+        return results
+
+
+# Internal definitions
+# =============================================================================================
+
+def _box(element: dict):
+    box = element.get("box")
+    if isinstance(box, list) and len(box) == 4 and all(isinstance(v, (int, float)) for v in box):
+        return box
+    return None
@@ -0,0 +1,177 @@
+'''
+Pool of worker processes running one job at a time each.
+
+Unlike `concurrent.futures.ProcessPoolExecutor`, each job is sent to a given process, so that a
+job running for too long can be stopped by killing its process alone: the other jobs go on, and
+the process is replaced when needed. The timeout of a job starts when a process begins to run it,
+not when it is submitted.
+'''
+
+import multiprocessing
+import threading
+
+
+class WorkerPoolError(RuntimeError):
+    '''
+    A worker process crashed (or was killed), or the pool was shut down.
+    '''
+
+
+class JobTimeoutError(WorkerPoolError):
+    pass
+
+
+def _serve(connection, initializer, initargs):
+    # Main loop of the worker processes
+    if initializer is not None:
+        initializer(*initargs)
+    connection.send(None)  # ready
+    while True:
+        try:
+            function, args = connection.recv()
+        except EOFError:
+            return
+        try:
+            result = (True, function(*args))
+        except Exception as err:
+            result = (False, err)
+        try:
+            connection.send(result)
+        except Exception as err:
+            # The result (or the error) cannot be pickled
+            connection.send((False, WorkerPoolError(f"Cannot send the result of the job: {err!r}")))
+
+
+class _Worker:
+    def __init__(self, context, initializer, initargs):
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=_serve, args=(child_connection, initializer, initargs), daemon=True)
+        self.process.start()
+        child_connection.close()
+        self.ready = False
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+
+    def close(self):
+        self.kill()
+        self.connection.close()
+
+
+class WorkerPool:
+    '''
+    Pool of up to `size` processes, started on demand.
+
+    Args:
+        size (int): Maximum number of processes
+        initializer: Function called by each process when it starts, with `initargs`
+        initargs (tuple): Arguments of `initializer`
+        start_method (str): Start method of the processes (see `multiprocessing`), the default
+            one if `None`
+    '''
+    def __init__(self, size: int, initializer=None, initargs: tuple = (), start_method: str = None):
+        self.size = size
+        self._initializer = initializer
+        self._initargs = initargs
+        self._context = multiprocessing.get_context(start_method)
+        self._condition = threading.Condition()
+        self._workers = set()
+        self._idle = []
+        self._starting = 0  # processes being started, outside the lock
+        self._closed = False
+
+    def run(self, function, *args, timeout: float = None):
+        '''
+        Return `function(*args)`, computed by a process of the pool, once one is available.
+        `function`, its arguments and its result must be picklable.
+
+        Raises:
+            JobTimeoutError: If the job ran for more than `timeout` seconds (its process is killed)
+            WorkerPoolError: If the process crashed, or the pool was shut down
+            Errors raised by `function`
+        '''
+        worker = self._acquire()
+        try:
+            if not worker.ready:
+                # Started for this job: its initialization does not count in the timeout
+                worker.connection.recv()
+                worker.ready = True
+            worker.connection.send((function, args))
+            if not worker.connection.poll(timeout):
+                raise JobTimeoutError(f"Job timed out after {timeout} s.")
+            success, result = worker.connection.recv()
+        except JobTimeoutError:
+            self._discard(worker)
+            raise
+        except (EOFError, OSError) as err:
+            self._discard(worker)
+            raise WorkerPoolError(f"Worker process stopped: {err!r}")
+        except BaseException:
+            self._discard(worker)
+            raise
+        self._release(worker)
+        if not success:
+            raise result
+        return result
+
+    def shutdown(self):
+        '''
+        Stop the processes, including the ones running jobs (which fail with `WorkerPoolError`).
+        '''
+        with self._condition:
+            self._closed = True
+            for worker in self._workers:
+                if worker in self._idle:
+                    worker.close()
+                else:
+                    # Its job fails, then it is discarded by the thread waiting for it
+                    worker.kill()
+            self._workers.difference_update(self._idle)
+            self._idle = []
+            self._condition.notify_all()
+
+    # Internal definitions
+    # -----------------------------------------------------------------------------------------
+
+    def _acquire(self) -> _Worker:
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise WorkerPoolError("The pool is shut down.")
+                if len(self._idle) > 0:
+                    return self._idle.pop()
+                if len(self._workers) + self._starting < self.size:
+                    self._starting += 1
+                    break
+                self._condition.wait()
+        # Started without the lock: spawning a process takes long, it must not block the others
+        try:
+            worker = _Worker(self._context, self._initializer, self._initargs)
+        except BaseException:
+            with self._condition:
+                self._starting -= 1
+                self._condition.notify()
+            raise
+        with self._condition:
+            self._starting -= 1
+            if self._closed:
+                worker.close()
+                raise WorkerPoolError("The pool is shut down.")
+            self._workers.add(worker)
+        return worker
+
+    def _release(self, worker: _Worker):
+        with self._condition:
+            if self._closed:
+                self._workers.discard(worker)
+                worker.close()
+            else:
+                self._idle.append(worker)
+            self._condition.notify()
+
+    def _discard(self, worker: _Worker):
+        worker.close()
+        with self._condition:
+            self._workers.discard(worker)
+            self._condition.notify()
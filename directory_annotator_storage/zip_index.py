@@ -0,0 +1,147 @@
+'''
+Per-process cache of the central directory of the annotation archives.
+
+Opening a `zipfile.ZipFile` parses the whole central directory, which grows with the number of
+views of the document. The index of each archive (member name to offset, sizes, CRC and
+compression) is kept in memory, keyed by the identity of the file (inode, modification time and
+size), so reading a member only costs a seek and the read of that member. Archives are replaced
+atomically (never modified in place), so a changed identity is enough to invalidate an index.
+'''
+
+import os
+import struct
+import threading
+import zipfile
+import zlib
+
+# Local file header: signature, then fixed fields up to the name and extra field lengths
+_LOCAL_HEADER = struct.Struct("<4s22xHH")
+_LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+
+
+class ArchiveCorruptedError(RuntimeError):
+    pass
+
+
+class MemberInfo:
+    '''
+    Location and description of a member of an archive.
+    '''
+    __slots__ = ("header_offset", "compress_type", "compress_size", "file_size", "crc", "comment")
+
+    def __init__(self, info: zipfile.ZipInfo):
+        self.header_offset = info.header_offset
+        self.compress_type = info.compress_type
+        self.compress_size = info.compress_size
+        self.file_size = info.file_size
+        self.crc = info.CRC
+        self.comment = info.comment
+
+
+_lock = threading.Lock()
+_indexes = {}  # path -> ((inode, mtime_ns, size), {name: MemberInfo})
+
+
+def _identity(stat: os.stat_result) -> tuple:
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def _index(zip_file, zip_path: str) -> dict:
+    identity = _identity(os.fstat(zip_file.fileno()))
+    with _lock:
+        cached = _indexes.get(zip_path)
+    if cached is not None and cached[0] == identity:
+        return cached[1]
+    zip_file.seek(0)
+    with zipfile.ZipFile(zip_file) as zo:
+        # Later members win, as with `ZipFile.getinfo`
+        members = {info.filename: MemberInfo(info) for info in zo.infolist()}
+    with _lock:
+        _indexes[zip_path] = (identity, members)
+    return members
+
+
+def member_names(zip_path: str) -> list:
+    '''
+    Return the names of the members of an archive, or an empty list if it does not exist.
+    '''
+    try:
+        with open(zip_path, "rb") as zip_file:
+            return list(_index(zip_file, zip_path))
+    except FileNotFoundError:
+        return []
+
+
+def member_info(zip_path: str, name: str) -> MemberInfo:
+    '''
+    Return the description of a member of an archive, or `None` if the archive or the member
+    does not exist.
+    '''
+    try:
+        with open(zip_path, "rb") as zip_file:
+            return _index(zip_file, zip_path).get(name)
+    except FileNotFoundError:
+        return None
+
+
+def read_stored_member(zip_path: str, name: str):
+    '''
+    Return the content of a member of an archive as it is stored (e.g. a raw deflate stream),
+    with its `MemberInfo`, or `None` if the archive or the member does not exist.
+
+    Raises:
+        ArchiveCorruptedError: If the member cannot be located
+    '''
+    try:
+        zip_file = open(zip_path, "rb")
+    except FileNotFoundError:
+        return None
+    with zip_file:
+        member = _index(zip_file, zip_path).get(name)
+        if member is None:
+            return None
+        zip_file.seek(member.header_offset)
+        signature, name_length, extra_length = _LOCAL_HEADER.unpack(zip_file.read(_LOCAL_HEADER.size))
+        if signature != _LOCAL_HEADER_SIGNATURE:
+            raise ArchiveCorruptedError(f"Bad local header for '{name}' in '{zip_path}'.")
+        zip_file.seek(name_length + extra_length, os.SEEK_CUR)
+        return zip_file.read(member.compress_size), member
+
+
+def read_member(zip_path: str, name: str) -> bytes:
+    '''
+    Return the uncompressed content of a member of an archive,
+    or `None` if the archive or the member does not exist.
+
+    Raises:
+        ArchiveCorruptedError: If the member cannot be read
+    '''
+    stored = read_stored_member(zip_path, name)
+    if stored is None:
+        return None
+    data, member = stored
+    if member.compress_type == zipfile.ZIP_DEFLATED:
+        data = zlib.decompress(data, -zlib.MAX_WBITS)
+    elif member.compress_type != zipfile.ZIP_STORED:
+        # Unusual compression: let zipfile deal with it
+        with zipfile.ZipFile(zip_path) as zo:
+            return zo.read(name)
+    if len(data) != member.file_size or zlib.crc32(data) != member.crc:
+        raise ArchiveCorruptedError(f"Bad CRC for '{name}' in '{zip_path}'.")
+    return data
+
+
+def forget(zip_path: str):
+    '''
+    Drop the cached index of an archive (to call after replacing or removing it).
+    '''
+    with _lock:
+        _indexes.pop(zip_path, None)
+
+
+def cached_archives() -> int:
+    '''
+    Return the number of archive indexes cached by this process.
+    '''
+    with _lock:
+        return len(_indexes)
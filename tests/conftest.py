@@ -10,18 +10,21 @@ from shutil import copy
 import pytest
 
 from directory_annotator_storage import create_app
-from directory_annotator_storage.constants_config import ANNOT_PATH, DOC_PATH
+from directory_annotator_storage.annotation_backend import create_annotation_backend
+from directory_annotator_storage.constants_config import ANNOT_BACKEND, ANNOT_PATH, CACHE_PATH, DOC_PATH
 
 # ROUTES
 @pytest.fixture
 def app():
     doc_path = tempfile.mkdtemp()
     annot_path = tempfile.mkdtemp()
+    cache_path = tempfile.mkdtemp()
 
     app = create_app({
         'TESTING': True,
         DOC_PATH: doc_path,
-        ANNOT_PATH: annot_path
+        ANNOT_PATH: annot_path,
+        CACHE_PATH: cache_path
     })
 
     app.logger.debug(f"Created (temporary) fake document dir '{doc_path}'.")
@@ -47,6 +50,7 @@ def app():
 
     shutil.rmtree(doc_path)
     shutil.rmtree(annot_path)
+    shutil.rmtree(cache_path)
 
 @pytest.fixture
 def client(app):
@@ -65,3 +69,18 @@ def annot_path():
         yield annot_path
     finally:
         shutil.rmtree(annot_path)
+
+@pytest.fixture(params=["zip", "sqlite"])
+def annotation_backend(request, annot_path):
+    return create_annotation_backend({ ANNOT_PATH: annot_path, ANNOT_BACKEND: request.param })
+
+@pytest.fixture
+def doc_path():
+    doc_path = tempfile.mkdtemp()
+    BASE_PATH = os.path.join(os.path.dirname(__file__), 'resources', 'documents')
+    for fn in os.listdir(BASE_PATH):
+        copy(os.path.join(BASE_PATH, fn), doc_path)
+    try:
+        yield doc_path
+    finally:
+        shutil.rmtree(doc_path)
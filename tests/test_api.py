@@ -1,23 +1,328 @@
 from io import BytesIO
+import gzip
+import json
+import os
+import pstats
+import threading
+import time
 import zipfile
-from directory_annotator_storage.constants_config import DEBUG_TOKEN
+from PIL import Image
+from directory_annotator_storage.constants_config import (
+    ANNOT_PATH, ANNOT_SORT_ON_SAVE, DEBUG_TOKEN, IMAGE_POOL, METRICS_ENABLED, METRICS_TOKEN, PROFILE_PATH, PROFILE_TOKEN)
+from directory_annotator_storage.image_workers import ImageWorkers
 
 # HEALTH CHECK
 def test_health_check(client):
     resp = client.get('/health_check/')
     assert resp.status_code == 200
 
+# METRICS
+def test_metrics(client):
+    h = { 'Authorization': DEBUG_TOKEN }
+    client.get('/directories/Didot_1842a-sample.pdf/4/image/thumbnail', headers = h)
+    client.put('/directories/metricsdoc.pdf/1/annotation', headers = h, json = {"content": [{"type": "PAGE"}]})
+    for _ in range(50):
+        resp = client.get('/metrics')
+        assert resp.status_code == 200
+        assert resp.mimetype == "text/plain"
+        text = resp.get_data(as_text=True)
+        if 'stage="jpeg_encode"' in text:
+            break
+        time.sleep(0.1)  # image workers write their metrics within a second
+    assert 'soduco_request_duration_seconds_count{method="PUT",route="/directories/<document>/<int:view>/annotation",' \
+        'status="200"} ' in text
+    # Stages run by the image workers are aggregated with the ones of the application
+    assert 'soduco_stage_duration_seconds_count{stage="jpeg_encode"}' in text
+    assert 'soduco_stage_duration_seconds_count{stage="annotation_append"} ' in text
+    assert "soduco_lock_wait_seconds_bucket" in text
+    assert 'soduco_annotation_write_bytes_count{kind="append"} ' in text
+    assert 'soduco_pdf_pages_decoded_total{kind="decoded"} ' in text
+    assert "soduco_annotation_cache_hit_ratio " in text
+    assert "soduco_image_workers_completed_total " in text
+    assert "# TYPE soduco_annotation_cache_hits_total counter" in text
+
+def test_metrics_token(app, client):
+    app.config[METRICS_TOKEN] = "secret"
+    assert client.get('/metrics').status_code == 403
+    assert client.get('/metrics', headers = { 'Authorization': "secret" }).status_code == 200
+    assert client.get('/metrics/', headers = { 'Authorization': "secret" }).status_code == 200
+    app.config[METRICS_ENABLED] = False
+    assert client.get('/metrics', headers = { 'Authorization': "secret" }).status_code == 404
+
+# PROFILING
+def test_profile_request_summary(app, client):
+    h = { 'Authorization': DEBUG_TOKEN, 'X-Profile-Token': "prof" }
+    # Disabled by default
+    resp = client.get('/directories/Didot_1842a-sample.pdf/4/image/thumbnail', headers = h)
+    assert resp.mimetype == "image/jpeg"
+    app.config[PROFILE_TOKEN] = "prof"
+    resp = client.get('/directories/Didot_1842a-sample.pdf/4/image/thumbnail', headers = h)
+    assert resp.status_code == 200
+    assert resp.mimetype == "text/plain"
+    # Produced by the request thread, not read from the image cache
+    assert "get_variant_from_view" in resp.get_data(as_text=True)
+    resp = client.get('/directories/Didot_1842a-sample.pdf/4/image', headers = dict(h, **{'X-Profile-Token': "bad"}))
+    assert resp.status_code == 403
+
+def test_profile_request_file(app, client, tmp_path):
+    h = { 'Authorization': DEBUG_TOKEN, 'X-Profile-Token': "prof" }
+    app.config[PROFILE_TOKEN] = "prof"
+    app.config[PROFILE_PATH] = str(tmp_path)
+    resp = client.put('/directories/profiled.pdf/3/annotation', headers = h, json = {"content": [{"type": "PAGE"}]})
+    assert resp.status_code == 200
+    file_name = resp.headers["X-Profile-File"]
+    assert "_directories.access_annotation_profiled.pdf_3_" in file_name
+    stats = pstats.Stats(os.path.join(tmp_path, file_name))
+    assert any(function == "save_many_annotations" for _, _, function in stats.stats)
+
+# DOCUMENTS
+def test_list_directories(client):
+    h = { 'Authorization': DEBUG_TOKEN }
+    resp = client.get('/directories/', headers = h)
+    assert resp.status_code == 200
+    assert set(resp.json["directories"]) == set([
+        "Didot_1842a-sample.pdf", "Didot_1848a-sample.pdf", "Didot_1851a-sample.pdf"])
+
+def test_get_directory(client):
+    h = { 'Authorization': DEBUG_TOKEN }
+    resp = client.get('/directories/Didot_1842a-sample.pdf', headers = h)
+    assert resp.status_code == 200
+    assert resp.json == { "num_pages": 4, "filename": "Didot_1842a-sample.pdf" }
+
+def test_get_directory_unknown(client):
+    h = { 'Authorization': DEBUG_TOKEN }
+    resp = client.get('/directories/unknown.pdf', headers = h)
+    assert resp.status_code == 404
+
 # ANNOTATIONS
 # TODO check annotation content from know test element (present, absent)
 # TODO check invalid requests
+def test_get_annotation_gzip_passthrough(client):
+    h = { 'Authorization': DEBUG_TOKEN }
+    content = [{"type": "ENTRY", "box": [1, 2, 3, 4], "text": "éà"}, {"type": "PAGE", "box": [0, 0, 9, 9]}]
+    resp = client.put('/directories/newdoc.pdf/1/annotation', headers = h, json = {"content": content})
+    assert resp.status_code == 200
+    expected = [dict(content[0], origin="computer", checked=False), content[1]]
+
+    resp = client.get('/directories/newdoc.pdf/1/annotation', headers = dict(h, **{'Accept-Encoding': 'gzip'}))
+    assert resp.status_code == 200
+    assert resp.headers["Content-Encoding"] == "gzip"
+    assert resp.mimetype == "application/json"
+    assert json.loads(gzip.decompress(resp.data)) == {"content": expected}
+
+    resp = client.get('/directories/newdoc.pdf/1/annotation', headers = h)
+    assert "Content-Encoding" not in resp.headers
+    assert resp.json == {"content": expected}
+
+
+def test_annotation_conditional_requests(client):
+    h = { 'Authorization': DEBUG_TOKEN }
+    url = '/directories/etagdoc.pdf/1/annotation'
+    resp = client.put(url, headers = h, json = {"content": [{"type": "PAGE"}]})
+    etag = resp.headers["ETag"]
+
+    resp = client.get(url, headers = h)
+    assert resp.headers["ETag"] == etag
+    resp = client.get(url, headers = dict(h, **{"If-None-Match": etag}))
+    assert resp.status_code == 304
+    resp = client.get(url, headers = dict(h, **{"Accept-Encoding": "gzip"}))
+    gzip_etag = resp.headers["ETag"]
+    assert gzip_etag != etag
+    resp = client.get(url, headers = dict(h, **{"If-None-Match": gzip_etag}))
+    assert resp.status_code == 304
 
+    resp = client.put(url, headers = dict(h, **{"If-Match": etag}), json = {"content": [{"type": "TITLE"}]})
+    assert resp.status_code == 200
+    new_etag = resp.headers["ETag"]
+    assert new_etag != etag
+    # Lost update: saved by somebody else in the meantime
+    resp = client.put(url, headers = dict(h, **{"If-Match": etag}), json = {"content": []})
+    assert resp.status_code == 412
+    resp = client.put('/directories/etagdoc.pdf/2/annotation', headers = dict(h, **{"If-Match": "*"}),
+        json = {"content": []})
+    assert resp.status_code == 412
+    resp = client.get(url, headers = dict(h, **{"If-None-Match": etag}))
+    assert resp.status_code == 200 and resp.json == {"content": [{"type": "TITLE"}]}
+
+def test_annotation_patch(client):
+    h = { 'Authorization': DEBUG_TOKEN }
+    url = '/directories/patchdoc.pdf/1/annotation'
+    content = [{"type": "ENTRY", "text": "a"}, {"type": "ENTRY", "text": "b"}]
+    etag = client.put(url, headers = h, json = {"content": content}).headers["ETag"]
+
+    resp = client.patch(url, headers = h, json = {"1": {"checked": True, "text": None}})
+    assert resp.status_code == 200
+    resp = client.patch(url, headers = dict(h, **{"Content-Type": "application/json-patch+json"}),
+        data = json.dumps([{"op": "test", "path": "/0/text", "value": "a"},
+                           {"op": "add", "path": "/-", "value": {"type": "PAGE"}}]))
+    assert resp.status_code == 200
+    assert client.get(url, headers = h).json["content"] == [
+        {"type": "ENTRY", "text": "a", "origin": "computer", "checked": False},
+        {"type": "ENTRY", "origin": "computer", "checked": True},
+        {"type": "PAGE"}]
+
+    resp = client.patch(url, headers = dict(h, **{"If-Match": etag}), json = {"0": {"checked": True}})
+    assert resp.status_code == 412
+    resp = client.patch(url, headers = h, json = {"5": {"checked": True}})
+    assert resp.status_code == 409
+    resp = client.patch(url, headers = h, json = [1, 2])
+    assert resp.status_code == 400
+    resp = client.patch('/directories/patchdoc.pdf/2/annotation', headers = h, json = {"0": {"checked": True}})
+    assert resp.status_code == 404
+
+def test_batch_annotations(client):
+    h = { 'Authorization': DEBUG_TOKEN }
+    payload = {"views": {"1": [{"type": "PAGE"}], "3": [{"type": "TITLE"}]}}
+    resp = client.put('/directories/batchdoc.pdf/annotations', headers = h, json = payload)
+    assert resp.status_code == 200
+    assert resp.json == {"views": {"1": {"status": 200}, "3": {"status": 200}}}
+    # Nothing is saved when a view is invalid
+    for key, content in [("x", []), ("\u00b2", []), ("0", []), ("2", {"type": "PAGE"}), ("2", None), ("2", [1])]:
+        resp = client.put('/directories/batchdoc.pdf/annotations', headers = h,
+                          json = {"views": {"2": [{"type": "PAGE"}], key: content}})
+        assert resp.status_code == 400
+        assert f"view &#39;{key}&#39;" in resp.get_data(as_text=True)
+    resp = client.put('/directories/batchdoc.pdf/annotations', headers = h,
+                      json = {"views": {str(view): [] for view in range(1, 1002)}})
+    assert resp.status_code == 400
+
+    resp = client.get('/directories/batchdoc.pdf/annotations?views=1-3', headers = h)
+    assert resp.status_code == 200
+    assert resp.json == {"views": {
+        "1": {"status": 200, "content": [{"type": "PAGE"}]},
+        "2": {"status": 404},
+        "3": {"status": 200, "content": [{"type": "TITLE"}]}}}
+
+    for bad_views in ["", "3-1", "a", "0", "0-2", "0-100000"]:
+        resp = client.get(f'/directories/batchdoc.pdf/annotations?views={bad_views}', headers = h)
+        assert resp.status_code == 400
+
+def test_corrupted_annotations(app, client):
+    h = { 'Authorization': DEBUG_TOKEN }
+    client.put('/directories/corruptdoc.pdf/1/annotation', headers = h, json = {"content": [{"type": "PAGE"}]})
+    with open(os.path.join(app.config[ANNOT_PATH], "corruptdoc.zip.log"), "r+b") as log_file:
+        log_file.write(b"XXXX")
+    resp = client.get('/directories/corruptdoc.pdf/1/annotation', headers = h)
+    assert resp.status_code == 500
+    resp = client.patch('/directories/corruptdoc.pdf/1/annotation', headers = h, json = {"0": {"checked": True}})
+    assert resp.status_code == 500
+    resp = client.get('/directories/corruptdoc.pdf/annotations?views=1', headers = h)
+    assert resp.json == {"views": {"1": {"status": 500}}}
+
+def test_sort_annotations_on_save(client):
+    h = { 'Authorization': DEBUG_TOKEN }
+    column = {"type": "COLUMN_LEVEL_1", "box": [0, 0, 100, 500]}
+    first = {"type": "ENTRY", "box": [0, 0, 10, 10], "origin": "computer", "checked": False}
+    second = {"type": "ENTRY", "box": [0, 100, 10, 10], "origin": "computer", "checked": False}
+    client.application.config[ANNOT_SORT_ON_SAVE] = True
+    resp = client.put('/directories/sortdoc.pdf/1/annotation', headers = h, json = {"content": [second, column, first]})
+    assert resp.status_code == 200
+    resp = client.get('/directories/sortdoc.pdf/1/annotation', headers = h)
+    assert resp.json["content"] == [column, first, second]
+
+def test_query_elements(client):
+    h = { 'Authorization': DEBUG_TOKEN }
+    entry = {"type": "ENTRY", "box": [10, 10, 50, 20]}
+    title = {"type": "TITLE_LEVEL_1", "box": [200, 10, 50, 20]}
+    client.put('/directories/querydoc.pdf/1/annotation', headers = h, json = {"content": [entry, title]})
+    client.put('/directories/querydoc.pdf/annotations', headers = h, json = {"views": {"2": [title], "3": [entry]}})
+    client.patch('/directories/querydoc.pdf/3/annotation', headers = h, json = {"0": {"text": "Didot"}})
+
+    resp = client.get('/directories/querydoc.pdf/elements?type=ENTRY', headers = h)
+    assert resp.status_code == 200
+    assert [(e["view"], e["index"], e["element"].get("text")) for e in resp.json["elements"]] == \
+        [(1, 0, None), (3, 0, "Didot")]
+    resp = client.get('/directories/querydoc.pdf/elements?views=1-2&box=150,0,100,100', headers = h)
+    assert [(e["view"], e["index"]) for e in resp.json["elements"]] == [(1, 1), (2, 0)]
+    resp = client.get('/directories/Didot_1851a-sample.pdf/elements?views=1&type=ENTRY', headers = h)
+    assert resp.status_code == 200
+    resp = client.get('/directories/querydoc.pdf/elements?box=1,2', headers = h)
+    assert resp.status_code == 400
+
+def test_search_annotations(client):
+    h = { 'Authorization': DEBUG_TOKEN }
+    entry = {"type": "ENTRY", "box": [10, 10, 50, 20], "text": "Didot frères, imprimeurs"}
+    resp = client.put('/directories/searchdoc.pdf/1/annotation', headers = h, json = {"content": [entry]})
+    # Indexed once the response is sent
+    assert client.get('/directories/search?q=freres', headers = h).json["hits"] == []
+    resp.close()
+    resp = client.get('/directories/search?q=freres', headers = h)
+    assert resp.status_code == 200
+    assert [(hit["document"], hit["view"], hit["path"]) for hit in resp.json["hits"]] == [("searchdoc", 1, "/0")]
+
+    # Uploaded archives are indexed
+    resp = client.get('/directories/search?q=Vendome&document=Didot_1851a-sample.pdf', headers = h)
+    assert resp.json["hits"] == []
+    with open(os.path.join(os.path.dirname(__file__), 'resources', 'annotations', 'Didot_1851a-sample.zip'), 'rb') as f:
+        resp = client.put('/directories/Didot_1851a-sample.pdf/replace_directory', headers = h, data = f.read())
+    assert resp.status_code == 200
+    resp = client.get('/directories/search?q=Vendome&document=Didot_1851a-sample.pdf', headers = h)
+    assert len(resp.json["hits"]) > 0
+    assert client.get('/directories/search?q=x&limit=0', headers = h).status_code == 400
 
 # IMAGE
 def test_get_last_valid_image(client):
     h = { 'Authorization': DEBUG_TOKEN }
     resp = client.get( '/directories/Didot_1842a-sample.pdf/4/image', headers = h)
     assert resp.status_code == 200
+    assert resp.mimetype == "image/jpeg"
     assert len(resp.data) > 0
+    assert "Accept" in resp.headers["Vary"]
+
+def test_get_image_not_modified(client):
+    h = { 'Authorization': DEBUG_TOKEN }
+    resp = client.get( '/directories/Didot_1842a-sample.pdf/3/image', headers = h)
+    assert resp.status_code == 200
+    etag = resp.headers["ETag"]
+    assert "Last-Modified" in resp.headers
+
+    h_cond = { 'Authorization': DEBUG_TOKEN, 'If-None-Match': etag }
+    resp2 = client.get( '/directories/Didot_1842a-sample.pdf/3/image', headers = h_cond)
+    assert resp2.status_code == 304
+    assert len(resp2.data) == 0
+    assert "Accept" in resp2.headers["Vary"]
+
+    # Other views have other tags
+    resp3 = client.get( '/directories/Didot_1842a-sample.pdf/4/image', headers = h_cond)
+    assert resp3.status_code == 200
+
+def test_get_image_thumbnail(client):
+    h = { 'Authorization': DEBUG_TOKEN }
+    resp = client.get( '/directories/Didot_1842a-sample.pdf/4/image/thumbnail', headers = h)
+    assert resp.status_code == 200
+    assert resp.mimetype == "image/jpeg"
+    with Image.open(BytesIO(resp.data)) as image:
+        assert max(image.size) == 256
+
+def test_get_image_unknown_variant(client):
+    h = { 'Authorization': DEBUG_TOKEN }
+    resp = client.get( '/directories/Didot_1842a-sample.pdf/4/image/huge', headers = h)
+    assert resp.status_code == 404
+
+def test_get_tiles(client):
+    h = { 'Authorization': DEBUG_TOKEN }
+    resp = client.get( '/directories/Didot_1842a-sample.pdf/4/tiles', headers = h)
+    assert resp.status_code == 200
+    info = resp.json
+    assert (info["width"], info["height"], info["tile_size"]) == (2048, 3034, 512)
+    assert info["levels"] == 4
+
+    # Full resolution, bottom-right tile
+    resp = client.get( '/directories/Didot_1842a-sample.pdf/4/tiles/0/3_5.jpg', headers = h)
+    assert resp.status_code == 200
+    with Image.open(BytesIO(resp.data)) as image:
+        assert image.size == (512, 3034 - 5 * 512)
+
+    # Whole page in a single tile
+    resp = client.get( '/directories/Didot_1842a-sample.pdf/4/tiles/3/0_0.jpg', headers = h)
+    assert resp.status_code == 200
+    with Image.open(BytesIO(resp.data)) as image:
+        assert image.size == (256, 380)
+
+    resp = client.get( '/directories/Didot_1842a-sample.pdf/4/tiles/0/4_0.jpg', headers = h)
+    assert resp.status_code == 404
+    resp = client.get( '/directories/Didot_1842a-sample.pdf/4/tiles/4/0_0.jpg', headers = h)
+    assert resp.status_code == 404
 
 # def test_get_non_jpeg_image(client): #TODO: Sample a Pdf with all the different images type
 #     h = { 'Authorization': DEBUG_TOKEN }
@@ -28,8 +333,18 @@ def test_get_last_valid_image(client):
 def test_get_rasterize_image(client):
     h = { 'Authorization': DEBUG_TOKEN }
     resp = client.get( '/directories/Didot_1842a-sample.pdf/1/image', headers = h)
-    assert resp.status_code == 500 # TODO: On the long term should be fix to return code: 200
-    assert len(resp.data) > 0
+    assert resp.status_code == 200
+    assert resp.mimetype == "image/png"
+    with Image.open(BytesIO(resp.data)) as image:
+        assert image.size == (2731, 4096)  # page is 2048x3072 pt, rendered at most 4096 px high
+
+def test_get_rasterize_image_tiles(client):
+    h = { 'Authorization': DEBUG_TOKEN }
+    resp = client.get( '/directories/Didot_1842a-sample.pdf/1/tiles', headers = h)
+    assert resp.status_code == 200
+    assert (resp.json["width"], resp.json["height"]) == (2731, 4096)
+    resp = client.get( '/directories/Didot_1842a-sample.pdf/1/tiles/1/2_3.jpg', headers = h)
+    assert resp.status_code == 200
 
 def test_get_unavailable_image(client):
     h = { 'Authorization': DEBUG_TOKEN }
@@ -51,6 +366,25 @@ def test_get_unavailable_image_unk_doc(client):
     resp = client.get( '/directories/unknown/10/image', headers = h)
     assert resp.status_code == 404
 
+def test_get_image_workers_busy(app, client):
+    h = { 'Authorization': DEBUG_TOKEN }
+    workers = ImageWorkers(1, 0, 30, 4, {"workers": 0, "dpi": 150, "timeout": 60, "memory_limit": 0})
+    app.config[IMAGE_POOL] = workers
+    job = threading.Thread(target=workers.run, args=(time.sleep, 1))
+    job.start()
+    while workers.info()["pending"] == 0:
+        time.sleep(0.01)
+    resp = client.get( '/directories/Didot_1842a-sample.pdf/4/image', headers = h)
+    assert resp.status_code == 503
+    assert int(resp.headers["Retry-After"]) >= 1
+    # Other requests are not delayed
+    assert client.get( '/directories/Didot_1842a-sample.pdf/3/annotation', headers = h).status_code == 200
+    assert client.get('/health_check/').status_code == 200
+    job.join()
+    resp = client.get( '/directories/Didot_1842a-sample.pdf/4/image', headers = h)
+    workers.shutdown()
+    assert resp.status_code == 200
+
 # DOWNLOAD / UPLOAD
 def test_download_directory_unavail(client):
     h = { 'Authorization': DEBUG_TOKEN }
@@ -72,6 +406,48 @@ def test_download_directory_avail(client):
         files_in_zip = set(zipObj.namelist())
     assert files_in_zip == files_expected
     
+def test_download_directory_range_and_etag(client):
+    h = { 'Authorization': DEBUG_TOKEN }
+    resp = client.get( '/directories/Didot_1842a-sample/download_directory', headers = h)
+    assert resp.status_code == 200
+    assert resp.headers["Accept-Ranges"] == "bytes"
+    full = resp.data
+    etag = resp.headers["ETag"]
+
+    resp2 = client.get( '/directories/Didot_1842a-sample/download_directory',
+        headers = dict(h, Range = "bytes=10-99", **{"If-Range": etag}))
+    assert resp2.status_code == 206
+    assert resp2.data == full[10:100]
+    assert resp2.headers["Content-Range"] == f"bytes 10-99/{len(full)}"
+
+    resp3 = client.get( '/directories/Didot_1842a-sample/download_directory',
+        headers = dict(h, **{"If-None-Match": etag}))
+    assert resp3.status_code == 304
+
+def test_upload_directory_invalid(client):
+    h = { 'Authorization': DEBUG_TOKEN }
+    resp = client.get( '/directories/Didot_1842a-sample/download_directory', headers = h)
+    data = resp.data
+    for bad_data in [data[:len(data) // 2], data[len(data) // 2:], b"", b"not a zip"]:
+        resp2 = client.put('/directories/Didot_1842a-sample/replace_directory', headers = h, data=bad_data)
+        assert resp2.status_code == 400
+    resp3 = client.get( '/directories/Didot_1842a-sample/download_directory', headers = h)
+    assert resp3.data == data
+
+def test_upload_directory_merge(client):
+    h = { 'Authorization': DEBUG_TOKEN }
+    client.put('/directories/mergedoc/1/annotation', headers = h, json={"content": [{"type": "PAGE"}]})
+    client.put('/directories/mergedoc/2/annotation', headers = h, json={"content": [{"type": "PAGE"}]})
+    io_zip = BytesIO()
+    with zipfile.ZipFile(io_zip, 'w') as zipObj:
+        zipObj.writestr("0002.json", '[{"type": "TITLE"}]')
+        zipObj.writestr("0003.json", '[{"type": "TITLE"}]')
+    resp = client.put('/directories/mergedoc/replace_directory?merge=1', headers = h, data=io_zip.getvalue())
+    assert resp.status_code == 200
+    for view, expected in [(1, "PAGE"), (2, "TITLE"), (3, "TITLE")]:
+        resp2 = client.get(f'/directories/mergedoc/{view}/annotation', headers = h)
+        assert resp2.json["content"] == [{"type": expected}]
+
 # Upload to new and existing
 def test_upload_directory_new_then_existing(client):
     h_down = { 'Authorization': DEBUG_TOKEN }
@@ -118,6 +494,7 @@ def test_upload_directory_new_then_existing(client):
     assert resp5.status_code == 200
 
     # upload again and overwrite
+    io_zip.seek(0)
     resp6 = client.put(
         f'/directories/{new_doc_name}/replace_directory',
         headers = h_up, 
@@ -1,7 +1,53 @@
+import json
+import os
+import shutil
+import socket
+import subprocess
+import threading
+import time
 import zipfile
+import zlib
+from collections import OrderedDict
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
 from directory_annotator_storage.backend_annotations import (
-    load_annotations, save_annotations, get_document_annotations_as_zip_file, 
-    replace_document_annotations)
+    VersionMismatchError, SaveError,
+    AnnotationsNotFoundError, load_annotations, save_annotations, get_document_annotations_as_zip_file, 
+    replace_document_annotations, compact_annotations, InvalidArchiveError, annotation_cache_info, configure_annotation_cache,
+    load_deflated_annotations, save_many_annotations, group_commit_info)
+from directory_annotator_storage.annotation_cache import AnnotationCache
+from directory_annotator_storage.backend_documents import (
+    DocumentNotFoundError, DocumentReadError, configure_pdf_cache, get_decoded_image_from_view, get_document_pages,
+    get_image_from_view, pdf_cache_info)
+import directory_annotator_storage.annotation_log as alog
+from directory_annotator_storage.annotation_backend import create_annotation_backend
+from directory_annotator_storage.backend_annotations_sqlite import SQLiteAnnotationBackend
+import directory_annotator_storage.catalog as catalog_module
+from directory_annotator_storage.catalog import DocumentCatalog
+from directory_annotator_storage.constants_config import (
+    ANNOT_BACKEND, ANNOT_PATH, CACHE_PATH, DEFAULT_ANNOT_CACHE_SIZE, DEFAULT_PDF_CACHE_SIZE)
+from directory_annotator_storage.image_cache import ImageCache
+import directory_annotator_storage.image_variants as image_variants
+from directory_annotator_storage.image_variants import InvalidTileIndexError, get_tile_from_view, level_size
+from directory_annotator_storage.image_workers import ImageWorkers, ImageWorkersBusyError
+import directory_annotator_storage.instrumentation as instrumentation
+import directory_annotator_storage.worker_pool as worker_pool
+from directory_annotator_storage.worker_pool import WorkerPool
+from directory_annotator_storage.group_commit import GroupCommitter
+from directory_annotator_storage.json_patch import (
+    InvalidPatchError, PatchConflictError, apply_json_patch, apply_keyed_diff)
+from directory_annotator_storage.prefetch import Prefetcher
+from directory_annotator_storage.search_index import SearchIndex, extract_texts, search_index_path
+from directory_annotator_storage.search_index import main as search_index_main
+from directory_annotator_storage.spatial_index import SpatialIndex
+from directory_annotator_storage.reading_order import assign_columns, sort_documents, sort_entries, sort_page
+import directory_annotator_storage.reading_order as reading_order
+import directory_annotator_storage.zip_index as zindex
+
 
 def test_save_load_roundtrip(annot_path):
     data = {"a": 1, "b": 1.5, "c": "éàœß🚀" }
@@ -11,6 +57,7 @@ def test_save_load_roundtrip(annot_path):
     data2 = load_annotations(annot_path, doc_name, 1)
     assert data == data2
 
+
 def test_save_twice_load_roundtrip(annot_path):
     data = {"a": 1, "b": 1.5, "c": "éàœß🚀" }
     doc_name = "testdoc.pdf"
@@ -36,6 +83,7 @@ def test_save_empty_pages_before(annot_path):
     data4 = load_annotations(annot_path, doc_name, 2)
     assert data3 == data4
 
+
 def test_download_zipfile(annot_path):
     data = {"a": 1, "b": 1.5, "c": "éàœß🚀" }
     doc1_name = "testdoc1.pdf"
@@ -49,6 +97,7 @@ def test_download_zipfile(annot_path):
         files_in_zip = set(zipObj.namelist())
     assert files_in_zip == files_expected
     
+
 def test_download_upload_zipfile(annot_path):
     data = {"a": 1, "b": 1.5, "c": "éàœß🚀" }
     doc1_name = "testdoc1.pdf"
@@ -78,3 +127,975 @@ def test_download_upload_zipfile(annot_path):
         files_in_zip3 = set(zipObj.namelist())
     assert files_in_zip3 == files_expected
 
+
+# DOCUMENTS
+def test_pdf_cache_hit_on_same_document(doc_path):
+    doc_name = "Didot_1842a-sample.pdf"
+    get_document_pages(doc_path, doc_name)
+    before = pdf_cache_info()
+    assert get_document_pages(doc_path, doc_name) == 4
+    assert len(get_image_from_view(doc_path, doc_name, 3)[0]) > 0
+    after = pdf_cache_info()
+    assert after["hits"] == before["hits"] + 2
+    assert after["misses"] == before["misses"]
+
+
+def test_pdf_cache_bounded(doc_path):
+    configure_pdf_cache(1)
+    try:
+        for doc_name in ["Didot_1842a-sample.pdf", "Didot_1848a-sample.pdf", "Didot_1851a-sample.pdf"]:
+            assert get_document_pages(doc_path, doc_name) == 4
+            assert pdf_cache_info()["size"] == 1
+    finally:
+        configure_pdf_cache(DEFAULT_PDF_CACHE_SIZE)
+
+
+def test_pdf_cache_reopens_modified_document(doc_path):
+    doc_name = "Didot_1842a-sample.pdf"
+    get_document_pages(doc_path, doc_name)
+    # Replace the document with another one
+    os.replace(os.path.join(doc_path, "Didot_1848a-sample.pdf"), os.path.join(doc_path, doc_name))
+    misses = pdf_cache_info()["misses"]
+    assert get_document_pages(doc_path, doc_name) == 4
+    assert pdf_cache_info()["misses"] == misses + 1
+
+
+def test_jpeg_page_passthrough(doc_path):
+    data, mimetype = get_image_from_view(doc_path, "Didot_1842a-sample.pdf", 4)
+    assert mimetype == "image/jpeg"
+    assert data[:3] == b"\xff\xd8\xff"  # JPEG magic number
+
+
+def test_jpeg_page_decoded_without_passthrough(doc_path):
+    data, mimetype = get_image_from_view(doc_path, "Didot_1842a-sample.pdf", 4, passthrough_types=())
+    assert mimetype == "image/png"
+    assert data[:8] == b"\x89PNG\r\n\x1a\n"
+
+
+def test_tile_levels_scaled_from_cached_page(doc_path, monkeypatch):
+    decoded = []
+
+    def decode(*args):
+        decoded.append(args)
+        return get_decoded_image_from_view(*args)
+    monkeypatch.setattr(image_variants, "get_decoded_image_from_view", decode)
+    page_size = DocumentCatalog(doc_path).get("Didot_1842a-sample.pdf")["page_sizes"][2]
+    # Checked against the size of the page, without decoding it
+    for level, column in [(0, 100), (10, 0), (-1, 0)]:
+        with pytest.raises(InvalidTileIndexError):
+            get_tile_from_view(doc_path, "Didot_1842a-sample.pdf", 3, level, column, 0, 256, page_size)
+    assert len(decoded) == 0
+    for level in [1, 3, 2]:
+        image_data, _ = get_tile_from_view(doc_path, "Didot_1842a-sample.pdf", 3, level, 0, 0, 256, page_size)
+        with Image.open(BytesIO(image_data)) as tile:
+            assert tile.size == tuple(min(256, v) for v in level_size(*page_size, level))
+    assert len(decoded) == 1
+
+
+def test_decoded_pages_bounded_by_bytes(doc_path, monkeypatch):
+    monkeypatch.setattr(image_variants, "_DECODED_CACHE_BYTES", 4 * 1024 ** 2)
+    monkeypatch.setattr(image_variants, "_decoded_pages", OrderedDict())
+    monkeypatch.setattr(image_variants, "_decoded_bytes", 0)
+    for level in [2, 3]:
+        image_variants._scaled_page(doc_path, "Didot_1842a-sample.pdf", 3, level)
+    # The full page is larger than the budget: only its scaled levels are kept
+    assert [key[-1] for key in image_variants._decoded_pages] == [2, 3]
+    assert 0 < image_variants._decoded_bytes <= 4 * 1024 ** 2
+
+
+# CATALOG
+def test_catalog_entries(doc_path):
+    catalog = DocumentCatalog(doc_path)
+    catalog.refresh()
+    assert catalog.document_names() == [
+        "Didot_1842a-sample.pdf", "Didot_1848a-sample.pdf", "Didot_1851a-sample.pdf"]
+    entry = catalog.get("Didot_1842a-sample.pdf")
+    assert entry["num_pages"] == 4
+    assert entry["page_sizes"][2] == [2048, 2892]
+
+
+def test_catalog_incremental_refresh(doc_path):
+    catalog = DocumentCatalog(doc_path)
+    catalog.refresh()
+    os.remove(os.path.join(doc_path, "Didot_1848a-sample.pdf"))
+    assert catalog.document_names() == ["Didot_1842a-sample.pdf", "Didot_1851a-sample.pdf"]
+    with pytest.raises(DocumentNotFoundError):
+        catalog.get("Didot_1848a-sample.pdf")
+
+
+def test_catalog_shared_index(doc_path, annot_path, monkeypatch):
+    index_path = os.path.join(annot_path, "catalog.json")
+    DocumentCatalog(doc_path, index_path, max_workers=2).refresh(parallel=True)
+    assert os.path.exists(index_path)
+
+    # Another worker reads the index instead of opening the documents again
+    def fail(path):
+        raise AssertionError(f"{path} should not be opened")
+    monkeypatch.setattr(catalog_module, "_describe_document", fail)
+    catalog = DocumentCatalog(doc_path, index_path)
+    catalog.refresh()
+    assert len(catalog.document_names()) == 3
+    assert catalog.get("Didot_1851a-sample.pdf")["num_pages"] == 4
+
+
+# IMAGE CACHE
+def test_image_cache_produces_once(annot_path):
+    cache = ImageCache(os.path.join(annot_path, "images"), 1000)
+    calls = []
+
+    def produce():
+        calls.append(1)
+        return b"x" * 10, "image/png"
+    path, mimetype = cache.get_or_create("ab" * 32, produce)
+    path2, _ = cache.get_or_create("ab" * 32, produce)
+    assert path == path2
+    assert mimetype == "image/png"
+    assert len(calls) == 1
+    with open(path, "rb") as f:
+        assert f.read() == b"x" * 10
+
+
+def test_image_cache_eviction(annot_path):
+    cache = ImageCache(os.path.join(annot_path, "images"), 250)
+    keys = [f"{i:064x}" for i in range(5)]
+    for i, key in enumerate(keys):
+        path, _ = cache.get_or_create(key, lambda: (b"x" * 100, "image/png"))
+        os.utime(path, (i, i))  # make access order explicit
+        cache.evict()
+    assert cache.usage() <= 250
+    assert cache.get(keys[-1]) is not None
+    assert cache.get(keys[0]) is None
+    # Lock files are kept
+    assert os.path.exists(os.path.join(annot_path, "images", keys[0][:2], keys[0] + ".lock"))
+
+
+def test_image_cache_scans_after_threshold(annot_path, monkeypatch):
+    cache = ImageCache(os.path.join(annot_path, "images"), 1000)
+    scans = []
+    monkeypatch.setattr(cache, "evict", lambda: scans.append(1))
+    for i in range(19):
+        cache.get_or_create(f"{i:064x}", lambda: (b"x" * 10, "image/png"))
+    # A scan each time a tenth of the budget was written
+    assert len(scans) == 1
+
+
+def test_image_cache_entry_evicted_before_open(annot_path, monkeypatch):
+    cache = ImageCache(os.path.join(annot_path, "images"), 1000)
+    path, _ = cache.get_or_create("ab" * 32, lambda: (b"x" * 10, "image/png"))
+    os.remove(path)
+    monkeypatch.setattr(cache, "get_or_create", lambda key, produce: (path, "image/png"))
+    image_file, mimetype = cache.open_or_create("ab" * 32, lambda: (b"y" * 10, "image/png"))
+    assert (image_file.read(), mimetype) == (b"y" * 10, "image/png")
+
+
+# IMAGE WORKERS
+_RASTER_SETTINGS = {"workers": 0, "dpi": 150, "timeout": 60, "memory_limit": 0}
+
+
+def test_image_workers_reject_when_saturated():
+    workers = ImageWorkers(1, 0, 30, 4, _RASTER_SETTINGS)
+    job = threading.Thread(target=workers.run, args=(time.sleep, 1))
+    job.start()
+    while workers.info()["pending"] == 0:
+        time.sleep(0.01)
+    with pytest.raises(ImageWorkersBusyError) as err:
+        workers.run(abs, -1)
+    assert err.value.retry_after >= 1
+    job.join()
+    assert workers.run(abs, -1) == 1
+    info = workers.info()
+    workers.shutdown()
+    assert (info["pending"], info["completed"], info["rejected"]) == (0, 2, 1)
+
+
+def test_image_workers_background_jobs():
+    workers = ImageWorkers(1, 0, 30, 4, _RASTER_SETTINGS)
+    job = threading.Thread(target=workers.run, args=(time.sleep, 1))
+    job.start()
+    while workers.info()["pending"] == 0:
+        time.sleep(0.01)
+    # Not run while the pool has other jobs
+    with pytest.raises(ImageWorkersBusyError):
+        workers.run(abs, -1, background=True)
+    job.join()
+    background = threading.Thread(target=workers.run, args=(time.sleep, 1), kwargs={"background": True})
+    background.start()
+    while workers.info()["pending"] == 0:
+        time.sleep(0.01)
+    # Background jobs do not count in the admission of the other jobs (the queue is empty)
+    assert workers.run(abs, -1) == 1
+    assert workers.run(abs, -2) == 2
+    background.join()
+    info = workers.info()
+    workers.shutdown()
+    assert (info["pending"], info["background"], info["completed"], info["rejected"]) == (0, 0, 4, 0)
+
+
+def test_worker_pool_starts_processes_outside_lock(monkeypatch):
+    proceed = threading.Event()
+    starting = []
+
+    class SlowWorker(worker_pool._Worker):
+        def __init__(self, *args):
+            starting.append(self)
+            if len(starting) == 1:
+                proceed.wait(10)
+            super().__init__(*args)
+
+    monkeypatch.setattr(worker_pool, "_Worker", SlowWorker)
+    pool = WorkerPool(2)
+    first = threading.Thread(target=pool.run, args=(abs, -1))
+    first.start()
+    while len(starting) == 0:
+        time.sleep(0.01)
+    # The other slot is usable while the first process starts
+    results = []
+    second = threading.Thread(target=lambda: results.append(pool.run(abs, -2)))
+    second.start()
+    second.join(5)
+    assert results == [2]
+    proceed.set()
+    first.join()
+    pool.shutdown()
+    with pytest.raises(worker_pool.WorkerPoolError):
+        pool.run(abs, -3)
+
+
+def test_image_workers_timeout():
+    workers = ImageWorkers(1, 0, 0.5, 4, _RASTER_SETTINGS)
+    with pytest.raises(DocumentReadError):
+        workers.run(time.sleep, 30)
+    workers.timeout = 30  # the process is replaced
+    assert workers.run(abs, -1) == 1
+    workers.shutdown()
+    assert workers.info()["timeouts"] == 1
+
+
+def test_image_workers_timeout_kills_only_the_job():
+    workers = ImageWorkers(2, 2, 1, 4, _RASTER_SETTINGS)
+    slow = []
+    stuck = threading.Thread(target=lambda: slow.append(pytest.raises(DocumentReadError, workers.run, time.sleep, 30)))
+    stuck.start()
+    # Queued behind each other: the waiting time does not count in the timeout
+    results = []
+    jobs = [threading.Thread(target=lambda: results.append(workers.run(time.sleep, 0.4))) for _ in range(3)]
+    for job in jobs:
+        job.start()
+    for job in jobs + [stuck]:
+        job.join()
+    workers.shutdown()
+    assert results == [None] * 3 and len(slow) == 1
+    assert workers.info()["timeouts"] == 1
+
+
+def test_image_workers_produce_images(doc_path):
+    workers = ImageWorkers(1, 0, 30, 4, _RASTER_SETTINGS)
+    image_data, mimetype = workers.run(get_image_from_view, doc_path, "Didot_1842a-sample.pdf", 4)
+    with pytest.raises(DocumentNotFoundError):
+        workers.run(get_image_from_view, doc_path, "unknown", 4)
+    workers.shutdown()
+    assert mimetype == "image/jpeg"
+    assert (image_data, mimetype) == get_image_from_view(doc_path, "Didot_1842a-sample.pdf", 4)
+
+
+# METRICS
+def test_metrics_aggregated_over_processes(annot_path):
+    metrics_path = os.path.join(annot_path, "metrics")
+    instrumentation.configure_metrics(metrics_path)
+    try:
+        # Metrics of a process which exited
+        exited = subprocess.Popen(["true"])
+        exited.wait()
+        with open(os.path.join(metrics_path, f"{socket.gethostname()}-{exited.pid}.json"), "w") as f:
+            json.dump({
+                "counters": [["soduco_pdf_pages_decoded_total", {"kind": "test"}, 2]],
+                "histograms": [["soduco_annotation_write_bytes", {"kind": "test"}, [1] + [0] * 9, 100]],
+                "gauges": [["soduco_test_size", {}, 5]],
+            }, f)
+        instrumentation.increment("soduco_pdf_pages_decoded_total", kind="test")
+        instrumentation.observe("soduco_annotation_write_bytes", 10 ** 9, kind="test")
+        text = instrumentation.export()
+        assert 'soduco_pdf_pages_decoded_total{kind="test"} 3' in text
+        assert 'soduco_annotation_write_bytes_bucket{kind="test",le="256.0"} 1' in text
+        assert 'soduco_annotation_write_bytes_bucket{kind="test",le="16777216.0"} 1' in text
+        assert 'soduco_annotation_write_bytes_bucket{kind="test",le="+Inf"} 2' in text
+        assert 'soduco_annotation_write_bytes_sum{kind="test"} 1000000100' in text
+        assert "soduco_test_size" not in text  # gauges of exited processes are dropped
+        assert sorted(os.listdir(metrics_path)) == sorted([
+            "archive.json", "archive.json.lock", f"{socket.gethostname()}-{os.getpid()}.json"])
+        # Counters do not decrease
+        assert 'soduco_pdf_pages_decoded_total{kind="test"} 3' in instrumentation.export()
+    finally:
+        instrumentation.configure_metrics(None)
+
+
+def test_metrics_collector_counters(annot_path, caplog):
+    instrumentation.register_collector("test_cache", lambda: {"hits": 3, "misses": 1, "size": 2},
+                                       ("size",), ("hits", "misses"))
+    text = instrumentation.export()
+    assert "# TYPE soduco_test_cache_hits_total counter\nsoduco_test_cache_hits_total 3\n" in text
+    assert "soduco_test_cache_misses_total 1\n" in text
+    assert "# TYPE soduco_test_cache_size gauge\nsoduco_test_cache_size 2\n" in text
+    assert "soduco_test_cache_hit_ratio 0.75\n" in text
+    # No warning when the metrics directory was removed before the exit
+    metrics_path = os.path.join(annot_path, "metrics")
+    instrumentation.configure_metrics(metrics_path)
+    try:
+        shutil.rmtree(metrics_path)
+        instrumentation._registry.flush()
+        assert not os.path.exists(metrics_path)
+        assert caplog.records == []
+    finally:
+        instrumentation.configure_metrics(None)
+        instrumentation.register_collector("test_cache", dict, ())
+
+
+# PREFETCH
+def _wait_idle(prefetcher):
+    for _ in range(100):
+        if prefetcher.info()["pending"] == 0:
+            return
+        time.sleep(0.01)
+
+
+def test_prefetch_next_views():
+    warmed = []
+    prefetcher = Prefetcher(2, 1, [lambda doc, view: warmed.append((doc, view))])
+    prefetcher.schedule("doc.pdf", 3)
+    _wait_idle(prefetcher)
+    prefetcher.schedule("doc.pdf", 4)  # view 5 is already warmed, will warm again
+    _wait_idle(prefetcher)
+    prefetcher.shutdown()
+    assert warmed[:2] == [("doc.pdf", 4), ("doc.pdf", 5)]
+    assert ("doc.pdf", 6) in warmed
+
+
+def test_prefetch_paused_by_foreground_requests():
+    warmed = []
+    prefetcher = Prefetcher(2, 1, [lambda doc, view: warmed.append(view)])
+    prefetcher.foreground_started()
+    prefetcher.schedule("doc.pdf", 1)
+    _wait_idle(prefetcher)
+    prefetcher.foreground_finished()
+    prefetcher.shutdown()
+    assert warmed == []
+    assert prefetcher.info()["dropped"] == 2
+
+
+def test_prefetch_cancels_unwanted_views():
+    release = threading.Event()
+    warmed = []
+
+    def warm(doc, view):
+        release.wait(1)
+        warmed.append(view)
+    prefetcher = Prefetcher(3, 1, [warm])
+    prefetcher.schedule("doc.pdf", 10)  # 11 starts, 12 and 13 are queued
+    prefetcher.schedule("doc.pdf", 50)  # 12 and 13 are not wanted anymore
+    release.set()
+    _wait_idle(prefetcher)
+    prefetcher.shutdown()
+    assert 12 not in warmed and 13 not in warmed
+    assert 51 in warmed
+
+
+# APPEND-ONLY STORAGE
+def test_save_does_not_rewrite_archive(annot_path):
+    doc_name = "testdoc.pdf"
+    zip_path = os.path.join(annot_path, "testdoc.zip")
+    for v in [1, 2, 3]:
+        save_annotations(annot_path, doc_name, v, {"v": v})
+    compact_annotations(annot_path, doc_name)
+    before = os.stat(zip_path)
+
+    save_annotations(annot_path, doc_name, 2, {"v": "updated"})
+    save_annotations(annot_path, doc_name, 4, {"v": 4})
+    after = os.stat(zip_path)
+    assert (before.st_ino, before.st_mtime_ns, before.st_size) == (after.st_ino, after.st_mtime_ns, after.st_size)
+    assert load_annotations(annot_path, doc_name, 2) == {"v": "updated"}
+    assert load_annotations(annot_path, doc_name, 4) == {"v": 4}
+
+
+def test_compaction_folds_log(annot_path):
+    doc_name = "testdoc.pdf"
+    for v in [1, 2]:
+        save_annotations(annot_path, doc_name, v, {"v": v})
+    save_annotations(annot_path, doc_name, 1, {"v": "updated"})
+    compact_annotations(annot_path, doc_name)
+    assert not os.path.exists(os.path.join(annot_path, "testdoc.zip.log"))
+    with zipfile.ZipFile(os.path.join(annot_path, "testdoc.zip")) as zipObj:
+        assert sorted(zipObj.namelist()) == ["0001.json", "0002.json"]
+    assert load_annotations(annot_path, doc_name, 1) == {"v": "updated"}
+
+
+def test_interrupted_save_is_ignored(annot_path):
+    doc_name = "testdoc.pdf"
+    save_annotations(annot_path, doc_name, 1, {"v": 1})
+    # Simulate a crash while appending a record
+    with open(os.path.join(annot_path, "testdoc.zip.log"), "ab") as log_file:
+        log_file.write(b"SDAL\x02\x00")
+    assert load_annotations(annot_path, doc_name, 1) == {"v": 1}
+    save_annotations(annot_path, doc_name, 2, {"v": 2})
+    assert load_annotations(annot_path, doc_name, 2) == {"v": 2}
+    with pytest.raises(AnnotationsNotFoundError):
+        load_annotations(annot_path, doc_name, 3)
+
+
+def test_log_recreated_with_same_inode(annot_path):
+    doc_name = "testdoc.pdf"
+    log_path = os.path.join(annot_path, "testdoc.zip.log")
+    save_annotations(annot_path, doc_name, 1, {"v": 1})
+    old_entry = alog.read_index(log_path).entries[1]
+
+    # Compacted, then created again by another worker, reusing the inode
+    with open(log_path, "r+b") as log_file:
+        log_file.truncate(0)
+    alog.append_records(log_path, [alog.encode_record(2, json.dumps({"v": os.urandom(64).hex()}).encode()),
+                                   alog.encode_record(1, b'{"v": "new"}')])
+    assert load_annotations(annot_path, doc_name, 1) == {"v": "new"}
+    assert sorted(alog.read_index(log_path).entries) == [1, 2]
+    with pytest.raises(FileNotFoundError):
+        alog.read_stored_record(log_path, old_entry)
+
+
+# ARCHIVE INDEX
+def test_archive_index_reads_members(annot_path):
+    zip_path = os.path.join(annot_path, "testdoc.zip")
+    with zipfile.ZipFile(zip_path, "w") as zipOut:
+        zipOut.writestr("0001.json", b"stored")
+        zipOut.writestr("0002.json", b"deflated" * 100, compress_type=zipfile.ZIP_DEFLATED)
+    assert zindex.read_member(zip_path, "0001.json") == b"stored"
+    assert zindex.read_member(zip_path, "0002.json") == b"deflated" * 100
+    assert zindex.read_member(zip_path, "0003.json") is None
+    assert zindex.read_member(os.path.join(annot_path, "missing.zip"), "0001.json") is None
+    assert sorted(zindex.member_names(zip_path)) == ["0001.json", "0002.json"]
+
+
+def test_archive_index_follows_replacement(annot_path):
+    doc_name = "testdoc.pdf"
+    save_annotations(annot_path, doc_name, 1, {"v": 1})
+    compact_annotations(annot_path, doc_name)
+    assert load_annotations(annot_path, doc_name, 1) == {"v": 1}
+
+    data_zip = get_document_annotations_as_zip_file(annot_path, doc_name)
+    save_annotations(annot_path, doc_name, 2, {"v": 2})
+    compact_annotations(annot_path, doc_name)
+    assert load_annotations(annot_path, doc_name, 2) == {"v": 2}
+    replace_document_annotations(annot_path, doc_name, data_zip.read())
+    with pytest.raises(AnnotationsNotFoundError):
+        load_annotations(annot_path, doc_name, 2)
+
+
+# PARSED ANNOTATION CACHE
+def test_annotation_cache_bounded_by_bytes():
+    cache = AnnotationCache(100)
+    cache.put(("doc", 1), "v1", [1], 60)
+    cache.put(("doc", 2), "v1", [2], 30)
+    assert cache.get(("doc", 1), "v1") == [1]
+    assert cache.get(("doc", 1), "v2") is None
+    cache.put(("doc", 3), "v1", [3], 30)  # evicts the least recently used page
+    assert cache.get(("doc", 2), "v1") is None
+    assert cache.get(("doc", 3), "v1") == [3]
+    info = cache.info()
+    assert info["bytes"] == 90 and info["size"] == 2
+    assert info["hits"] == 2 and info["misses"] == 2 and info["hit_ratio"] == 0.5
+
+
+def test_annotation_cache_follows_writes(annot_path):
+    doc_name = "testdoc.pdf"
+    save_annotations(annot_path, doc_name, 1, [{"type": "ENTRY"}])
+    hits = annotation_cache_info()["hits"]
+    first = load_annotations(annot_path, doc_name, 1)
+    assert first == [{"type": "ENTRY", "origin": "computer", "checked": False}]
+    assert load_annotations(annot_path, doc_name, 1) is first
+    assert annotation_cache_info()["hits"] == hits + 2
+
+    # Saved by another worker: the record in the log changed
+    with open(os.path.join(annot_path, "testdoc.zip.log"), "ab") as log_file:
+        log_file.write(alog.encode_record(1, b'[{"type": "ENTRY", "checked": true}]'))
+    assert load_annotations(annot_path, doc_name, 1)[0]["checked"] is True
+    compact_annotations(annot_path, doc_name)
+    assert load_annotations(annot_path, doc_name, 1)[0]["checked"] is True
+
+
+def test_annotation_cache_disabled(annot_path):
+    configure_annotation_cache(0)
+    try:
+        save_annotations(annot_path, "testdoc.pdf", 1, {"v": 1})
+        assert load_annotations(annot_path, "testdoc.pdf", 1) == {"v": 1}
+        assert annotation_cache_info()["size"] == 0
+    finally:
+        configure_annotation_cache(DEFAULT_ANNOT_CACHE_SIZE)
+
+
+# STORAGE CODEC
+def test_saved_views_are_deflated_and_normalized(annot_path):
+    doc_name = "testdoc.pdf"
+    page = [{"type": "ENTRY", "text": "x" * 1000}, {"type": "ENTRY", "origin": "human", "checked": True}]
+    save_annotations(annot_path, doc_name, 1, page)
+    assert "origin" not in page[0]
+    for compact in [False, True]:
+        if compact:
+            compact_annotations(annot_path, doc_name)
+            with zipfile.ZipFile(os.path.join(annot_path, "testdoc.zip")) as zipObj:
+                assert zipObj.getinfo("0001.json").compress_type == zipfile.ZIP_DEFLATED
+        deflated = load_deflated_annotations(annot_path, doc_name, 1)
+        assert len(deflated.data) < 200
+        assert json.loads(zlib.decompress(deflated.data, -zlib.MAX_WBITS)) == [
+            dict(page[0], origin="computer", checked=False), page[1]]
+
+
+def test_uploaded_views_are_not_deflated(annot_path):
+    data_zip = BytesIO()
+    with zipfile.ZipFile(data_zip, "w") as zipOut:
+        zipOut.writestr("0001.json", '[{"type": "ENTRY"}]')
+    replace_document_annotations(annot_path, "testdoc.pdf", data_zip.getvalue())
+    assert load_deflated_annotations(annot_path, "testdoc.pdf", 1) is None
+    assert load_annotations(annot_path, "testdoc.pdf", 1) == [{"type": "ENTRY", "origin": "computer", "checked": False}]
+    with pytest.raises(AnnotationsNotFoundError):
+        load_deflated_annotations(annot_path, "testdoc.pdf", 2)
+
+
+# GROUP COMMIT
+def test_group_commit_batches_waiting_writes():
+    committer = GroupCommitter(0)
+    first_started, release = threading.Event(), threading.Event()
+    batches = []
+
+    def commit(key, items):
+        if len(batches) == 0:
+            first_started.set()
+            release.wait(5)
+        batches.append(list(items))
+        if "bad" in items:
+            raise ValueError("bad")
+        return [item.upper() for item in items], 0.0
+
+    results = {}
+    errors = {}
+
+    def write(item):
+        try:
+            results[item] = committer.submit("doc", item, commit)
+        except ValueError as err:
+            errors[item] = err
+    threads = [threading.Thread(target=write, args=("a",))]
+    threads[0].start()
+    first_started.wait(5)
+    # Queued while the first commit is in progress: committed together
+    for item in ["b", "c", "bad"]:
+        threads.append(threading.Thread(target=write, args=(item,)))
+        threads[-1].start()
+    while len(committer._queues["doc"].writes) < 3:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert batches == [["a"], ["b", "c", "bad"]]
+    assert results == {"a": "A"}
+    assert set(errors) == {"b", "c", "bad"}
+    assert committer.info()["max_batch"] == 3 and committer.info()["commits"] == 2
+
+
+def test_group_commit_leader_returns_after_its_batch():
+    committer = GroupCommitter(0)
+    first_started, release_first, second_started, release_second = (threading.Event() for _ in range(4))
+
+    def commit(key, items):
+        if "a" in items:
+            first_started.set()
+            release_first.wait(5)
+        else:
+            second_started.set()
+            release_second.wait(5)
+        return [item.upper() for item in items], 0.0
+
+    results = {}
+    threads = [threading.Thread(target=lambda item=item: results.update({item: committer.submit("doc", item, commit)}))
+               for item in ["a", "b"]]
+    threads[0].start()
+    first_started.wait(5)
+    threads[1].start()
+    while len(committer._queues["doc"].writes) < 1:
+        time.sleep(0.01)
+    release_first.set()
+    # The first writer returns while the next batch, led by the second writer, is committed
+    threads[0].join(5)
+    assert results == {"a": "A"} and second_started.wait(5)
+    release_second.set()
+    threads[1].join(5)
+    assert results == {"a": "A", "b": "B"} and "doc" not in committer._queues
+
+
+def test_concurrent_saves_are_grouped(annot_path):
+    commits = group_commit_info()["commits"]
+    threads = [
+        threading.Thread(target=save_many_annotations, args=(annot_path, "testdoc.pdf", {v: {"v": v}, 0: {"by": v}}))
+        for v in range(1, 21)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    for v in range(1, 21):
+        assert load_annotations(annot_path, "testdoc.pdf", v) == {"v": v}
+    assert load_annotations(annot_path, "testdoc.pdf", 0)["by"] in range(1, 21)
+    info = group_commit_info()
+    assert 0 < info["commits"] - commits <= 20 and info["lock_wait"] >= 0
+
+
+# PARTIAL UPDATES
+def test_json_patch_operations():
+    page = [{"type": "ENTRY", "box": [1, 2, 3, 4]}, {"type": "PAGE"}]
+    patched = apply_json_patch(page, [
+        {"op": "replace", "path": "/0/box/0", "value": 10},
+        {"op": "add", "path": "/1/a~1b", "value": {"x": 1}},
+        {"op": "move", "from": "/1", "path": "/0"},
+        {"op": "copy", "from": "/1/box", "path": "/1/old_box"},
+        {"op": "remove", "path": "/1/type"},
+        {"op": "test", "path": "/0/a~1b/x", "value": 1},
+    ])
+    assert patched == [{"type": "PAGE", "a/b": {"x": 1}}, {"box": [10, 2, 3, 4], "old_box": [10, 2, 3, 4]}]
+    assert page == [{"type": "ENTRY", "box": [1, 2, 3, 4]}, {"type": "PAGE"}]
+    with pytest.raises(PatchConflictError):
+        apply_json_patch(page, [{"op": "test", "path": "/1/type", "value": "ENTRY"}])
+    with pytest.raises(PatchConflictError):
+        apply_json_patch(page, [{"op": "remove", "path": "/2"}])
+    with pytest.raises(InvalidPatchError):
+        apply_json_patch(page, [{"op": "jump", "path": "/0"}])
+
+
+def test_keyed_diff():
+    page = [{"type": "ENTRY", "checked": False}, {"type": "PAGE"}]
+    assert apply_keyed_diff(page, {"0": {"checked": True, "type": None}}) == [{"checked": True}, {"type": "PAGE"}]
+    assert page[0] == {"type": "ENTRY", "checked": False}
+    with pytest.raises(PatchConflictError):
+        apply_keyed_diff(page, {"2": {"checked": True}})
+    with pytest.raises(InvalidPatchError):
+        apply_keyed_diff(page, {"first": {"checked": True}})
+    with pytest.raises(InvalidPatchError):
+        apply_keyed_diff(page, {"\u00b2": {"checked": True}})
+    with pytest.raises(PatchConflictError):
+        apply_json_patch(page, [{"op": "replace", "path": "/\u00b2/checked", "value": True}])
+
+
+def test_backend_update_retries_concurrent_saves(annotation_backend):
+    annotation_backend.save("testdoc.pdf", 1, [{"type": "PAGE", "n": 0}])
+    calls = []
+
+    def transform(page):
+        calls.append(page)
+        if len(calls) == 1:
+            # Saved by somebody else while the page is transformed
+            annotation_backend.save("testdoc.pdf", 1, [{"type": "PAGE", "n": 1}])
+        return apply_keyed_diff(page, {"0": {"n": page[0]["n"] + 10}})
+    annotation_backend.update("testdoc.pdf", 1, transform)
+    assert len(calls) == 2
+    assert annotation_backend.load("testdoc.pdf", 1) == [{"type": "PAGE", "n": 11}]
+
+
+# ARCHIVE UPLOAD
+def test_replace_and_compaction_keep_archive_mode(annot_path):
+    zip_path = os.path.join(annot_path, "modedoc.zip")
+    replace_document_annotations(annot_path, "modedoc.pdf", _empty_zip())
+    umask = os.umask(0)
+    os.umask(umask)
+    assert os.stat(zip_path).st_mode & 0o777 == 0o666 & ~umask
+    os.chmod(zip_path, 0o640)
+    replace_document_annotations(annot_path, "modedoc.pdf", _empty_zip())
+    assert os.stat(zip_path).st_mode & 0o777 == 0o640
+    save_annotations(annot_path, "modedoc.pdf", 1, {"v": 1})
+    compact_annotations(annot_path, "modedoc.pdf")
+    assert not os.path.exists(zip_path + ".log")
+    assert os.stat(zip_path).st_mode & 0o777 == 0o640
+
+
+def test_replace_checks_archive(annot_path):
+    with pytest.raises(InvalidArchiveError):
+        replace_document_annotations(annot_path, "testdoc.pdf", b"PK\x03\x04truncated")
+    for name, content in [("notes.txt", "{}"), ("1.json", "{}"), ("0001.json", "{not json")]:
+        data_zip = BytesIO()
+        with zipfile.ZipFile(data_zip, "w") as zipOut:
+            zipOut.writestr(name, content)
+        with pytest.raises(InvalidArchiveError):
+            replace_document_annotations(annot_path, "testdoc.pdf", data_zip.getvalue())
+    assert os.listdir(annot_path) == []
+
+
+def test_replace_merge_appends_changed_views(annot_path):
+    doc_name = "testdoc.pdf"
+    for v in [1, 2]:
+        save_annotations(annot_path, doc_name, v, [{"type": "PAGE", "v": v}])
+    compact_annotations(annot_path, doc_name)
+    data_zip = BytesIO()
+    with zipfile.ZipFile(data_zip, "w") as zipOut:
+        zipOut.writestr("0001.json", '[{"type": "PAGE", "v": 1}]')
+        zipOut.writestr("0002.json", '[{"type": "PAGE", "v": "new"}]')
+    data_zip.seek(0)
+    replace_document_annotations(annot_path, doc_name, data_zip, merge=True)
+    assert sorted(alog.read_index(os.path.join(annot_path, "testdoc.zip.log")).entries) == [2]
+    assert load_annotations(annot_path, doc_name, 2) == [{"type": "PAGE", "v": "new"}]
+
+
+# ANNOTATION BACKENDS
+def test_backend_save_load_roundtrip(annotation_backend):
+    data = [{"type": "ENTRY", "box": [1, 2, 3, 4], "text": "éàœß🚀"}]
+    annotation_backend.save("testdoc.pdf", 1, data)
+    annotation_backend.save("testdoc.pdf", 1, data + data)
+    assert len(annotation_backend.load("testdoc", 1)) == 2
+    with pytest.raises(AnnotationsNotFoundError):
+        annotation_backend.load("testdoc.pdf", 2)
+    with pytest.raises(AnnotationsNotFoundError):
+        annotation_backend.load("otherdoc.pdf", 1)
+
+
+def test_backend_export_is_a_snapshot(annotation_backend):
+    annotation_backend.save("testdoc.pdf", 1, {"v": 1})
+    export = annotation_backend.open_export("testdoc.pdf")
+    annotation_backend.save("testdoc.pdf", 2, {"v": 2})
+    with annotation_backend.open_export("testdoc.pdf").file as zip_file:
+        other = zip_file.read()
+    annotation_backend.replace("testdoc.pdf", other)
+    with export.file as zip_file:
+        data = zip_file.read()
+    assert len(data) == export.size
+    with zipfile.ZipFile(BytesIO(data)) as zipObj:
+        assert zipObj.namelist() == ["0001.json"]
+    again = annotation_backend.open_export("testdoc.pdf")
+    again.file.close()
+    assert again.etag != export.etag
+    assert annotation_backend.open_export("otherdoc.pdf") is None
+
+
+def test_backend_export_replace(annotation_backend):
+    data = {"a": 1}
+    for v in [1, 2, 10]:
+        annotation_backend.save("testdoc1.pdf", v, data)
+    assert annotation_backend.export_zip("testdoc2.pdf") is None
+    data_zip = annotation_backend.export_zip("testdoc1.pdf")
+    with zipfile.ZipFile(data_zip) as zipObj:
+        assert set(zipObj.namelist()) == set(["0001.json", "0002.json", "0010.json"])
+
+    annotation_backend.save("testdoc2.pdf", 20, data)
+    data_zip.seek(0)
+    annotation_backend.replace("testdoc2.pdf", data_zip.read())
+    assert annotation_backend.load("testdoc2.pdf", 10) == data
+    with pytest.raises(AnnotationsNotFoundError):
+        annotation_backend.load("testdoc2.pdf", 20)
+
+
+def test_backend_replace_merge(annotation_backend):
+    for v in [1, 2]:
+        annotation_backend.save("testdoc.pdf", v, {"v": v})
+    data_zip = BytesIO()
+    with zipfile.ZipFile(data_zip, "w") as zipOut:
+        zipOut.writestr("0002.json", '{"v": "new"}')
+        zipOut.writestr("0003.json", '{"v": 3}')
+    data_zip.seek(0)
+    annotation_backend.replace("testdoc.pdf", data_zip, merge=True)
+    assert [annotation_backend.load("testdoc.pdf", v) for v in [1, 2, 3]] == [{"v": 1}, {"v": "new"}, {"v": 3}]
+    with pytest.raises(InvalidArchiveError):
+        annotation_backend.replace("testdoc.pdf", b"garbage")
+    assert annotation_backend.load("testdoc.pdf", 1) == {"v": 1}
+
+
+def test_backend_save_load_many(annotation_backend):
+    annotation_backend.save_many("testdoc.pdf", {1: {"v": 1}, 3: {"v": 3}})
+    loaded = list(annotation_backend.load_many("testdoc.pdf", [1, 2, 3]))
+    assert [(view, data) for view, data, _ in loaded] == [(1, {"v": 1}), (2, None), (3, {"v": 3})]
+    assert isinstance(loaded[1][2], AnnotationsNotFoundError)
+
+
+def test_backend_versions(annotation_backend):
+    version = annotation_backend.save("testdoc.pdf", 1, {"v": 1})
+    assert annotation_backend.version("testdoc.pdf", 1) == version
+    with pytest.raises(AnnotationsNotFoundError):
+        annotation_backend.version("testdoc.pdf", 2)
+    with pytest.raises(VersionMismatchError):
+        annotation_backend.save("testdoc.pdf", 1, {"v": 2}, if_match="0-0")
+    with pytest.raises(VersionMismatchError):
+        annotation_backend.save("testdoc.pdf", 2, {"v": 2}, if_match="*")
+    new_version = annotation_backend.save("testdoc.pdf", 1, {"v": 2}, if_match=version)
+    assert new_version != version
+    assert annotation_backend.load("testdoc.pdf", 1) == {"v": 2}
+    # Versions identify contents: they survive compaction and export
+    data_zip = annotation_backend.export_zip("testdoc.pdf")
+    annotation_backend.replace("testdoc.pdf", data_zip.read())
+    assert annotation_backend.version("testdoc.pdf", 1) == new_version
+
+
+def test_sqlite_backend_replace_error(annot_path):
+    import sqlite3
+    db_path = os.path.join(annot_path, "locked.sqlite3")
+    backend = SQLiteAnnotationBackend(db_path, timeout=0.1)
+    backend.save("testdoc.pdf", 1, {"v": 1})
+    locker = sqlite3.connect(db_path)
+    locker.execute("BEGIN IMMEDIATE")
+    try:
+        with pytest.raises(SaveError):
+            backend.replace("testdoc.pdf", backend.export_zip("testdoc.pdf"))
+    finally:
+        locker.rollback()
+        locker.close()
+    assert backend.load("testdoc.pdf", 1) == {"v": 1}
+
+
+def test_backend_lists_documents_and_views(annotation_backend):
+    annotation_backend.save_many("testdoc.pdf", {3: {"v": 3}, 1: {"v": 1}})
+    annotation_backend.save("otherdoc.pdf", 2, {"v": 2})
+    assert annotation_backend.documents() == ["otherdoc", "testdoc"]
+    assert annotation_backend.document_views("testdoc.pdf") == [1, 3]
+    assert annotation_backend.document_views("unknown.pdf") == []
+
+
+# READING ORDER
+def test_assign_columns_matches_dense_search():
+    rng = np.random.default_rng(0)
+    # Two sections of three columns, and a column overlapping others
+    columns = np.array([[x, y, 100, 200] for y in (0, 300) for x in (0, 100, 250)] + [[50, 250, 100, 100]])
+    points = rng.integers(-10, 520, size=(500, 2))
+    in_x = (columns[:, 0, None] <= points[:, 0]) & (points[:, 0] < columns[:, 0, None] + columns[:, 2, None])
+    in_y = (columns[:, 1, None] <= points[:, 1]) & (points[:, 1] < columns[:, 1, None] + columns[:, 3, None])
+    inside = in_x & in_y
+    for count in (6, 7):
+        expected = np.where(inside[:count].any(axis=0), np.argmax(inside[:count], axis=0), -1)
+        assert (assign_columns(points, columns[:count]) == expected).all()
+
+
+def test_sort_page():
+    page = [
+        {"type": "COLUMN_LEVEL_1", "box": [100, 0, 100, 500]},
+        {"type": "ENTRY", "box": [110, 10, 50, 20], "id": "b1"},
+        {"type": "COLUMN_LEVEL_1", "box": [0, 0, 100, 500]},
+        {"type": "ENTRY", "box": [400, 10, 50, 20], "id": "out"},
+        {"type": "TITLE_LEVEL_2", "box": [10, 300, 50, 20], "id": "a2"},
+        {"type": "ENTRY", "box": [110, 5, 50, 10], "id": "b0"},
+        {"type": "ENTRY", "box": [10, 100, 50, 20], "id": "a1"},
+        {"type": "PAGE", "box": [0, 0, 500, 500]},
+    ]
+    ordered = sort_page(page)
+    assert [e.get("id", e["type"]) for e in ordered] == \
+        ["COLUMN_LEVEL_1", "COLUMN_LEVEL_1", "PAGE", "b0", "b1", "a1", "a2", "out"]
+    assert sort_page({"nested": "format"}) == {"nested": "format"}
+    with pytest.raises(RuntimeError):
+        sort_entries(page[3:4], page[:1], skip_error=False)
+
+
+@pytest.mark.parametrize("backend_name", ["zip", "sqlite"])
+def test_sort_documents(annot_path, backend_name):
+    config = {ANNOT_PATH: annot_path, ANNOT_BACKEND: backend_name}
+    backend = create_annotation_backend(config)
+    column = {"type": "COLUMN_LEVEL_1", "box": [0, 0, 100, 500]}
+    first = {"type": "ENTRY", "box": [0, 0, 10, 10]}
+    second = {"type": "ENTRY", "box": [0, 100, 10, 10]}
+    backend.save_many("testdoc.pdf", {1: [column, second, first], 2: [column, first, second]})
+    assert sort_documents(config, max_workers=1) == {"testdoc": 1}
+    assert [e["box"] for e in backend.load("testdoc.pdf", 1)] == [column["box"], first["box"], second["box"]]
+
+
+def test_sort_document_keeps_concurrent_saves(annot_path, monkeypatch):
+    config = {ANNOT_PATH: annot_path, ANNOT_BACKEND: "zip"}
+    backend = create_annotation_backend(config)
+    column = {"type": "COLUMN_LEVEL_1", "box": [0, 0, 100, 500]}
+    first = {"type": "ENTRY", "box": [0, 0, 10, 10]}
+    second = {"type": "ENTRY", "box": [0, 100, 10, 10]}
+    third = {"type": "ENTRY", "box": [0, 200, 10, 10]}
+    backend.save("testdoc.pdf", 1, [column, second, first])
+
+    def sort_page_during_save(page):
+        # Saved by a user while the document is being sorted
+        monkeypatch.setattr(reading_order, "sort_page", sort_page_unchanged)
+        backend.save("testdoc.pdf", 1, [column, third, second, first])
+        return sort_page_unchanged(page)
+    sort_page_unchanged = reading_order.sort_page
+    monkeypatch.setattr(reading_order, "sort_page", sort_page_during_save)
+    assert reading_order.sort_document(config, "testdoc.pdf") == 1
+    assert [e["box"] for e in backend.load("testdoc.pdf", 1)] == [column["box"], first["box"], second["box"],
+                                                                   third["box"]]
+
+
+# SPATIAL INDEX
+def test_spatial_index_queries(annotation_backend, annot_path):
+    index = SpatialIndex(os.path.join(annot_path, "spatial_index.sqlite3"))
+    column = {"type": "COLUMN_LEVEL_1", "box": [0, 0, 100, 500]}
+    entry = {"type": "ENTRY", "box": [10, 10, 50, 20], "text": "Didot"}
+    title = {"type": "TITLE_LEVEL_1", "box": [200, 10, 50, 20]}
+    pages = {1: [column, entry, title], 2: [column, dict(entry, box=[10, 300, 50, 20])]}
+    versions = annotation_backend.save_many("testdoc.pdf", pages)
+    index.index_saved("testdoc.pdf", {view: (annotation_backend.load("testdoc.pdf", view), version)
+                                      for view, version in versions.items()})
+    assert [(v, i) for v, i, _ in index.query(annotation_backend, "testdoc.pdf", [1, 2], box=(0, 0, 70, 25))] == \
+        [(1, 0), (1, 1), (2, 0)]
+    found = index.query(annotation_backend, "testdoc.pdf", [1, 2, 3], types=["ENTRY"])
+    assert [(v, i, e["text"]) for v, i, e in found] == [(1, 1, "Didot"), (2, 1, "Didot")]
+    assert found[0][2]["origin"] == "computer"
+    # Views saved without the index are indexed again when queried
+    annotation_backend.save("testdoc.pdf", 2, [title])
+    annotation_backend.save("testdoc.pdf", 3, [entry])
+    found = index.query(annotation_backend, "testdoc.pdf", [1, 2, 3], types=["ENTRY", "TITLE_LEVEL_1"])
+    assert [(v, i, e["type"]) for v, i, e in found] == \
+        [(1, 1, "ENTRY"), (1, 2, "TITLE_LEVEL_1"), (2, 0, "TITLE_LEVEL_1"), (3, 0, "ENTRY")]
+    # Views of replaced annotations are forgotten, then indexed again when queried
+    index.index_replaced("testdoc.pdf")
+    assert index._connection().execute("SELECT COUNT(*) FROM elements").fetchone()[0] == 0
+    assert len(index.query(annotation_backend, "testdoc.pdf", [1, 2, 3])) == 5
+    annotation_backend.replace("testdoc.pdf", _empty_zip())
+    assert index.query(annotation_backend, "testdoc.pdf", [1, 2, 3]) == []
+
+
+def _backend_name(annotation_backend):
+    return "sqlite" if isinstance(annotation_backend, SQLiteAnnotationBackend) else "zip"
+
+
+def _empty_zip():
+    data_zip = BytesIO()
+    with zipfile.ZipFile(data_zip, "w"):
+        pass
+    return data_zip.getvalue()
+
+
+# FULL-TEXT SEARCH
+def test_extract_texts():
+    page = {"type": "PAGE", "children": [
+        {"type": "TITLE_LEVEL_1", "box": [1, 2, 3, 4], "text": "KAU KER\n"},
+        {"type": "ENTRY", "raw": "Justice, place Vendôme", "name": "Justice", "origin": "computer",
+         "children": [{"type": "LINE", "text": "ignored"}]}]}
+    assert extract_texts(page) == [
+        ("/children/0", "TITLE_LEVEL_1", [1, 2, 3, 4], "KAU KER"),
+        ("/children/1", "ENTRY", None, "Justice, place Vendôme Justice")]
+    assert extract_texts([{"type": "ENTRY", "text": ""}, {"type": "ENTRY", "text": "Didot"}]) == \
+        [("/1", "ENTRY", None, "Didot")]
+
+
+def test_search_index(annotation_backend, annot_path):
+    index = SearchIndex(os.path.join(annot_path, "search_index.sqlite3"))
+    first = {"type": "ENTRY", "box": [10, 10, 50, 20], "text": "Didot frères, imprimeurs, rue Jacob"}
+    second = {"type": "ENTRY", "box": [10, 40, 50, 20], "text": "Dupont, épicier, rue Jacob"}
+    versions = annotation_backend.save_many("testdoc.pdf", {1: [first], 2: [second]})
+    index.index_saved("testdoc.pdf", {1: ([first], versions[1])})
+    assert [hit["view"] for hit in index.search("jacob")] == [1]
+    # Views which changed are indexed again by a refresh
+    assert index.refresh(annotation_backend, "testdoc.pdf") == 1
+    assert index.refresh(annotation_backend, "testdoc.pdf") == 0
+    hits = index.search("EPICIER jac*")
+    assert [(h["document"], h["view"], h["path"], h["box"]) for h in hits] == [("testdoc", 2, "/0", [10, 40, 50, 20])]
+    # Query operators are plain words
+    assert len(index.search('"rue" (')) == 2 and index.search("rue OR Didot") == [] and index.search(" ") == []
+    assert index.search("jacob", "otherdoc.pdf") == []
+    annotation_backend.save("otherdoc.pdf", 1, [second])
+    annotation_backend.replace("testdoc.pdf", _empty_zip())
+    config = {ANNOT_PATH: annot_path, ANNOT_BACKEND: _backend_name(annotation_backend)}
+    assert index.build(config, max_workers=1) == {"otherdoc": 1, "testdoc": 2}
+    assert [(h["document"], h["view"]) for h in index.search("jacob")] == [("otherdoc", 1)]
+
+
+def test_search_index_command_uses_server_index(annot_path, monkeypatch):
+    cache_path = os.path.join(annot_path, "cache")
+    settings_path = os.path.join(annot_path, "settings.cfg")
+    with open(settings_path, "w") as settings:
+        settings.write(f"SODUCO_CACHE_PATH = {cache_path!r}\n")
+    monkeypatch.setenv("SODUCO_SETTINGS", settings_path)
+    save_annotations(annot_path, "testdoc.pdf", 1, [{"type": "ENTRY", "box": [0, 0, 1, 1], "text": "Didot"}])
+    assert search_index_main(["--workers", "1", annot_path]) == 0
+    index_path = search_index_path({ANNOT_PATH: annot_path, CACHE_PATH: cache_path})
+    assert index_path == os.path.join(cache_path, "search_index.sqlite3")
+    assert [hit["view"] for hit in SearchIndex(index_path).search("didot")] == [1]